@@ -0,0 +1,62 @@
+"""
+Measures how long it takes to start the `openag` command line interface, by
+running `openag db show` in fresh interpreters, and fails if the median time
+exceeds the budget. The CLI is run from scripts and cron jobs on slow SD
+cards, where startup time dominates.
+
+Usage: python benchmarks/cli_startup.py [--runs N] [--budget SECONDS]
+"""
+import os
+import sys
+import time
+import click
+import subprocess
+
+SCRIPT = """
+import sys
+from openag.cli import main
+try:
+    main(["db", "show"])
+except SystemExit:
+    pass
+"""
+
+def timed_run(script, env):
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        subprocess.call(
+            [sys.executable, "-c", script], env=env, stdout=devnull,
+            stderr=devnull
+        )
+    return time.time() - start
+
+def median_time(script, env, runs):
+    return sorted(timed_run(script, env) for _ in range(runs))[runs // 2]
+
+@click.command()
+@click.option("--runs", default=20)
+@click.option(
+    "--budget", default=0.25, help="Maximum median startup time in seconds"
+)
+def main(runs, budget):
+    env = dict(os.environ)
+    # Run openag from this checkout, wherever the script is run from
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + filter(None, [env.get("PYTHONPATH")])
+    )
+    # The time taken to start the interpreter itself, for comparison
+    baseline = median_time("pass", env, runs)
+    median = median_time(SCRIPT, env, runs)
+    click.echo("openag db show: {:.3f}s (interpreter alone: {:.3f}s)".format(
+        median, baseline
+    ))
+    if median > budget:
+        raise click.ClickException(
+            "Startup took {:.3f}s, which is over the budget of {:.3f}s".format(
+                median, budget
+            )
+        )
+
+if __name__ == '__main__':
+    main()
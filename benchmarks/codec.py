@@ -0,0 +1,57 @@
+"""
+Compares the size and encoding/decoding speed of series of data point values
+encoded with :mod:`openag.codec` against plain JSON arrays.
+
+Usage: python benchmarks/codec.py [--count N]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import click
+
+# Import openag from this checkout, wherever the script is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openag.codec import encode_series, decode_series
+
+def generate_series(count):
+    start = time.time() - count
+    timestamps = [start + i for i in range(count)]
+    values = [
+        round(22 + 2 * math.sin(i / 3600.0) + random.gauss(0, 0.05), 1)
+        for i in range(count)
+    ]
+    return timestamps, values
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+@click.command()
+@click.option("--count", default=86400)
+def main(count):
+    timestamps, values = generate_series(count)
+    plain, plain_encode_time = timed(
+        json.dumps, {"timestamps": timestamps, "values": values}
+    )
+    _, plain_decode_time = timed(json.loads, plain)
+    encoded, encode_time = timed(encode_series, timestamps, values)
+    encoded = json.dumps(encoded)
+    _, decode_time = timed(lambda s: decode_series(json.loads(s)), encoded)
+    click.echo("JSON arrays: {} bytes, encode {:.3f}s, decode {:.3f}s".format(
+        len(plain), plain_encode_time, plain_decode_time
+    ))
+    click.echo("dod-xor: {} bytes, encode {:.3f}s, decode {:.3f}s".format(
+        len(encoded), encode_time, decode_time
+    ))
+    click.echo("Compression ratio: {:.1f}".format(
+        float(len(plain)) / len(encoded)
+    ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares the insert rate and resulting database size of environmental data
+points with time-ordered IDs (from :func:`openag.couch.data_point_id`) against
+points with random IDs assigned by CouchDB.
+
+Usage: python benchmarks/data_point_ids.py [--db_url URL] [--count N]
+"""
+import os
+import sys
+import time
+import click
+
+# Import openag from this checkout, wherever the script is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openag.couch import Server
+
+def generate_points(count):
+    start = time.time() - count
+    for i in range(count):
+        yield {
+            "environment": "environment_1",
+            "variable": "air_temperature",
+            "is_desired": False,
+            "value": 20 + (i % 100) / 10.0,
+            "timestamp": start + i
+        }
+
+def wait_for_compaction(db):
+    while db.info()["compact_running"]:
+        time.sleep(0.5)
+
+@click.command()
+@click.option("--db_url", default="http://localhost:5984")
+@click.option("--count", default=100000)
+@click.option("--batch_size", default=1000)
+def main(db_url, count, batch_size):
+    server = Server(db_url)
+    for mode in ("random", "time_ordered"):
+        db_name = "benchmark_data_point_ids_" + mode
+        if db_name in server:
+            del server[db_name]
+        db = server.get_or_create(db_name)
+        start = time.time()
+        if mode == "time_ordered":
+            server.write_data_points(
+                generate_points(count), db_name, batch_size=batch_size
+            )
+        else:
+            batch = []
+            for point in generate_points(count):
+                batch.append(point)
+                if len(batch) >= batch_size:
+                    db.update(batch)
+                    batch = []
+            if batch:
+                db.update(batch)
+        duration = time.time() - start
+        size = db.info()["disk_size"]
+        db.compact()
+        wait_for_compaction(db)
+        compacted_size = db.info()["disk_size"]
+        click.echo(
+            "{}: {:.0f} points/second, {} bytes on disk ({} bytes after "
+            "compaction)".format(
+                mode, count / duration, size, compacted_size
+            )
+        )
+        del server[db_name]
+
+if __name__ == '__main__':
+    main()
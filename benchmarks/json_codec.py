@@ -0,0 +1,57 @@
+"""
+Compares the speed of encoding and decoding batches of environmental data
+points with each JSON library supported by :mod:`openag.json_codec` that is
+installed.
+
+Usage: python benchmarks/json_codec.py [--count N]
+"""
+import os
+import sys
+import time
+import click
+
+# Import openag from this checkout, wherever the script is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openag import json_codec
+
+def generate_points(count):
+    start = time.time() - count
+    return [
+        {
+            "_id": "{:.6f}-environment_1-air_temperature-measured".format(
+                start + i
+            ),
+            "environment": "environment_1",
+            "variable": "air_temperature",
+            "is_manual": False,
+            "is_desired": False,
+            "value": 20 + (i % 100) / 10.0,
+            "timestamp": start + i
+        } for i in range(count)
+    ]
+
+def timed(f, *args):
+    start = time.time()
+    res = f(*args)
+    return res, time.time() - start
+
+@click.command()
+@click.option("--count", default=100000)
+def main(count):
+    docs = {"docs": generate_points(count)}
+    for name in json_codec.BACKENDS:
+        try:
+            json_codec.use(name)
+        except ImportError:
+            click.echo("{}: not installed".format(name))
+            continue
+        data, encode_time = timed(json_codec.dumps, docs)
+        _, decode_time = timed(json_codec.loads, data)
+        click.echo("{}: encode {:.3f}s, decode {:.3f}s".format(
+            name, encode_time, decode_time
+        ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the speed of validating documents with the voluptuous schemas in
+:mod:`openag.models` against the validators compiled from them by
+:mod:`openag.validators`.
+
+Usage: python benchmarks/validators.py [--count N]
+"""
+import os
+import sys
+import time
+import click
+
+# Import openag from this checkout, wherever the script is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openag.models import EnvironmentalDataPoint, FirmwareModuleType
+from openag.validators import compile_schema
+
+def generate_points(count):
+    start = time.time() - count
+    return [
+        {
+            "environment": "environment_1",
+            "variable": "air_temperature",
+            "is_desired": False,
+            "value": 20 + (i % 100) / 10.0,
+            "timestamp": start + i
+        } for i in range(count)
+    ]
+
+def generate_module_types(count):
+    return [
+        {
+            "_id": "module_type_{}".format(i),
+            "repository": {"type": "git", "url": "http://example.com/test"},
+            "header_file": "test.h",
+            "class_name": "Test",
+            "categories": ["sensors", "actuators"],
+            "arguments": [{"name": "pin", "type": "int", "default": 2}],
+            "inputs": {"set": {"type": "std_msgs/Float32"}},
+            "outputs": {
+                "temperature": {
+                    "type": "std_msgs/Float32", "accuracy": 0.5,
+                    "variable": "air_temperature"
+                }
+            },
+            "dependencies": [{"type": "pio", "id": 1}]
+        } for i in range(count)
+    ]
+
+def timed(validate, docs):
+    start = time.time()
+    for doc in docs:
+        validate(doc)
+    return time.time() - start
+
+@click.command()
+@click.option("--count", default=100000)
+def main(count):
+    for name, schema, docs in (
+        ("EnvironmentalDataPoint", EnvironmentalDataPoint,
+            generate_points(count)),
+        ("FirmwareModuleType", FirmwareModuleType,
+            generate_module_types(count // 10))
+    ):
+        slow = timed(schema, docs)
+        fast = timed(compile_schema(schema), docs)
+        click.echo(
+            "{}: voluptuous {:.3f}s, compiled {:.3f}s ({:.1f}x faster)".format(
+                name, slow, fast, slow / fast
+            )
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+function(newDoc, oldDoc, userCtx, secObj) {
+  if (newDoc._deleted) {
+    return;
+  }
+  var required_fields = ['environment', 'variable', 'is_desired', 'start', 'size', 'timestamps', 'values'];
+  var field;
+  for (var i in required_fields) {
+    field = required_fields[i];
+    if (!newDoc.hasOwnProperty(field)) {
+      throw({forbidden: "EnvironmentalDataBucket instances are required to have a " + field + " field"});
+    }
+  }
+  if (!newDoc.encoding && newDoc.timestamps.length != newDoc.values.length) {
+    throw({forbidden: "EnvironmentalDataBucket instances must have as many timestamps as values"});
+  }
+}
@@ -0,0 +1,18 @@
+function (doc) {
+  var point_type;
+  if (doc.is_desired) {
+    point_type = 'desired';
+  }
+  else {
+    point_type = 'measured';
+  }
+  var latest;
+  if (doc.encoding) {
+    latest = doc.latest;
+  }
+  else {
+    var last = doc.timestamps.length - 1;
+    latest = {timestamp: doc.timestamps[last], value: doc.values[last]};
+  }
+  emit([doc.environment, point_type, doc.variable, doc.start], latest);
+}
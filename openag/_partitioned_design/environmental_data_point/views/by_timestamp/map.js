@@ -0,0 +1,3 @@
+function (doc) {
+  emit([doc.timestamp], doc);
+}
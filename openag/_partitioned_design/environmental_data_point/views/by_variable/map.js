@@ -0,0 +1,10 @@
+function (doc) {
+  var point_type;
+  if (doc.is_desired) {
+    point_type = 'desired';
+  }
+  else {
+    point_type = 'measured';
+  }
+  emit([point_type, doc.variable, doc.timestamp], doc);
+}
@@ -1,12 +1,76 @@
+import sys
+import time
 import click
+from importlib import import_module
 
-@click.group()
-def main():
-    """ Command Line Interface for OpenAg software """
+from . import timings as _timings
+
+class LazyGroup(click.Group):
+    """
+    A group whose subcommands are only imported when they are used. The
+    subcommands are given as a dictionary mapping their names to import paths
+    of the form "module:attribute". This keeps commands such as `openag db
+    show` from importing the dependencies of every other command (couchdb,
+    voluptuous, yaml, the firmware code generators) on startup.
+    """
+    def __init__(self, *args, **kwargs):
+        self.lazy_commands = kwargs.pop("lazy_commands", {})
+        super(LazyGroup, self).__init__(*args, **kwargs)
+
+    def list_commands(self, ctx):
+        return sorted(
+            set(super(LazyGroup, self).list_commands(ctx)) |
+            set(self.lazy_commands)
+        )
 
-from db import db as db_commands
-from cloud import cloud as cloud_commands
-from firmware import firmware as firmware_commands
-main.add_command(db_commands)
-main.add_command(cloud_commands)
-main.add_command(firmware_commands)
+    def get_command(self, ctx, name):
+        if not name in self.commands and name in self.lazy_commands:
+            module_name, _, attr = self.lazy_commands[name].partition(":")
+            self.add_command(getattr(import_module(module_name), attr), name)
+        return super(LazyGroup, self).get_command(ctx, name)
+
+@click.group(cls=LazyGroup, lazy_commands={
+    "db": "openag.cli.db:db",
+    "cloud": "openag.cli.cloud:cloud",
+    "firmware": "openag.cli.firmware:firmware"
+})
+@click.option(
+    "--profile", is_flag=True,
+    help="Profile the command and print the functions that took the longest"
+)
+@click.option(
+    "--profile_file", type=click.Path(dir_okay=False),
+    help="Profile the command and write the statistics to this file (which "
+    "can be read with the pstats module)"
+)
+@click.option(
+    "--profile_sort", default="cumulative",
+    type=click.Choice(["cumulative", "time", "calls"]),
+    help="How to sort the functions printed by --profile"
+)
+@click.option(
+    "--timings", is_flag=True,
+    help="Print how long each phase of the command took"
+)
+@click.pass_context
+def main(ctx, profile, profile_file, profile_sort, timings):
+    """ Command Line Interface for OpenAg software """
+    if profile or profile_file:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        def report_profile():
+            profiler.disable()
+            if profile_file:
+                profiler.dump_stats(profile_file)
+            if profile:
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats(profile_sort).print_stats(30)
+        ctx.call_on_close(report_profile)
+        profiler.enable()
+    if timings:
+        _timings.reset()
+        start = time.time()
+        def report_timings():
+            click.echo(_timings.format_phases(time.time() - start), err=True)
+        ctx.call_on_close(report_timings)
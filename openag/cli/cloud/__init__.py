@@ -1,8 +1,10 @@
 import click
 
-from .db import init, show, deinit
+from .db import init, show, deinit, refresh_pull
 from .user import register, login, logout
-from .farm import create_farm, list_farms, init_farm, deinit_farm
+from .farm import (
+    create_farm, list_farms, init_farm, deinit_farm, push_farm
+)
 
 @click.group()
 def cloud():
@@ -16,6 +18,7 @@ def cloud():
 cloud.add_command(init)
 cloud.add_command(show)
 cloud.add_command(deinit)
+cloud.add_command(refresh_pull)
 
 cloud.add_command(register)
 cloud.add_command(login)
@@ -25,3 +28,4 @@ cloud.add_command(create_farm)
 cloud.add_command(list_farms)
 cloud.add_command(init_farm)
 cloud.add_command(deinit_farm)
+cloud.add_command(push_farm)
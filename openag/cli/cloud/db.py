@@ -1,3 +1,4 @@
+import time
 import click
 from urlparse import urlparse
 
@@ -7,7 +8,15 @@ from .user import logout as logout_user
 
 @click.command()
 @click.argument("cloud_url")
-def init(cloud_url):
+@click.option(
+    "--selective_pull/--full_pull", default=False,
+    help="Only pull the module types used by the modules on the local server"
+)
+@click.option(
+    "--compression/--no_compression", default=False,
+    help="Compress the traffic to the cloud server with gzip"
+)
+def init(cloud_url, selective_pull, compression):
     """
     Choose a cloud server to use. Sets CLOUD_URL as the cloud server to use and
     sets up replication of global databases from that cloud server if a local
@@ -24,6 +33,9 @@ def init(cloud_url):
     parsed_url = urlparse(cloud_url)
     if not parsed_url.scheme or not parsed_url.netloc or not parsed_url.port:
         raise click.BadParameter("Invalid url")
+    with config.transaction():
+        config["cloud_server"]["selective_pull"] = selective_pull
+        config["cloud_server"]["compression"] = compression
     if config["local_server"]["url"]:
         utils.replicate_global_dbs(cloud_url=cloud_url)
     config["cloud_server"]["url"] = cloud_url
@@ -47,6 +59,41 @@ def show():
             "Using farm \"{}\"".format(config["cloud_server"]["farm_name"])
         )
 
+@click.command()
+@click.option(
+    "--loop", is_flag=True,
+    help="Keep running and check for changed modules periodically"
+)
+@click.option(
+    "--interval", type=int, default=60,
+    help="Number of seconds between checks with --loop"
+)
+def refresh_pull(loop, interval):
+    """
+    Update the selective pull of module types. Makes the replication of the
+    global databases pull the module types used by the modules currently on
+    the local server. With --loop, keeps running and does this whenever the
+    modules change.
+    """
+    utils.check_for_cloud_server()
+    utils.check_for_local_server()
+    if not config["cloud_server"].get("selective_pull"):
+        raise click.ClickException(
+            "Selective pull is not enabled. Run `openag cloud init` with the "
+            "--selective_pull option to enable it"
+        )
+    while True:
+        try:
+            if utils.refresh_global_db_replications():
+                click.echo("Updated the pulled module types")
+        except Exception as e:
+            if not loop:
+                raise
+            click.echo("Refresh failed: {}".format(e), err=True)
+        if not loop:
+            break
+        time.sleep(interval)
+
 @click.command()
 @click.pass_context
 def deinit(ctx):
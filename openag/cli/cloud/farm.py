@@ -1,8 +1,7 @@
 import json
+import time
 import click
-from couchdb.http import urljoin
 
-from openag.couch import Server
 from .. import utils
 from ..config import config
 
@@ -14,17 +13,16 @@ def create_farm(farm_name):
     cloud server. You can use the `openag cloud select_farm` command to start
     mirroring data into it.
     """
+    from couchdb.http import urljoin
     utils.check_for_cloud_server()
     utils.check_for_cloud_user()
-    server = Server(config["cloud_server"]["url"])
+    server = utils.get_cloud_server()
     username = config["cloud_server"]["username"]
-    password = config["cloud_server"]["password"]
-    server.log_in(username, password)
     url = urljoin(server.resource.url, "_openag", "v0.1", "register_farm")
     status, _, content = server.resource.session.request(
         "POST", url, headers=server.resource.headers.copy(), body={
             "name": username, "farm_name": farm_name
-        }, credentials=(username, password)
+        }
     )
     if status != 200:
         raise click.ClickException(
@@ -41,10 +39,7 @@ def list_farms():
     """
     utils.check_for_cloud_server()
     utils.check_for_cloud_user()
-    server = Server(config["cloud_server"]["url"])
-    server.log_in(
-        config["cloud_server"]["username"], config["cloud_server"]["password"]
-    )
+    server = utils.get_cloud_server()
     farms_list = server.get_user_info().get("farms", [])
     if not len(farms_list):
         raise click.ClickException(
@@ -59,7 +54,25 @@ def list_farms():
 
 @click.command()
 @click.argument("farm_name")
-def init_farm(farm_name):
+@click.option(
+    "--push_interval", type=int, default=0,
+    help="Push data to the farm every this many minutes (using `openag cloud "
+    "push_farm`) instead of replicating it continuously"
+)
+@click.option(
+    "--push_jitter", type=int, default=60,
+    help="Maximum random delay of each scheduled push (in seconds)"
+)
+@click.option(
+    "--seed", is_flag=True,
+    help="Upload the existing local data as a compressed snapshot before "
+    "setting up replication"
+)
+@click.option(
+    "--snapshot_dir", type=click.Path(file_okay=False, exists=True),
+    help="Directory in which to keep the snapshots created by --seed"
+)
+def init_farm(farm_name, push_interval, push_jitter, seed, snapshot_dir):
     """
     Select a farm to use. This command sets up the replication between your
     local database and the selected cloud server if you have already
@@ -73,7 +86,15 @@ def init_farm(farm_name):
             "Farm \"{}\" already initialized. Run `openag cloud deinit_farm` "
             "to deinitialize it".format(old_farm_name)
         )
+    if seed:
+        utils.check_for_local_server()
+    with config.transaction():
+        config["cloud_server"]["push_interval"] = push_interval
+        config["cloud_server"]["push_jitter"] = push_jitter
     if config["local_server"]["url"]:
+        if seed:
+            click.echo("Uploading snapshots of local data")
+            utils.seed_per_farm_dbs(farm_name, snapshot_dir)
         utils.replicate_per_farm_dbs(farm_name=farm_name)
     config["cloud_server"]["farm_name"] = farm_name
 
@@ -89,4 +110,50 @@ def deinit_farm():
     farm_name = config["cloud_server"]["farm_name"]
     if farm_name and config["local_server"]["url"]:
         utils.cancel_per_farm_db_replication()
-    config["cloud_server"]["farm_name"] = None
+    with config.transaction():
+        config["cloud_server"]["seed_seqs"] = None
+        config["cloud_server"]["farm_name"] = None
+
+@click.command()
+@click.option(
+    "--loop", is_flag=True,
+    help="Keep running and push in every scheduled window"
+)
+def push_farm(loop):
+    """
+    Push data to the current farm. Runs a one-shot replication of your local
+    data to the selected farm. With --loop, keeps running and pushes once per
+    window configured with `openag cloud init_farm --push_interval`. Failed
+    pushes are reported and retried in the next window.
+    """
+    utils.check_for_cloud_server()
+    utils.check_for_cloud_user()
+    utils.check_for_cloud_farm()
+    utils.check_for_local_server()
+    interval = config["cloud_server"].get("push_interval")
+    if loop and not interval:
+        raise click.ClickException(
+            "No push interval configured. Run `openag cloud init_farm` with "
+            "the --push_interval option to schedule pushes"
+        )
+    while True:
+        if loop:
+            time.sleep(utils.get_next_push_delay(
+                interval, config["cloud_server"].get("push_jitter", 0)
+            ))
+        try:
+            # Pick up modules added since the last push
+            utils.refresh_global_db_replications()
+            stats = utils.push_per_farm_dbs()
+        except Exception as e:
+            if not loop:
+                raise
+            # The link to the cloud server may be down for a while
+            click.echo("Push failed: {}".format(e), err=True)
+            continue
+        click.echo(
+            "Pushed {docs_written} documents in {duration:.1f} seconds "
+            "({docs_per_second:.1f} documents/second)".format(**stats)
+        )
+        if not loop:
+            break
@@ -1,8 +1,9 @@
 import click
 
-from openag.couch import Server
 from .farm import deinit_farm
-from ..utils import check_for_cloud_server, check_for_cloud_user
+from ..utils import (
+    check_for_cloud_server, check_for_cloud_user, cache_cloud_session
+)
 from ..config import config
 
 @click.command()
@@ -16,8 +17,12 @@ def register(username, password):
     Create a new user account. Creates a user account with the given
     credentials on the selected cloud server.
     """
+    from openag.couch import Server
     check_for_cloud_server()
-    server = Server(config["cloud_server"]["url"])
+    server = Server(
+        config["cloud_server"]["url"],
+        compress=config["cloud_server"].get("compression", False)
+    )
     server.create_user(username, password)
 
 @click.command()
@@ -27,6 +32,7 @@ def register(username, password):
 )
 def login(username, password):
     """ Log into your user account """
+    from openag.couch import Server
     check_for_cloud_server()
     old_username = config["cloud_server"]["username"]
     if old_username and old_username != username:
@@ -36,10 +42,15 @@ def login(username, password):
                 old_username
             )
         )
-    server = Server(config["cloud_server"]["url"])
+    server = Server(
+        config["cloud_server"]["url"],
+        compress=config["cloud_server"].get("compression", False)
+    )
     server.log_in(username, password)
-    config["cloud_server"]["username"] = username
-    config["cloud_server"]["password"] = password
+    with config.transaction():
+        config["cloud_server"]["username"] = username
+        config["cloud_server"]["password"] = password
+        cache_cloud_session(server)
 
 @click.command()
 @click.pass_context
@@ -49,5 +60,7 @@ def logout(ctx):
     check_for_cloud_user()
     if config["cloud_server"]["farm_name"]:
         ctx.invoke(deinit_farm)
-    config["cloud_server"]["username"] = None
-    config["cloud_server"]["password"] = None
+    with config.transaction():
+        config["cloud_server"]["username"] = None
+        config["cloud_server"]["password"] = None
+        config["cloud_server"]["session"] = None
@@ -14,54 +14,127 @@ config["cloud_server"]["username"] and
 config["cloud_server"]["password"] - The credentials with which to log in to
 the cloud server
 
+config["cloud_server"]["session"] - The cached session on the cloud server.
+Holds the "username" it belongs to, the "cookie" that identifies it and the
+timestamp at which it "expires"
+
+config["cloud_server"]["compression"] - If true, requests to the cloud server
+ask for gzipped responses and send large request bodies (such as bulk uploads)
+gzipped
+
 config["cloud_server"]["farm_name"] - The name of the farm on the cloud server
 into which to mirror data
 
+config["cloud_server"]["selective_pull"] - If true, only the firmware module
+types and software module types referenced by the modules on the local server
+are replicated from the cloud server
+
+config["cloud_server"]["module_seqs"] - The update sequences of the module
+databases on the local server at the time the list of module types to pull
+selectively was last built
+
+config["cloud_server"]["push_interval"] - If set, the per-farm databases are
+pushed to the cloud server every this many minutes (via `openag cloud
+push_farm`) instead of being replicated continuously
+
+config["cloud_server"]["push_jitter"] - The maximum number of random seconds
+by which to delay each scheduled push
+
+config["cloud_server"]["last_push"] - Statistics about the throughput of the
+most recent scheduled push
+
+config["cloud_server"]["seed_seqs"] - Maps the names of per-farm databases to
+the update sequences up to which they were uploaded to the cloud server as
+snapshots. Replication of those databases starts from these sequences
+
 config["local_server"] - Holds information about the local CouchDB instance
 selected by the current user
 
 config["local_server"]["url"] - The URL of the local server
+
+config["local_server"]["bucket_storage"] - If true, the local server has an
+"environmental_data_bucket" database (see
+`openag.couch.Server.write_bucketed_data_points`), which is replicated to the
+farm like the other per-farm databases
+
+config["local_server"]["retention"] - The retention policies used by `openag
+db retention` when none are given on the command line. Holds "policies", a
+dictionary mapping variable names to the number of days for which to keep
+environmental data points for that variable, and "default_days", the number of
+days for which to keep data points for other variables
+
+Changes to the configuration are written to the file as soon as they are made,
+each one under a lock and applied to a freshly loaded copy of the file.
+Commands that make several related changes should make them within
+`config.transaction()` so that they are written together, in a single atomic
+write, without interleaving with changes made by other `openag` processes.
 """
 import os
-import json
 import errno
+import tempfile
+from contextlib import contextmanager
 from click import get_app_dir
 
+from openag import json_codec as json
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 CONFIG_FOLDER = get_app_dir("openag", force_posix=True)
 CONFIG_FILE = os.path.join(CONFIG_FOLDER, "config.json")
 
+# Marks a key that should be removed from the configuration
+_DELETED = object()
+
 class PersistentObj(object):
-    def __init__(self, data, parent):
+    def __init__(self, data, parent, key=None):
         self._data = data
         self._parent = parent
+        self._key = key
 
     def __getitem__(self, attr):
         val = self._data.get(attr, dict())
         self._data[attr] = val
         if isinstance(val, dict):
-            return PersistentObj(val, self)
+            return PersistentObj(val, self, attr)
         else:
             return val
 
     def __setitem__(self, attr, value):
-        self._data[attr] = value
-        self._save()
+        self._root()._update(self._path() + [attr], value)
 
     def __delitem__(self, attr):
-        del self._data[attr]
-        self._save()
+        if not attr in self._data:
+            raise KeyError(attr)
+        self._root()._update(self._path() + [attr], _DELETED)
+
+    def get(self, attr, default=None):
+        if not attr in self._data:
+            return default
+        return self[attr]
 
     def __nonzero__(self):
         return bool(self._data)
 
+    def __eq__(self, other):
+        if isinstance(other, PersistentObj):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
     def __iter__(self):
         self._clean()
         for key in self._data:
             yield key
 
     def items(self):
-        self._clean()
-        for k in self:
+        for k in list(self):
             yield k, self[k]
 
     def _clean(self):
@@ -69,13 +142,23 @@ class PersistentObj(object):
             if not v:
                 del self._data[k]
 
-    def _save(self):
-        self._clean()
-        self._parent._save()
+    def _root(self):
+        return self._parent._root()
+
+    def _path(self):
+        return self._parent._path() + [self._key]
 
 class Config(PersistentObj):
+    """
+    The root of the global configuration, stored as JSON in the file
+    `filename`. Reads are served from a copy of the file that is kept in memory
+    and only reloaded when the file changes.
+    """
     def __init__(self, filename=CONFIG_FILE):
         self.filename = filename
+        self._parent = None
+        self._depth = 0
+        self._dirty = False
         folder = os.path.dirname(filename)
         try:
             os.makedirs(folder)
@@ -84,15 +167,121 @@ class Config(PersistentObj):
                 pass
             else:
                 raise
+        self._load()
+
+    def __getitem__(self, attr):
+        self._reload_if_changed()
+        return super(Config, self).__getitem__(attr)
+
+    def get(self, attr, default=None):
+        self._reload_if_changed()
+        return super(Config, self).get(attr, default)
+
+    def __iter__(self):
+        self._reload_if_changed()
+        return super(Config, self).__iter__()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Returns a context manager within which changes to the configuration are
+        only made in memory. They are written to the file together when the
+        outermost transaction ends, or discarded if it raises an exception. The
+        file is locked for the duration of the transaction and reloaded at its
+        start, so that concurrent transactions in other processes are applied
+        one after the other.
+        """
+        outermost = not self._depth
+        lock_file = self._lock() if outermost else None
+        try:
+            if outermost:
+                self._reload_if_changed()
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+            if outermost and self._dirty:
+                self._write()
+        except:
+            if outermost:
+                self._load()
+            raise
+        finally:
+            if outermost:
+                self._dirty = False
+                lock_file.close()
+
+    def _file_state(self, st):
+        # Files are replaced rather than rewritten, so the inode changes too
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load(self):
+        self._state = None
         try:
-            with open(filename) as f:
+            with open(self.filename) as f:
+                self._state = self._file_state(os.fstat(f.fileno()))
                 self._data = json.load(f)
         except (IOError, ValueError):
             self._data = {}
 
-    def _save(self):
-        self._clean()
-        with open(self.filename, "w+") as f:
-            json.dump(self._data, f)
+    def _reload_if_changed(self):
+        if self._depth:
+            return
+        try:
+            state = self._file_state(os.stat(self.filename))
+        except OSError:
+            state = None
+        if state != self._state:
+            self._load()
+
+    def _lock(self):
+        lock_file = open(self.filename + ".lock", "a")
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _write(self):
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_filename, self.filename)
+        except:
+            os.remove(tmp_filename)
+            raise
+        self._state = self._file_state(os.stat(self.filename))
+
+    def _root(self):
+        return self
+
+    def _path(self):
+        return []
+
+    def _update(self, path, value):
+        """
+        Sets the key at `path` (a list of keys leading to it from the root) to
+        `value`, or removes it if `value` is `_DELETED`. Every change is made
+        within a transaction, so a change made outside of one still locks the
+        file and applies to a freshly loaded copy of it instead of overwriting
+        the changes other processes made since it was last read.
+        """
+        with self.transaction():
+            parents = [self._data]
+            for key in path[:-1]:
+                parents.append(parents[-1].setdefault(key, {}))
+            if value is _DELETED:
+                parents[-1].pop(path[-1], None)
+            else:
+                parents[-1][path[-1]] = value
+            for data in reversed(parents):
+                for k, v in data.items():
+                    if not v:
+                        del data[k]
+            self._dirty = True
 
 config = Config()
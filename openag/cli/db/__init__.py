@@ -1,20 +1,21 @@
 import os
-import json
 import time
 import click
 import subprocess
 from os import path
 from shutil import rmtree
 from tempfile import mkdtemp
-from couchdb.http import urljoin
 
-from openag import _design
-from openag.couch import Server, ResourceNotFound
+# couchdb, openag.couch and the models are imported by the commands that use
+# them so that light commands such as `openag db show` start quickly
+from openag import _design, json_codec as json
 from openag.utils import make_dir_name_from_url
-from openag.models import FirmwareModuleType
-from openag.db_names import all_dbs, FIRMWARE_MODULE_TYPE
-from .. import utils
-from ..config import config
+from openag.db_names import (
+    all_dbs, FIRMWARE_MODULE_TYPE, ENVIRONMENTAL_DATA_POINT,
+    ENVIRONMENTAL_DATA_BUCKET
+)
+from .. import utils, timings
+from ..config import config, CONFIG_FOLDER
 from .db_config import generate_config
 
 @click.group()
@@ -24,13 +25,25 @@ def db():
 @db.command()
 @click.option("--db_url", default="http://localhost:5984")
 @click.option("--api_url")
-def init(db_url, api_url):
+@click.option(
+    "--partitioned", is_flag=True,
+    help="Partition environmental data points by environment (requires "
+    "CouchDB 3)"
+)
+@click.option(
+    "--bucket_storage", is_flag=True,
+    help="Create the environmental_data_bucket database for storing high-rate "
+    "series in buckets, and replicate it to the farm"
+)
+def init(db_url, api_url, partitioned, bucket_storage):
     """
     Initialize the database server. Sets some configuration parameters on the
     server, creates the necessary databases for this project, pushes design
     documents into those databases, and sets up replication with the cloud
     server if one has already been selected.
     """
+    from couchdb.http import urljoin
+    from openag.couch import Server, ResourceNotFound
     old_db_url = config["local_server"]["url"]
     if old_db_url and old_db_url != db_url:
         raise click.ClickException(
@@ -46,7 +59,7 @@ def init(db_url, api_url):
     for section, values in db_config.items():
         for param, value in values.items():
             config_items.append((section, param, value))
-    with click.progressbar(
+    with timings.phase("Applying CouchDB configuration"), click.progressbar(
         config_items, label="Applying CouchDB configuration",
         length=len(config_items)
     ) as _config_items:
@@ -74,23 +87,31 @@ def init(db_url, api_url):
                 time.sleep(1)
 
     # Create all dbs on the server
-    with click.progressbar(
-        all_dbs, label="Creating databases", length=len(all_dbs)
+    db_names = set(all_dbs)
+    bucket_storage = bucket_storage or \
+        config["local_server"].get("bucket_storage", False)
+    if bucket_storage:
+        db_names.add(ENVIRONMENTAL_DATA_BUCKET)
+        config["local_server"]["bucket_storage"] = True
+    with timings.phase("Creating databases"), click.progressbar(
+        db_names, label="Creating databases", length=len(db_names)
     ) as _dbs:
         for db_name in _dbs:
-            server.get_or_create(db_name)
+            server.get_or_create(
+                db_name, partitioned and db_name == ENVIRONMENTAL_DATA_POINT
+            )
 
     # Push design documents
     click.echo("Pushing design documents")
     design_path = os.path.dirname(_design.__file__)
-    server.push_design_documents(design_path)
+    with timings.phase("Pushing design documents"):
+        server.push_design_documents(design_path)
 
     # Set up replication
     if config["cloud_server"]["url"]:
         click.echo("Setting up replication with cloud server")
-        utils.replicate_global_dbs(local_url=db_url)
-        if config["cloud_server"]["farm_name"]:
-            utils.replicate_per_farm_dbs(local_url=db_url)
+        with timings.phase("Setting up replication"):
+            utils.replicate_all_dbs(local_url=db_url)
 
     config["local_server"]["url"] = db_url
 
@@ -118,13 +139,14 @@ def clear():
     """
     Clear all data on the local server. Useful for debugging purposed.
     """
+    from openag.couch import Server
     utils.check_for_local_server()
     click.confirm(
         "Are you sure you want to do this? It will delete all of your data",
         abort=True
     )
     server = Server(config["local_server"]["url"])
-    for db_name in all_dbs:
+    for db_name in all_dbs | utils.get_enabled_per_farm_dbs():
         del server[db_name]
 
 @db.command()
@@ -136,6 +158,7 @@ def load_fixture(fixture_file):
     dictionary mapping database names to arrays of objects to store in those
     databases.
     """
+    from openag.couch import Server
     utils.check_for_local_server()
     local_url = config["local_server"]["url"]
     server = Server(local_url)
@@ -154,6 +177,80 @@ def load_fixture(fixture_file):
                         continue
                 db[item_id] = item
 
+    # The set of module types used by the farm may have changed
+    utils.refresh_global_db_replications()
+
+@db.command()
+@click.option(
+    "-p", "--policy", multiple=True, metavar="VARIABLE=DAYS",
+    help="Keep data points for VARIABLE for DAYS days"
+)
+@click.option(
+    "--default_days", type=float,
+    help="Keep data points for other variables for this many days"
+)
+@click.option(
+    "--archive_dir", type=click.Path(file_okay=False),
+    default=os.path.join(CONFIG_FOLDER, "archive"),
+    help="Directory in which to store the expired data points"
+)
+@click.option("--compact/--no_compact", default=True)
+def retention(policy, default_days, archive_dir, compact):
+    """
+    Remove old environmental data points. Data points that are older than the
+    retention policy for their variable are archived to compressed files in
+    ARCHIVE_DIR (which can be restored with `Server.load_snapshot`) and then
+    purged from the database, and the database is compacted to free up the
+    disk space they used. If no policies are given, the ones stored in the
+    configuration are used.
+    """
+    from openag.couch import Server
+    utils.check_for_local_server()
+    policies = {}
+    for item in policy:
+        variable, _, days = item.partition("=")
+        try:
+            policies[variable] = float(days)
+        except ValueError:
+            raise click.ClickException(
+                'Invalid retention policy "{}"'.format(item)
+            )
+    if not policies and default_days is None:
+        stored = config["local_server"].get("retention") or {}
+        policies = dict(stored.get("policies") or {})
+        default_days = stored.get("default_days")
+    if not policies and default_days is None:
+        raise click.ClickException("No retention policies are configured")
+
+    server = Server(config["local_server"]["url"])
+    if not path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    now = time.time()
+    db_names = [ENVIRONMENTAL_DATA_POINT] + \
+        server.list_shards(ENVIRONMENTAL_DATA_POINT)
+    total_reclaimed = 0
+    for db_name in db_names:
+        archive_path = path.join(
+            archive_dir, "{}-{}.json.gz".format(db_name, int(now))
+        )
+        with open(archive_path, "wb") as f:
+            count = server.archive_expired_data_points(
+                policies, f, default=default_days, db_name=db_name, now=now
+            )
+        if not count:
+            os.remove(archive_path)
+            continue
+        click.echo('Archived {} data points from "{}" to "{}"'.format(
+            count, db_name, archive_path
+        ))
+        if compact:
+            click.echo('Compacting "{}"'.format(db_name))
+            total_reclaimed += server.compact(db_name)
+    if compact:
+        click.echo("Reclaimed {:.1f} MB of disk space".format(
+            total_reclaimed / 1e6
+        ))
+
 def update_record(obj, temp_folder):
     if not "repository" in obj:
         return obj
@@ -180,15 +277,19 @@ def update_module_types():
     update them using the `module.json` files from the repositories themselves.
     Currently only works for git repositories.
     """
+    from openag.couch import Server
+    from openag.models import FirmwareModuleType
+    from openag.validators import get_validator
     local_url = config["local_server"]["url"]
     server = Server(local_url)
     db = server[FIRMWARE_MODULE_TYPE]
     temp_folder = mkdtemp()
+    validate = get_validator(FirmwareModuleType)
     for _id in db:
         if _id.startswith("_"):
             continue
         obj = db[_id]
-        new_obj = update_record(FirmwareModuleType(obj), temp_folder)
+        new_obj = update_record(validate(obj), temp_folder)
         new_obj["_rev"] = obj["_rev"]
         if new_obj != obj:
             db[_id] = new_obj
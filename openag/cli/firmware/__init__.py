@@ -1,6 +1,5 @@
 import os
 import sys
-import json
 import yaml
 import click
 import subprocess
@@ -11,11 +10,14 @@ from ConfigParser import ConfigParser
 from base import CodeGen
 from plugins import plugin_map
 from ..config import config
+from .. import timings
 from openag.utils import (
     synthesize_firmware_module_info, make_dir_name_from_url, index_by_id,
     parent_dirname
 )
 from openag.models import FirmwareModuleType, FirmwareModule
+from openag.validators import get_validator, validate_batch
+from openag import json_codec as json
 from openag.db_names import FIRMWARE_MODULE_TYPE, FIRMWARE_MODULE
 from openag.categories import all_categories, default_categories, SENSORS, ACTUATORS
 
@@ -130,14 +132,8 @@ def _run(
     firmware_type_params = params.get(FIRMWARE_MODULE_TYPE, [])
     firmware_params = params.get(FIRMWARE_MODULE, [])
 
-    firmware_types = [
-        FirmwareModuleType(record)
-        for record in firmware_type_params
-    ]
-    firmware = [
-        FirmwareModule(record)
-        for record in firmware_params
-    ]
+    firmware_types = validate_batch(FirmwareModuleType, firmware_type_params)
+    firmware = validate_batch(FirmwareModule, firmware_params)
 
     # Check for working modules in the lib folder
     # Do this second so project-local values overwrite values from the server
@@ -157,7 +153,9 @@ def _run(
                 if not doc.get("_id"):
                     # Patch in id if id isn't present
                     doc["_id"] = parent_dirname(config_path)
-                firmware_types.append(FirmwareModuleType(doc))
+                firmware_types.append(
+                    get_validator(FirmwareModuleType)(doc)
+                )
 
     if len(firmware) == 0:
         click.echo("Warning: no modules specified for the project")
@@ -182,6 +180,30 @@ def _run(
         modules=modules, plugins=plugins,
         status_update_interval=status_update_interval
     )
+    with timings.phase("Fetching dependencies"):
+        _fetch_dependencies(codegen, project_dir)
+    with timings.phase("Generating code"), open(src_file_path, "w+") as f:
+        codegen.write_to(f)
+
+    # Compile the generated code
+    command = ["platformio", "run"]
+    if target:
+        command.append("-t")
+        command.append(target)
+    env = os.environ.copy()
+    build_flags = []
+    for c in categories:
+        build_flags.append("-DOPENAG_CATEGORY_{}".format(c.upper()))
+    env["PLATFORMIO_BUILD_FLAGS"] = " ".join(build_flags)
+    with timings.phase("Compiling"):
+        if subprocess.call(command, cwd=project_dir, env=env):
+            raise click.ClickException("Compilation failed")
+
+def _fetch_dependencies(codegen, project_dir):
+    """
+    Installs the PlatformIO libraries and clones or updates the git
+    repositories that the modules of `codegen` depend on
+    """
     pio_ids = (dep["id"] for dep in codegen.all_pio_dependencies())
     for _id in pio_ids:
         subprocess.call(["platformio", "lib", "install", str(_id)])
@@ -200,21 +222,6 @@ def _run(
             click.echo('Downloading "{}"'.format(dep_folder_name))
             subprocess.call(
                 ["git", "clone", "-b", branch, url, dep_folder], cwd=lib_dir)
-    with open(src_file_path, "w+") as f:
-        codegen.write_to(f)
-
-    # Compile the generated code
-    command = ["platformio", "run"]
-    if target:
-        command.append("-t")
-        command.append(target)
-    env = os.environ.copy()
-    build_flags = []
-    for c in categories:
-        build_flags.append("-DOPENAG_CATEGORY_{}".format(c.upper()))
-    env["PLATFORMIO_BUILD_FLAGS"] = " ".join(build_flags)
-    if subprocess.call(command, cwd=project_dir, env=env):
-        raise click.ClickException("Compilation failed")
 
 @firmware.command()
 @project_dir_option
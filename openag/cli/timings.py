@@ -0,0 +1,52 @@
+"""
+Commands that take a long time mark their main steps as phases with
+:func:`phase`, so that `openag --timings` can report how long each step took.
+"""
+import time
+from contextlib import contextmanager
+
+# Tuples of the nesting depth, name and duration (or None while running) of
+# each phase, in the order in which they started
+_phases = []
+_depth = [0]
+
+@contextmanager
+def phase(name):
+    """ Records the time taken by the body of the `with` block as `name` """
+    index = len(_phases)
+    _phases.append((_depth[0], name, None))
+    _depth[0] += 1
+    start = time.time()
+    try:
+        yield
+    finally:
+        _depth[0] -= 1
+        _phases[index] = (_phases[index][0], name, time.time() - start)
+
+def reset():
+    """ Forgets the recorded phases """
+    del _phases[:]
+    _depth[0] = 0
+
+def get_phases():
+    """
+    Returns a list of tuples of the nesting depth, name and duration of each
+    recorded phase
+    """
+    return list(_phases)
+
+def format_phases(total):
+    """
+    Returns a table of the recorded phases and the share of the `total`
+    number of seconds that each took
+    """
+    lines = ["{:<50} {:>9} {:>6}".format("phase", "time(s)", "share")]
+    for depth, name, duration in _phases:
+        if duration is None:
+            continue
+        lines.append("{:<50} {:>9.3f} {:>5.1f}%".format(
+            "  " * depth + name, duration,
+            100.0 * duration / total if total else 0
+        ))
+    lines.append("{:<50} {:>9.3f}".format("total", total))
+    return "\n".join(lines)
@@ -1,11 +1,25 @@
-from click import ClickException
+import os
+import time
+import random
+import shutil
+import tempfile
+from zlib import crc32
+from click import ClickException, get_current_context
 from urllib import quote
 from urlparse import urlparse, ParseResult
-from couchdb.http import urljoin
 
 from .config import config
-from ..couch import Server
-from ..db_names import global_dbs, per_farm_dbs
+from ..db_names import (
+    global_dbs, per_farm_dbs, is_shard, FIRMWARE_MODULE, FIRMWARE_MODULE_TYPE,
+    SOFTWARE_MODULE, SOFTWARE_MODULE_TYPE, ENVIRONMENTAL_DATA_BUCKET
+)
+
+# Maps each per-farm module database to the global database holding the types
+# of the modules in it
+MODULE_TYPE_DBS = {
+    FIRMWARE_MODULE: FIRMWARE_MODULE_TYPE,
+    SOFTWARE_MODULE: SOFTWARE_MODULE_TYPE
+}
 
 def check_for_local_server():
     """
@@ -49,6 +63,52 @@ def check_for_cloud_farm():
             "to, and `openag cloud farm select` to select a farm"
         )
 
+# Number of seconds before a cached session expires at which to renew it
+SESSION_RENEWAL_MARGIN = 60
+
+def get_cloud_server():
+    """
+    Returns a :class:`~openag.couch.Server` for the cloud server that is logged
+    in as the current user. The session cookie is cached in the global
+    configuration and reused until it is about to expire, at which point a new
+    session is created. A new session is also created if the server rejects
+    the cached cookie. The latest cookie is cached again when the current
+    command ends, since the server may have refreshed it.
+    """
+    from ..couch import Server
+    server = Server(
+        config["cloud_server"]["url"],
+        compress=config["cloud_server"].get("compression", False)
+    )
+    username = config["cloud_server"]["username"]
+    password = config["cloud_server"]["password"]
+    session = config["cloud_server"].get("session")
+    if session and session["username"] == username and \
+            session["expires"] > time.time() + SESSION_RENEWAL_MARGIN:
+        server.use_session(
+            username, session["cookie"], session["expires"], password
+        )
+    else:
+        server.log_in(username, password)
+        cache_cloud_session(server)
+    ctx = get_current_context(silent=True)
+    if ctx is not None:
+        ctx.call_on_close(lambda: cache_cloud_session(server))
+    return server
+
+def cache_cloud_session(server):
+    """
+    Saves the session with which `server` is logged in to the global
+    configuration so that later commands can reuse it
+    """
+    session = {
+        "username": server.username,
+        "cookie": server.session_cookie,
+        "expires": server.session_expires
+    }
+    if config["cloud_server"].get("session") != session:
+        config["cloud_server"]["session"] = session
+
 def replicate_global_dbs(cloud_url=None, local_url=None):
     """
     Set up replication of the global databases from the cloud server to the
@@ -61,23 +121,104 @@ def replicate_global_dbs(cloud_url=None, local_url=None):
     configuration in case the calling function is in the process of
     initializing the local server
     """
+    from ..couch import Server
     local_url = local_url or config["local_server"]["url"]
     cloud_url = cloud_url or config["cloud_server"]["url"]
     server = Server(local_url)
+    server.reconcile_replications(
+        get_global_db_replications(server, cloud_url), managed_ids=global_dbs
+    )
+
+def get_global_db_replications(server, cloud_url):
+    """
+    Returns a dictionary describing the replications that pull the global
+    databases from the cloud server at `cloud_url` into the local server
+    `server`, in the format expected by
+    :meth:`~openag.couch.Server.reconcile_replications`. With selective pull,
+    the update sequences of the module databases the list of pulled module
+    types was derived from are saved as config["cloud_server"]["module_seqs"]
+    so that :func:`refresh_global_db_replications` can tell when it is stale
+    """
+    from couchdb.http import urljoin
+    if config["cloud_server"].get("selective_pull"):
+        # Read these before the modules so that any module written in the
+        # meantime makes the next refresh rebuild the list
+        module_seqs = get_module_db_seqs(server)
+        doc_ids = get_referenced_global_doc_ids(server)
+        config["cloud_server"]["module_seqs"] = module_seqs
+    else:
+        doc_ids = {}
+    res = {}
     for db_name in global_dbs:
-        server.replicate(
-            db_name, urljoin(cloud_url, db_name), db_name, continuous=True,
-        )
+        db_doc_ids = doc_ids.get(db_name)
+        # Nothing in this database is used by the farm, so don't pull it
+        if db_doc_ids == []:
+            continue
+        res[db_name] = {
+            "source": urljoin(cloud_url, db_name),
+            "target": db_name,
+            "continuous": True
+        }
+        if db_doc_ids is not None:
+            res[db_name]["doc_ids"] = db_doc_ids
+    return res
+
+def get_module_db_seqs(server):
+    """
+    Returns a dictionary mapping the names of the module databases on the
+    server `server` to their current update sequences
+    """
+    return {
+        db_name: server[db_name].info()["update_seq"]
+        for db_name in MODULE_TYPE_DBS
+    }
+
+def refresh_global_db_replications():
+    """
+    Rebuild the list of module types that are pulled from the cloud server if
+    the modules on the local server have changed since it was last built.
+    Does nothing unless selective pull is enabled. Returns True if the
+    replications were updated.
+    """
+    from ..couch import Server
+    if not config["cloud_server"]["url"] or \
+            not config["local_server"]["url"] or \
+            not config["cloud_server"].get("selective_pull"):
+        return False
+    server = Server(config["local_server"]["url"])
+    if get_module_db_seqs(server) == config["cloud_server"].get("module_seqs"):
+        return False
+    replicate_global_dbs()
+    return True
+
+def get_referenced_global_doc_ids(server):
+    """
+    Returns a dictionary mapping the names of global databases to lists of the
+    IDs of the documents in them that are referenced by the firmware modules
+    and software modules on the server `server`. Global databases whose
+    documents aren't referenced by modules (e.g. recipes) are left out of the
+    dictionary.
+    """
+    res = {}
+    for db_name, type_db_name in MODULE_TYPE_DBS.items():
+        type_ids = set()
+        for row in server[db_name].view("_all_docs", include_docs=True):
+            if row.id.startswith("_"):
+                continue
+            if row.doc.get("type"):
+                type_ids.add(row.doc["type"])
+        res[type_db_name] = sorted(type_ids)
+    return res
 
 def cancel_global_db_replication():
     """
     Cancel replication of the global databases from the cloud server to the
     local server.
     """
+    from ..couch import Server
     local_url = config["local_server"]["url"]
     server = Server(local_url)
-    for db_name in global_dbs:
-        server.cancel_replication(db_name)
+    server.reconcile_replications({}, managed_ids=global_dbs)
 
 def replicate_per_farm_dbs(cloud_url=None, local_url=None, farm_name=None):
     """
@@ -94,14 +235,60 @@ def replicate_per_farm_dbs(cloud_url=None, local_url=None, farm_name=None):
     configuratino in case the calling function is in the process of
     initializing the farm
     """
-    cloud_url = cloud_url or config["cloud_server"]["url"]
+    from ..couch import Server
     local_url = local_url or config["local_server"]["url"]
+    server = Server(local_url)
+    db_names = get_per_farm_db_names(server)
+    # Scheduled pushes replace the continuous replications
+    if config["cloud_server"].get("push_interval"):
+        desired = {}
+    else:
+        desired = get_per_farm_db_replications(cloud_url, farm_name, db_names)
+    server.reconcile_replications(desired, managed_ids=db_names)
+
+def get_enabled_per_farm_dbs():
+    """
+    Returns the set of names of the per-farm databases that are in use,
+    including the optional ones that are turned on in the global configuration
+    """
+    res = set(per_farm_dbs)
+    if config["local_server"].get("bucket_storage"):
+        res.add(ENVIRONMENTAL_DATA_BUCKET)
+    return res
+
+def get_per_farm_db_names(server):
+    """
+    Returns the set of names of the per-farm databases in use on the server
+    `server` (see :func:`get_enabled_per_farm_dbs`), including the monthly
+    shards of per-farm databases that are written in sharded mode (see
+    :meth:`~openag.couch.Server.write_data_points`)
+    """
+    db_names = get_enabled_per_farm_dbs()
+    res = set(db_names)
+    for name in server:
+        if any(is_shard(name, db_name) for db_name in db_names):
+            res.add(name)
+    return res
+
+def get_per_farm_db_replications(
+    cloud_url=None, farm_name=None, db_names=None
+):
+    """
+    Returns a dictionary describing the replications that push the per-farm
+    databases (or the databases `db_names`, e.g. as returned by
+    :func:`get_per_farm_db_names`) from the local server to the farm
+    `farm_name` on the cloud server at `cloud_url`, in the format expected by
+    :meth:`~openag.couch.Server.reconcile_replications`
+    """
+    from couchdb.http import urljoin
+    cloud_url = cloud_url or config["cloud_server"]["url"]
     farm_name = farm_name or config["cloud_server"]["farm_name"]
     username = config["cloud_server"]["username"]
     password = config["cloud_server"]["password"]
 
     # Add credentials to the cloud url
     parsed_cloud_url = urlparse(cloud_url)
+    new_netloc = parsed_cloud_url.netloc
     if not parsed_cloud_url.username:
         new_netloc = "{}:{}@{}".format(
             username, password, parsed_cloud_url.netloc
@@ -112,21 +299,152 @@ def replicate_per_farm_dbs(cloud_url=None, local_url=None, farm_name=None):
         parsed_cloud_url.fragment
     ).geturl()
 
-    server = Server(local_url)
-    for db_name in per_farm_dbs:
+    seed_seqs = config["cloud_server"].get("seed_seqs") or {}
+    res = {}
+    for db_name in db_names or get_enabled_per_farm_dbs():
         remote_db_name = "{}/{}/{}".format(username, farm_name, db_name)
-        server.replicate(
-            db_name, db_name, urljoin(cloud_url, remote_db_name),
-            continuous=True
-        )
+        res[db_name] = {
+            "source": db_name,
+            "target": urljoin(cloud_url, remote_db_name),
+            "continuous": True
+        }
+        # Only the main per-farm databases are created when the farm is
+        # registered, so the replications create the shards and the optional
+        # databases
+        if not db_name in per_farm_dbs:
+            res[db_name]["create_target"] = True
+        # Don't replicate what was already uploaded by `seed_per_farm_dbs`
+        if seed_seqs.get(db_name) is not None:
+            res[db_name]["since_seq"] = seed_seqs[db_name]
+    return res
+
+def seed_per_farm_dbs(farm_name=None, snapshot_dir=None):
+    """
+    Upload the current contents of the per-farm databases on the local server
+    to the cloud server as compressed snapshots. This is much faster than
+    replicating a large history document by document. Replications of the
+    per-farm databases set up afterwards start from the end of the snapshots.
+
+    :param str farm_name: Used to override the farm name from the global
+    configuration in case the calling function is in the process of
+    initializing the farm
+    :param str snapshot_dir: Directory in which to keep the snapshot files. If
+    not given, the snapshots are written to a temporary directory that is
+    removed afterwards
+    """
+    from ..couch import Server
+    farm_name = farm_name or config["cloud_server"]["farm_name"]
+    username = config["cloud_server"]["username"]
+    local_server = Server(config["local_server"]["url"])
+    cloud_server = get_cloud_server()
+    tmp_dir = None
+    if not snapshot_dir:
+        snapshot_dir = tmp_dir = tempfile.mkdtemp()
+    seed_seqs = {}
+    try:
+        for db_name in get_per_farm_db_names(local_server):
+            snapshot_path = os.path.join(snapshot_dir, db_name + ".json.gz")
+            with open(snapshot_path, "wb") as f:
+                local_server.dump_snapshot(db_name, f)
+            remote_db_name = "{}/{}/{}".format(username, farm_name, db_name)
+            with open(snapshot_path, "rb") as f:
+                seed_seqs[db_name] = cloud_server.load_snapshot(
+                    remote_db_name, f
+                )
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    config["cloud_server"]["seed_seqs"] = seed_seqs
+    return seed_seqs
 
 def cancel_per_farm_db_replication():
     """
     Cancel replication of the per-farm databases from the local server to the
     cloud server.
     """
-    cloud_url = config["cloud_server"]["url"]
+    from ..couch import Server
     local_url = config["local_server"]["url"]
     server = Server(local_url)
-    for db_name in per_farm_dbs:
-        server.cancel_replication(db_name)
+    server.reconcile_replications(
+        {}, managed_ids=get_per_farm_db_names(server)
+    )
+
+def replicate_all_dbs(local_url=None):
+    """
+    Set up replication of the global databases and, if a farm is selected, the
+    per-farm databases with the cloud server in a single step.
+
+    :param str local_url: Used to override the local url from the global
+    configuration in case the calling function is in the process of
+    initializing the local server
+    """
+    from ..couch import Server
+    local_url = local_url or config["local_server"]["url"]
+    cloud_url = config["cloud_server"]["url"]
+    server = Server(local_url)
+    desired = get_global_db_replications(server, cloud_url)
+    farm_db_names = get_per_farm_db_names(server)
+    if config["cloud_server"]["farm_name"] and \
+            not config["cloud_server"].get("push_interval"):
+        desired.update(get_per_farm_db_replications(db_names=farm_db_names))
+    server.reconcile_replications(
+        desired, managed_ids=global_dbs | farm_db_names
+    )
+
+def push_per_farm_dbs(local_url=None):
+    """
+    Push the per-farm databases from the local server to the cloud server with
+    one-shot replications. This is used instead of continuous replication when
+    pushes are scheduled (i.e. config["cloud_server"]["push_interval"] is
+    set). Returns a dictionary describing the throughput of the push, which is
+    also saved as config["cloud_server"]["last_push"].
+
+    :param str local_url: Used to override the local url from the global
+    configuration
+    """
+    from ..couch import Server, REPLICATION_FIELDS
+    local_url = local_url or config["local_server"]["url"]
+    server = Server(local_url)
+    start_time = time.time()
+    docs_read = 0
+    docs_written = 0
+    db_names = get_per_farm_db_names(server)
+    for spec in get_per_farm_db_replications(db_names=db_names).values():
+        # Keep the other settings, such as the "since_seq" at which seeded
+        # databases start, but make the replication a one-shot one
+        options = {
+            k: v for k, v in spec.items() if k in REPLICATION_FIELDS and
+            not k in ("source", "target", "continuous")
+        }
+        res = server.replicate_once(
+            spec["source"], spec["target"], **options
+        )
+        for session in res.get("history", [])[:1]:
+            docs_read += session.get("docs_read", 0)
+            docs_written += session.get("docs_written", 0)
+    duration = time.time() - start_time
+    stats = {
+        "timestamp": start_time,
+        "duration": duration,
+        "docs_read": docs_read,
+        "docs_written": docs_written,
+        "docs_per_second": docs_written / duration if duration else 0
+    }
+    config["cloud_server"]["last_push"] = stats
+    return stats
+
+def get_next_push_delay(interval, jitter=0, now=None):
+    """
+    Returns the number of seconds to wait before the next scheduled push.
+    Pushes happen every `interval` minutes, offset within the interval by an
+    amount derived from the farm name so that pushes from different farms are
+    staggered, plus up to `jitter` random seconds.
+    """
+    now = time.time() if now is None else now
+    period = interval * 60
+    farm_id = u"{}/{}".format(
+        config["cloud_server"]["username"], config["cloud_server"]["farm_name"]
+    )
+    offset = (crc32(farm_id.encode("utf-8")) & 0xffffffff) % period
+    next_push = ((now - offset) // period + 1) * period + offset
+    return next_push - now + random.uniform(0, jitter)
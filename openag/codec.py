@@ -0,0 +1,226 @@
+"""
+This module consists of code for compactly encoding series of
+:class:`~openag.models.EnvironmentalDataPoint` values. Timestamps are stored as
+deltas of deltas and values as the XOR of the bits of each value with those of
+the previous one, which are both mostly zero for slowly changing sensor
+readings. The results are compressed and base64 encoded so that they can be
+stored in JSON documents.
+
+All of the work is done on whole series at once: the numbers are packed into
+buffers of 8-byte lanes with :mod:`struct`, the bytes of the lanes are
+regrouped so that the (mostly zero or constant) high bytes of every number are
+next to each other, and the buffer is compressed with :mod:`zlib`. Only the
+running sums and XORs needed to decode a series are computed number by number.
+Series encoded by older versions of this module, which stored each number as a
+variable-length sequence of bytes, can still be decoded.
+"""
+import zlib
+import struct
+import operator
+from itertools import izip, repeat
+from base64 import b64encode, b64decode
+
+__all__ = [
+    "DOD_XOR", "encode_series", "decode_series", "encode_timestamps",
+    "decode_timestamps", "encode_values", "decode_values", "round_timestamp"
+]
+
+# Name of the encoding implemented by this module
+DOD_XOR = "dod-xor"
+
+# Version of the layout of the encoded series written by this module. Series
+# without a version were written with version 1, which is still decoded.
+VERSION = 2
+
+# Timestamps are stored as integer numbers of milliseconds
+TIMESTAMP_RESOLUTION = 1000
+
+# Fastest zlib compression level. Higher levels only save a few percent on
+# noisy values but take several times as long.
+COMPRESSION_LEVEL = 1
+
+# Types of the values in a series, stored in the first byte of the encoded
+# values
+FLOAT_VALUES = 0
+INTEGER_VALUES = 1
+MIXED_VALUES = 2
+
+def encode_series(timestamps, values):
+    """
+    Encodes the lists `timestamps` and `values` (which must all be numbers)
+    and returns a dictionary that can be stored in a JSON document and decoded
+    with :func:`decode_series`. Timestamps are rounded to the nearest
+    millisecond.
+    """
+    return {
+        "encoding": DOD_XOR,
+        "version": VERSION,
+        "timestamps": encode_timestamps(timestamps),
+        "values": encode_values(values)
+    }
+
+def decode_series(series):
+    """
+    Decodes a dictionary returned by :func:`encode_series` and returns a tuple
+    of the lists of timestamps and values
+    """
+    if series.get("encoding") != DOD_XOR:
+        raise ValueError(
+            'Unsupported encoding "{}"'.format(series.get("encoding"))
+        )
+    version = series.get("version", 1)
+    if version == 1:
+        return (
+            _decode_timestamps_v1(series["timestamps"]),
+            _decode_values_v1(series["values"])
+        )
+    if version != VERSION:
+        raise ValueError(
+            'Unsupported version {} of encoding "{}"'.format(version, DOD_XOR)
+        )
+    return (
+        decode_timestamps(series["timestamps"]),
+        decode_values(series["values"])
+    )
+
+def round_timestamp(timestamp):
+    """
+    Rounds `timestamp` to the resolution with which timestamps are encoded,
+    i.e. returns the value it will have after being encoded and decoded
+    """
+    return float(int(round(timestamp * TIMESTAMP_RESOLUTION))) / \
+        TIMESTAMP_RESOLUTION
+
+def encode_timestamps(timestamps):
+    """
+    Encodes the list of UNIX timestamps `timestamps` as a base64 string of
+    compressed deltas of deltas
+    """
+    n = len(timestamps)
+    ints = map(int, map(round, map(
+        operator.mul, timestamps, repeat(TIMESTAMP_RESOLUTION, n)
+    )))
+    deltas = map(operator.sub, ints, [0] + ints[:-1]) if n else []
+    dods = map(operator.sub, deltas, [0] + deltas[:-1]) if n else []
+    return b64encode(zlib.compress(
+        _shuffle(struct.pack("<%dq" % n, *dods)), COMPRESSION_LEVEL
+    ))
+
+def decode_timestamps(data):
+    """ Decodes a string returned by :func:`encode_timestamps` """
+    buf = _unshuffle(zlib.decompress(b64decode(data)))
+    res = []
+    append = res.append
+    delta = 0
+    timestamp = 0
+    for dod in struct.unpack("<%dq" % (len(buf) // 8), buf):
+        delta += dod
+        timestamp += delta
+        append(timestamp)
+    return map(
+        operator.truediv, res, repeat(float(TIMESTAMP_RESOLUTION), len(res))
+    )
+
+def encode_values(values):
+    """
+    Encodes the list of numbers `values` as a base64 string of the compressed
+    XORs of the bits of each value with those of the previous one. Integers
+    are decoded as integers as long as they fit in 64 bits.
+    """
+    n = len(values)
+    is_int = map(isinstance, values, repeat((int, long), n))
+    mask = b""
+    if n and all(is_int) and -2**63 <= min(values) and max(values) < 2**63:
+        kind = INTEGER_VALUES
+        bits = struct.unpack("<%dQ" % n, struct.pack("<%dq" % n, *values))
+    else:
+        kind = MIXED_VALUES if any(is_int) else FLOAT_VALUES
+        if kind == MIXED_VALUES:
+            mask = bytes(bytearray(is_int))
+        bits = struct.unpack("<%dQ" % n, struct.pack("<%dd" % n, *values))
+    xors = map(operator.xor, bits, (0,) + bits[:-1]) if n else []
+    return b64encode(zlib.compress(
+        chr(kind) + _shuffle(struct.pack("<%dQ" % n, *xors)) + mask,
+        COMPRESSION_LEVEL
+    ))
+
+def decode_values(data):
+    """ Decodes a string returned by :func:`encode_values` """
+    buf = zlib.decompress(b64decode(data))
+    kind = ord(buf[0])
+    width = 9 if kind == MIXED_VALUES else 8
+    n = (len(buf) - 1) // width
+    bits = []
+    append = bits.append
+    prev = 0
+    for xor in struct.unpack("<%dQ" % n, _unshuffle(buf[1:8 * n + 1])):
+        prev ^= xor
+        append(prev)
+    fmt = "<%dq" if kind == INTEGER_VALUES else "<%dd"
+    values = list(struct.unpack(fmt % n, struct.pack("<%dQ" % n, *bits)))
+    if kind == MIXED_VALUES:
+        values = [
+            int(value) if is_int != "\0" else value
+            for value, is_int in izip(values, buf[8 * n + 1:])
+        ]
+    return values
+
+def _shuffle(buf, width=8):
+    # Groups the first bytes of all of the `width`-byte lanes in `buf`
+    # together, then the second bytes and so on
+    return b"".join(buf[i::width] for i in range(width))
+
+def _unshuffle(buf, width=8):
+    # Reverses _shuffle
+    n = len(buf) // width
+    res = bytearray(len(buf))
+    for i in range(width):
+        res[i::width] = buf[i * n:(i + 1) * n]
+    return bytes(res)
+
+def _decode_timestamps_v1(data):
+    # Timestamps were stored as variable-length deltas of deltas
+    res = []
+    delta = 0
+    timestamp = 0
+    for dod in _read_varints(bytearray(b64decode(data))):
+        delta += _unzigzag(dod)
+        timestamp += delta
+        res.append(timestamp)
+    return [float(t) / TIMESTAMP_RESOLUTION for t in res]
+
+def _decode_values_v1(data):
+    # Each XOR was stored as the bytes between its leading and trailing zero
+    # bytes, preceded by a byte giving the number of stored bytes and trailing
+    # zero bytes
+    data = bytearray(b64decode(data))
+    bits = []
+    prev = 0
+    i = 0
+    while i < len(data):
+        header = data[i]
+        i += 1
+        length = header >> 4
+        xor = 0
+        for byte in data[i:i + length]:
+            xor = xor << 8 | byte
+        i += length
+        prev ^= xor << 8 * (header & 0xf)
+        bits.append(prev)
+    n = len(bits)
+    return list(struct.unpack("<%dd" % n, struct.pack("<%dQ" % n, *bits)))
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+def _read_varints(data):
+    n = 0
+    shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield n
+            n = 0
+            shift = 0
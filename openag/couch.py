@@ -2,54 +2,1033 @@
 This module consists of code for interacting with a CouchDB server instance.
 """
 import os
-import json
+import gzip
+import time
 import requests
+import threading
 from urllib import quote
 from couchdb import Server as _Server
-from couchdb.http import ResourceNotFound
+from couchdb.client import DEFAULT_BASE_URL
+from couchdb import http
+from couchdb.http import ResourceNotFound, CHUNK_SIZE
 from urlparse import urljoin
 
+from . import _design, _partitioned_design, json_codec
+from .session import Session, session_cookie
+from .codec import DOD_XOR, encode_series, decode_series, round_timestamp
+from .models import EnvironmentalDataPoint, EnvironmentalDataBucket
+from .validators import get_validator
+from .var_types import VariableDictionary, VARIABLE_DICTIONARY
+from .db_names import (
+    ENVIRONMENTAL_DATA_POINT, ENVIRONMENTAL_DATA_BUCKET, optional_per_farm_dbs,
+    shard_db_name, shard_db_names, is_shard
+)
+
+# ID of the design documents holding the partition-scoped views of
+# partitioned databases
+PARTITIONED_DESIGN_DOC = "_design/partitioned"
+
+# ID of the design documents holding the Mango indexes declared in the
+# "indexes" folders of the design document folders
+INDEX_DESIGN_DOC = "_design/indexes"
+
+# ID of the design documents holding the variable dictionary (see
+# :class:`~openag.var_types.VariableDictionary`) and the names of the databases
+# that get one
+VARIABLE_DICTIONARY_DOC = "_design/variable_dictionary"
+VARIABLE_DICTIONARY_DBS = (ENVIRONMENTAL_DATA_POINT, ENVIRONMENTAL_DATA_BUCKET)
+
+# Fields of a "_replicator" document that define the replication itself (as
+# opposed to the fields the replicator writes to report its state)
+REPLICATION_FIELDS = (
+    "source", "target", "continuous", "doc_ids", "since_seq", "create_target"
+)
+
+def data_point_id(point, partitioned=False):
+    """
+    Returns a deterministic ID for the
+    :class:`~openag.models.EnvironmentalDataPoint` `point`. IDs start with the
+    zero-padded timestamp of the point, so new points are appended to the end
+    of the database's ID index, and writing the same point twice produces a
+    conflict instead of a duplicate. If `partitioned` is true, the ID is
+    prefixed with "<environment>:" so that the point is stored in the
+    partition of its environment in a partitioned database.
+    """
+    _id = _time_ordered_id(
+        point["timestamp"], point["environment"], point["is_desired"],
+        point["variable"]
+    )
+    if partitioned:
+        _id = "{}:{}".format(point["environment"], _id)
+    return _id
+
+def bucket_id(point, bucket_size):
+    """
+    Returns the ID of the :class:`~openag.models.EnvironmentalDataBucket` of
+    `bucket_size` seconds that holds the environmental data point `point`. The
+    IDs have the same format as the ones returned by :func:`data_point_id`.
+    """
+    start = bucket_start(point["timestamp"], bucket_size)
+    return _time_ordered_id(
+        start, point["environment"], point["is_desired"], point["variable"]
+    )
+
+def bucket_start(timestamp, bucket_size):
+    """
+    Returns the start of the bucket of `bucket_size` seconds that holds points
+    with the timestamp `timestamp`
+    """
+    return timestamp // bucket_size * bucket_size
+
+def _bucket_series(bucket):
+    """
+    Returns a tuple of the lists of timestamps and values in the
+    :class:`~openag.models.EnvironmentalDataBucket` `bucket`
+    """
+    if bucket.get("encoding"):
+        return decode_series(bucket)
+    return bucket["timestamps"], bucket["values"]
+
+def _file_size(info):
+    # CouchDB 2 reports the sizes of databases and view indexes in "sizes",
+    # earlier versions in "disk_size"
+    if "sizes" in info:
+        return info["sizes"]["file"]
+    return info["disk_size"]
+
+def _time_ordered_id(timestamp, environment, is_desired, variable):
+    return "{:017.6f}-{}-{}-{}".format(
+        timestamp, environment, "desired" if is_desired else "measured",
+        variable
+    )
+
+def _iter_chunks(body, chunk_size=CHUNK_SIZE):
+    """
+    Yields the response body `body` (a string or a file-like object) in
+    chunks of at most `chunk_size` bytes
+    """
+    if isinstance(body, basestring):
+        yield body
+        return
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def shard_target(target, db_name, shard_name):
+    """
+    Given the replication target `target` of the database `db_name`, returns
+    the corresponding target for its shard `shard_name`
+    """
+    quoted_db_name = quote(db_name, "")
+    if target.endswith(quoted_db_name):
+        return target[:-len(quoted_db_name)] + quote(shard_name, "")
+    return target + "_" + shard_name[len(db_name)+1:]
+
+class Resource(http.Resource):
+    """
+    A :class:`couchdb.http.Resource` that decodes JSON responses with the
+    library selected in :mod:`openag.json_codec`. Resources created from it
+    (and so the databases of a :class:`Server`) are of this class too.
+    """
+    def _request_json(
+        self, method, path=None, body=None, headers=None, **params
+    ):
+        status, headers, data = self._request(
+            method, path, body=body, headers=headers, **params
+        )
+        if "application/json" in headers.get("content-type", ""):
+            data = json_codec.loads(data.read())
+        return status, headers, data
+
 class Server(_Server):
     """
     Class that represents a single CouchDB server instance and provides
     functions for interfacing with that server
+
+    If `cache` (a :class:`~openag.session.MemoryCache` or
+    :class:`~openag.session.DiskCache`) is given and `session` isn't, responses
+    are cached in it and revalidated with their ETags. If `compress` is true
+    and `session` isn't given, responses and large request bodies are
+    gzipped. Requests can be measured with :meth:`add_request_hook`.
+
+    A single instance can be shared by several threads, which then share its
+    pool of connections and its cache. Threads that should authenticate as
+    different users can get their own instances from :meth:`with_session` or
+    :meth:`with_credentials`, which still share the connections.
     """
-    def get_or_create(self, db_name):
+    def __init__(
+        self, url=DEFAULT_BASE_URL, full_commit=True, session=None, cache=None,
+        compress=False
+    ):
+        if isinstance(url, basestring):
+            if session is None:
+                session = Session(cache=cache, compress=compress)
+            url = Resource(url, session)
+        super(Server, self).__init__(url, full_commit, session)
+        self._known_shards = set()
+        self._shard_lock = threading.Lock()
+
+    def add_request_hook(self, hook):
+        """
+        Registers the callable `hook` (such as an
+        :class:`~openag.instrumentation.RequestStats`) to be called with an
+        :class:`~openag.instrumentation.RequestRecord` describing every
+        request made through this server's session, including requests made
+        by servers returned by :meth:`with_session` and
+        :meth:`with_credentials`
+        """
+        session = self.resource.session
+        if not isinstance(session, Session):
+            raise RuntimeError(
+                "Request hooks require an openag.session.Session"
+            )
+        session.add_request_hook(hook)
+
+    def remove_request_hook(self, hook):
+        """ Unregisters a hook registered with :meth:`add_request_hook` """
+        self.resource.session.remove_request_hook(hook)
+
+    def with_session(self, username, cookie, expires):
+        """
+        Returns a new :class:`Server` that uses the same connections as this
+        one but authenticates with the session cookie `cookie` of the user
+        `username` (as in :meth:`use_session`). This server is not changed.
+        """
+        server = self._copy()
+        server.use_session(username, cookie, expires)
+        return server
+
+    def with_credentials(self, username, password):
+        """
+        Returns a new :class:`Server` that uses the same connections as this
+        one but sends the credentials `username` and `password` with every
+        request. This server is not changed.
+        """
+        server = self._copy()
+        server.resource.credentials = (username, password)
+        server.resource.headers.pop("Cookie", None)
+        return server
+
+    def _copy(self):
+        server = type(self)(self.resource())
+        server._known_shards = self._known_shards
+        server._shard_lock = self._shard_lock
+        return server
+
+    def get_or_create(self, db_name, partitioned=False):
         """
         Creates the database named `db_name` if it doesn't already exist and
-        return it
+        return it. If `partitioned` is true, the database is created as a
+        partitioned database (which requires CouchDB 3).
         """
         if not db_name in self:
-            res = self.resource.put(db_name)
+            if partitioned:
+                res = self.resource.put(db_name, partitioned=True)
+            else:
+                res = self.resource.put(db_name)
             if not res[0] == 201:
                 raise RuntimeError(
                     'Failed to create database "{}"'.format(db_name)
                 )
         return self[db_name]
 
-    def replicate(self, doc_id, source, target, continuous=False):
+    def is_partitioned(self, db_name):
+        """
+        Returns whether the database `db_name` is a partitioned database
+        """
+        status, _, body = self.resource(db_name).get_json()
+        if status != 200:
+            raise RuntimeError(
+                'Failed to read information about "{}"'.format(db_name)
+            )
+        return bool(body.get("props", {}).get("partitioned"))
+
+    def replicate(
+        self, doc_id, source, target, continuous=False, doc_ids=None
+    ):
         """
         Starts a replication from the `source` database to the `target`
         database by writing a document with the id `doc_id` to the "_relicator"
-        database
+        database. If `doc_ids` is given, only the documents with those IDs are
+        replicated. If a replication with the same ID but different settings
+        already exists, it is replaced.
         """
-        if doc_id in self["_replicator"]:
-            return
-        data = {
-            "_id": doc_id,
+        spec = {
             "source": source,
             "target": target,
             "continuous": continuous
         }
-        self["_replicator"][doc_id] = data
+        if doc_ids is not None:
+            spec["doc_ids"] = doc_ids
+        self.reconcile_replications({doc_id: spec})
+
+    def replicate_once(self, source, target, **options):
+        """
+        Runs a single, non-continuous replication from the `source` database to
+        the `target` database and waits for it to finish. Any extra `options`
+        are passed on to CouchDB. Returns the response from the server, which
+        describes what was replicated.
+        """
+        data = dict(options, source=source, target=target)
+        status, _, body = self.resource.post_json("_replicate", body=data)
+        if status != 200 or not body.get("ok"):
+            raise RuntimeError(
+                'Failed to replicate "{}" to "{}"'.format(source, target)
+            )
+        return body
 
     def cancel_replication(self, doc_id):
         """
         Cancels the replication with the id `doc_id`
         """
-        if doc_id not in self["_replicator"]:
+        self.reconcile_replications({}, managed_ids=[doc_id])
+
+    def reconcile_replications(self, desired, managed_ids=()):
+        """
+        Makes the "_replicator" database match `desired`, a dictionary mapping
+        replication document IDs to dictionaries of replication settings (the
+        fields in `REPLICATION_FIELDS`). Replications whose IDs are in
+        `managed_ids` but not in `desired` are cancelled. Only the documents
+        with those IDs are read from the "_replicator" database, in a single
+        request, and all changes are written in a single bulk request. Returns
+        a dictionary mapping "added", "updated" and "removed" to lists of
+        replication document IDs.
+        """
+        res = {"added": [], "updated": [], "removed": []}
+        doc_ids = sorted(set(desired) | set(managed_ids))
+        if not doc_ids:
+            return res
+        replicator = self.resource("_replicator")
+        status, _, body = replicator.post_json(
+            "_all_docs", body={"keys": doc_ids}, include_docs=True
+        )
+        if status != 200:
+            raise RuntimeError("Failed to read the replicator database")
+        # Documents that don't exist (or were deleted) have no "doc"
+        existing = {
+            row["id"]: row["doc"] for row in body["rows"] if row.get("doc")
+        }
+        docs = []
+        for doc_id, spec in desired.items():
+            data = {
+                k: v for k, v in spec.items() if k in REPLICATION_FIELDS
+            }
+            if data.get("doc_ids") is not None:
+                data["doc_ids"] = sorted(data["doc_ids"])
+            data["_id"] = doc_id
+            old_doc = existing.get(doc_id)
+            if old_doc is None:
+                res["added"].append(doc_id)
+            else:
+                old_data = {
+                    k: old_doc[k] for k in REPLICATION_FIELDS if k in old_doc
+                }
+                old_data["_id"] = doc_id
+                if old_data == data:
+                    continue
+                data["_rev"] = old_doc["_rev"]
+                res["updated"].append(doc_id)
+            docs.append(data)
+        for doc_id in managed_ids:
+            if doc_id in existing and doc_id not in desired:
+                res["removed"].append(doc_id)
+                docs.append({
+                    "_id": doc_id, "_rev": existing[doc_id]["_rev"],
+                    "_deleted": True
+                })
+        if not docs:
+            return res
+        results = self._bulk_docs(replicator, docs)
+        # Older versions of CouchDB forbid editing a replication document
+        # while the replication is running, so replace those documents instead
+        forbidden = {
+            r["id"] for r in results if r.get("error") == "forbidden"
+        }
+        retry_docs = [
+            doc for doc in docs if doc["_id"] in forbidden and
+            "_rev" in doc and not doc.get("_deleted")
+        ]
+        if retry_docs:
+            self._bulk_docs(replicator, [
+                {"_id": doc["_id"], "_rev": doc["_rev"], "_deleted": True}
+                for doc in retry_docs
+            ])
+            for doc in retry_docs:
+                del doc["_rev"]
+            results = [
+                r for r in results if r["id"] not in forbidden
+            ] + self._bulk_docs(replicator, retry_docs)
+        self._check_bulk_results(results)
+        return res
+
+    def write_data_points(
+        self, points, db_name=ENVIRONMENTAL_DATA_POINT, batch_size=1000,
+        point_filter=None, sharded=False, partitioned=False
+    ):
+        """
+        Validates the environmental data points `points` and writes them to the
+        database `db_name` in batches of `batch_size` points. Each point gets
+        an ID from :func:`data_point_id`, so retrying a write after a failure
+        doesn't create duplicates. If a `point_filter` (such as an
+        :class:`~openag.ingest.IngestFilter`) is given, only the points it
+        yields are written. If `sharded` is true, each point is written to the
+        monthly shard of `db_name` that covers its timestamp instead (see
+        :meth:`get_or_create_shard`). If `partitioned` is true, `db_name` must
+        be a partitioned database, and each point is stored in the partition
+        of its environment. Returns the number of points that were written
+        (i.e. that weren't already in the database).
+        """
+        count = 0
+        batches = {}
+        def flush(target, docs):
+            if sharded:
+                self.get_or_create_shard(target, db_name, partitioned)
+            results = self._bulk_docs(self.resource(target), docs)
+            # Conflicts mean that the point has already been written
+            self._check_bulk_results([
+                r for r in results if r.get("error") != "conflict"
+            ])
+            return len([r for r in results if "error" not in r])
+        validate = get_validator(EnvironmentalDataPoint)
+        points = (validate(point) for point in points)
+        if point_filter:
+            points = point_filter(points)
+        for doc in points:
+            doc["_id"] = data_point_id(doc, partitioned)
+            if sharded:
+                target = shard_db_name(db_name, doc["timestamp"])
+            else:
+                target = db_name
+            docs = batches.setdefault(target, [])
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                count += flush(target, docs)
+                batches[target] = []
+        for target, docs in batches.items():
+            if docs:
+                count += flush(target, docs)
+        return count
+
+    def read_data_points(
+        self, environment, start, end, variable=None, is_desired=False,
+        db_name=ENVIRONMENTAL_DATA_POINT, sharded=False, partitioned=False
+    ):
+        """
+        Yields the environmental data points for the environment `environment`
+        with timestamps between `start` and `end` from the database `db_name`
+        (or its monthly shards if `sharded` is true), in order of their
+        timestamps. If `variable` is given, only the measured (or desired, if
+        `is_desired` is true) points for that variable are returned. If
+        `partitioned` is true, the partition-scoped views of the partition of
+        `environment` are queried, so the data of other environments isn't
+        touched.
+        """
+        view, startkey, endkey = self._data_point_range(
+            environment, start, end, variable, is_desired, partitioned
+        )
+        for target in self._data_point_dbs(db_name, start, end, sharded):
+            rows = self._query_data_point_view(
+                target, environment, view, partitioned, reduce=False,
+                startkey=json_codec.dumps(startkey),
+                endkey=json_codec.dumps(endkey)
+            )
+            for row in rows:
+                yield row["value"]
+
+    def read_latest_data_point(
+        self, environment, variable, is_desired=False,
+        db_name=ENVIRONMENTAL_DATA_POINT, sharded=False, partitioned=False
+    ):
+        """
+        Returns the most recent measured (or desired, if `is_desired` is true)
+        environmental data point for the variable `variable` in the environment
+        `environment`, or None if there is none. `sharded` and `partitioned`
+        are as in :meth:`read_data_points`.
+        """
+        view, startkey, endkey = self._data_point_range(
+            environment, None, None, variable, is_desired, partitioned
+        )
+        if sharded:
+            targets = reversed(self.list_shards(db_name))
+        else:
+            targets = [db_name]
+        for target in targets:
+            # Read the view backwards to get the latest point first
+            rows = self._query_data_point_view(
+                target, environment, view, partitioned, reduce=False,
+                descending=True, limit=1, startkey=json_codec.dumps(endkey),
+                endkey=json_codec.dumps(startkey)
+            )
+            for row in rows:
+                return row["value"]
+        return None
+
+    def _query_data_point_view(
+        self, db_name, environment, view, partitioned, **params
+    ):
+        """
+        Yields the rows of the view `view` of the design document for
+        environmental data points in `db_name`. If `partitioned` is true, the
+        partition-scoped view of the partition of `environment` is queried.
+        """
+        if partitioned:
+            design_doc = PARTITIONED_DESIGN_DOC.split("/")[1]
+            return self.iter_view(
+                db_name, "{}/{}".format(design_doc, view),
+                partition=environment, **params
+            )
+        return self.iter_view(db_name, "openag/" + view, **params)
+
+    def iter_view(self, db_name, view, partition=None, **params):
+        """
+        Yields the rows of the view `view` (either "_all_docs" or the name of
+        a design document and a view in it, separated by a slash) of the
+        database `db_name`, queried with the parameters `params`. If
+        `partition` is given, the partition-scoped view of that partition is
+        queried. Unlike :meth:`couchdb.client.Database.view`, the response is
+        parsed as it is read, so rows are yielded as they arrive and only one
+        row at a time is held in memory.
+        """
+        if view.startswith("_"):
+            path = [view]
+        else:
+            design_doc, name = view.split("/", 1)
+            path = ["_design", design_doc, "_view", name]
+        if partition is not None:
+            path = ["_partition", partition] + path
+        status, _, body = self.resource(db_name).get(path, **params)
+        if status != 200:
+            raise RuntimeError(
+                'Failed to read view "{}" of "{}"'.format(view, db_name)
+            )
+        try:
+            for row in json_codec.iter_array(_iter_chunks(body), "rows"):
+                yield row
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def export_csv(
+        self, fileobj, environment, start, end, variable=None,
+        is_desired=False, cols=None, db_name=ENVIRONMENTAL_DATA_POINT,
+        sharded=False
+    ):
+        """
+        Writes the data points that :meth:`read_data_points` would return to
+        the file-like object `fileobj` as CSV using the `csv` list function.
+        `cols` is the list of fields to include (by default "timestamp",
+        "variable" and "value").
+        """
+        view, startkey, endkey = self._data_point_range(
+            environment, start, end, variable, is_desired
+        )
+        params = {
+            "reduce": False,
+            "startkey": json_codec.dumps(startkey),
+            "endkey": json_codec.dumps(endkey)
+        }
+        if cols:
+            params["cols"] = json_codec.dumps(cols)
+        header_written = False
+        for target in self._data_point_dbs(db_name, start, end, sharded):
+            status, _, data = self.resource(target).get(
+                ["_design", "openag", "_list", "csv", view], **params
+            )
+            if status != 200:
+                raise RuntimeError(
+                    'Failed to export data points from "{}"'.format(target)
+                )
+            lines = data.read().splitlines(True)
+            # Only write the header line once
+            if header_written:
+                lines = lines[1:]
+            header_written = True
+            fileobj.writelines(lines)
+
+    def _data_point_range(
+        self, environment, start, end, variable, is_desired,
+        partitioned=False
+    ):
+        """
+        Returns the view and the start and end keys with which to query data
+        points for :meth:`read_data_points` and :meth:`export_csv`. A `start`
+        or `end` of None means that the range is unbounded on that side.
+        """
+        if variable is None:
+            view, prefix = "by_timestamp", [environment]
+        else:
+            point_type = "desired" if is_desired else "measured"
+            view, prefix = "by_variable", [environment, point_type, variable]
+        # Partition-scoped views don't include the environment in their keys
+        if partitioned:
+            prefix = prefix[1:]
+        startkey = prefix + ([] if start is None else [start])
+        endkey = prefix + [{} if end is None else end]
+        return view, startkey, endkey
+
+    def _data_point_dbs(self, db_name, start, end, sharded):
+        """
+        Returns the names of the databases to read to get the data points
+        between `start` and `end`
+        """
+        if not sharded:
+            return [db_name]
+        existing = set(self.list_shards(db_name))
+        return [
+            name for name in shard_db_names(db_name, start, end)
+            if name in existing
+        ]
+
+    def list_shards(self, db_name):
+        """
+        Returns the sorted names of the monthly shards of the database
+        `db_name` that exist on the server
+        """
+        return sorted(name for name in self if is_shard(name, db_name))
+
+    def get_or_create_shard(self, shard_name, db_name, partitioned=False):
+        """
+        Creates the shard `shard_name` of the database `db_name` if it doesn't
+        already exist. New shards get the design documents of `db_name` and,
+        if `db_name` is being replicated, a matching replication. If
+        `partitioned` is true, new shards are partitioned databases.
+        """
+        if shard_name in self._known_shards:
+            return
+        # Keep threads sharing this server from creating the shard twice
+        with self._shard_lock:
+            if shard_name in self._known_shards:
+                return
+            if not shard_name in self:
+                self.get_or_create(shard_name, partitioned)
+                self._push_db_design_documents(
+                    shard_name, os.path.dirname(_design.__file__),
+                    os.path.dirname(_partitioned_design.__file__), db_name,
+                    partitioned
+                )
+                self._replicate_shard(shard_name, db_name)
+            self._known_shards.add(shard_name)
+
+    def _replicate_shard(self, shard_name, db_name):
+        """
+        Sets up replication of the shard `shard_name` of `db_name` to the same
+        place as `db_name`, if `db_name` is being replicated. Nothing creates
+        the shard on the other side in advance, so the replication creates it.
+        """
+        status, _, body = self.resource("_replicator").post_json(
+            "_all_docs", body={"keys": [db_name]}, include_docs=True
+        )
+        if status != 200:
+            return
+        rows = [row for row in body["rows"] if row.get("doc")]
+        if not rows:
             return
-        del self["_replicator"][doc_id]
+        base = rows[0]["doc"]
+        spec = {
+            k: base[k] for k in REPLICATION_FIELDS
+            if k in base and k != "since_seq"
+        }
+        spec["source"] = shard_name
+        spec["target"] = shard_target(base["target"], db_name, shard_name)
+        spec["create_target"] = True
+        self.reconcile_replications({shard_name: spec})
+
+    def write_bucketed_data_points(
+        self, points, db_name=ENVIRONMENTAL_DATA_BUCKET, bucket_size=3600,
+        max_retries=3, encoding=None, point_filter=None
+    ):
+        """
+        Validates the environmental data points `points` and adds them to the
+        :class:`~openag.models.EnvironmentalDataBucket` documents of
+        `bucket_size` seconds that cover them in the database `db_name`.
+        Manual readings are rare, so they are written as individual points with
+        :meth:`write_data_points` instead. Writing a point that is already in
+        its bucket has no effect. Buckets that were changed concurrently are
+        re-read and merged again up to `max_retries` times. If `encoding` is
+        "dod-xor", buckets holding only numbers are compressed with
+        :func:`openag.codec.encode_series`, and the timestamps of the points in
+        compressed buckets are rounded to the millisecond. If a `point_filter`
+        (such as an :class:`~openag.ingest.IngestFilter`) is given, only the
+        points it yields are written. Returns the number of points that were
+        added.
+        """
+        db = self.resource(db_name)
+        new_points = {}
+        manual_points = []
+        validate = get_validator(EnvironmentalDataPoint)
+        points = (validate(point) for point in points)
+        if point_filter:
+            points = point_filter(points)
+        for point in points:
+            if point["is_manual"]:
+                manual_points.append(point)
+                continue
+            _id = bucket_id(point, bucket_size)
+            if not _id in new_points:
+                new_points[_id] = (point, {})
+            new_points[_id][1][point["timestamp"]] = point["value"]
+        count = 0
+        if manual_points:
+            count += self.write_data_points(manual_points)
+        for attempt in range(max_retries + 1):
+            if not new_points:
+                break
+            status, _, body = db.post_json(
+                "_all_docs", body={"keys": sorted(new_points)},
+                include_docs=True
+            )
+            if status != 200:
+                raise RuntimeError(
+                    'Failed to read buckets from "{}"'.format(db_name)
+                )
+            docs = []
+            added = {}
+            for row in body["rows"]:
+                point, values = new_points[row["key"]]
+                if row.get("doc"):
+                    doc = row["doc"]
+                else:
+                    doc = {
+                        "_id": row["key"],
+                        "environment": point["environment"],
+                        "variable": point["variable"],
+                        "is_desired": point["is_desired"],
+                        "start": bucket_start(point["timestamp"], bucket_size),
+                        "size": bucket_size,
+                        "timestamps": [],
+                        "values": []
+                    }
+                merged = dict(zip(*_bucket_series(doc)))
+                # Encoded buckets only keep timestamps to the millisecond, so
+                # the points are compared at that resolution
+                if encoding == DOD_XOR or doc.get("encoding"):
+                    merged = {
+                        round_timestamp(t): v for t, v in merged.items()
+                    }
+                    values = {
+                        round_timestamp(t): v for t, v in values.items()
+                    }
+                added[row["key"]] = len(set(values) - set(merged))
+                if not added[row["key"]]:
+                    continue
+                merged.update(values)
+                timestamps = sorted(merged)
+                doc["timestamps"] = timestamps
+                doc["values"] = [merged[t] for t in timestamps]
+                doc.pop("encoding", None)
+                doc.pop("version", None)
+                doc.pop("latest", None)
+                if encoding == DOD_XOR and all(
+                    isinstance(v, (int, long, float)) and
+                    not isinstance(v, bool) for v in doc["values"]
+                ):
+                    doc["latest"] = {
+                        "timestamp": timestamps[-1],
+                        "value": doc["values"][-1]
+                    }
+                    doc.update(encode_series(timestamps, doc["values"]))
+                bucket = EnvironmentalDataBucket(doc)
+                bucket["_id"] = doc["_id"]
+                if "_rev" in doc:
+                    bucket["_rev"] = doc["_rev"]
+                docs.append(bucket)
+            results = self._bulk_docs(db, docs) if docs else []
+            conflicts = {
+                r["id"] for r in results if r.get("error") == "conflict"
+            }
+            self._check_bulk_results([
+                r for r in results if r["id"] not in conflicts
+            ])
+            for _id in set(new_points) - conflicts:
+                count += added.get(_id, 0)
+            new_points = {_id: new_points[_id] for _id in conflicts}
+        if new_points:
+            raise RuntimeError(
+                "Failed to write buckets because of repeated conflicts: "
+                "{}".format(", ".join(sorted(new_points)))
+            )
+        return count
+
+    def read_bucketed_data_points(
+        self, environment, variable, start, end, is_desired=False,
+        db_name=ENVIRONMENTAL_DATA_BUCKET, bucket_size=3600
+    ):
+        """
+        Yields the environmental data points for the variable `variable` in the
+        environment `environment` with timestamps between `start` and `end`
+        from the buckets of `bucket_size` seconds in the database `db_name`, in
+        order of their timestamps
+        """
+        point_type = "desired" if is_desired else "measured"
+        rows = self.iter_view(
+            db_name, "openag/by_variable", reduce=False, include_docs=True,
+            startkey=json_codec.dumps([
+                environment, point_type, variable,
+                bucket_start(start, bucket_size)
+            ]),
+            endkey=json_codec.dumps([environment, point_type, variable, end])
+        )
+        for row in rows:
+            for timestamp, value in zip(*_bucket_series(row["doc"])):
+                if start <= timestamp <= end:
+                    yield {
+                        "environment": environment,
+                        "variable": variable,
+                        "is_manual": False,
+                        "is_desired": is_desired,
+                        "value": value,
+                        "timestamp": timestamp
+                    }
+
+    def dump_snapshot(self, db_name, fileobj, batch_size=1000):
+        """
+        Writes all of the documents in the database `db_name` (with their
+        revisions) to the file-like object `fileobj` as gzip-compressed JSON
+        lines. Design documents and deleted documents are skipped. Returns the
+        update sequence of the database at the end of the snapshot, from which
+        replication can continue.
+        """
+        db = self.resource(db_name)
+        since = 0
+        out = gzip.GzipFile(fileobj=fileobj, mode="wb")
+        try:
+            while True:
+                status, _, body = db.get_json(
+                    "_changes", include_docs=True, since=since,
+                    limit=batch_size
+                )
+                if status != 200:
+                    raise RuntimeError(
+                        'Failed to read changes from "{}"'.format(db_name)
+                    )
+                for change in body["results"]:
+                    if change.get("deleted") or \
+                            change["id"].startswith("_design/"):
+                        continue
+                    out.write(json_codec.dumps(change["doc"]) + "\n")
+                since = body["last_seq"]
+                if len(body["results"]) < batch_size:
+                    break
+            out.write(json_codec.dumps({"last_seq": since}) + "\n")
+        finally:
+            out.close()
+        return since
+
+    def load_snapshot(self, db_name, fileobj, batch_size=1000):
+        """
+        Writes the documents in a snapshot created by :meth:`dump_snapshot`
+        from the file-like object `fileobj` into the database `db_name`,
+        keeping their revisions so that later replications treat them as
+        already replicated. Returns the update sequence recorded in the
+        snapshot.
+        """
+        db = self.resource(db_name)
+        last_seq = None
+        docs = []
+        for line in gzip.GzipFile(fileobj=fileobj, mode="rb"):
+            item = json_codec.loads(line)
+            if "_id" not in item:
+                last_seq = item["last_seq"]
+                continue
+            docs.append(item)
+            if len(docs) >= batch_size:
+                self._check_bulk_results(
+                    self._bulk_docs(db, docs, new_edits=False)
+                )
+                docs = []
+        if docs:
+            self._check_bulk_results(
+                self._bulk_docs(db, docs, new_edits=False)
+            )
+        return last_seq
+
+    def archive_expired_data_points(
+        self, policies, fileobj, default=None,
+        db_name=ENVIRONMENTAL_DATA_POINT, now=None, batch_size=1000,
+        time_ordered_ids=False
+    ):
+        """
+        Removes the environmental data points in the database `db_name` that
+        are older than their retention policy. `policies` maps variable names
+        to the number of days for which points for that variable are kept, and
+        `default` is the number of days for which points for other variables
+        are kept (forever if None). Expired points are first written to the
+        file-like object `fileobj` in the format of :meth:`dump_snapshot` (so
+        they can be restored with :meth:`load_snapshot`) and then purged, which
+        unlike deleting them doesn't leave tombstones behind. Returns the
+        number of points that were purged.
+
+        Points are selected by their "timestamp" fields, so the whole database
+        is scanned. If `time_ordered_ids` is true, all of the IDs in the
+        database are known to come from :func:`data_point_id` (and so start
+        with the timestamps of the points), and only the start of the database
+        up to the shortest retention period is scanned, unless the database is
+        partitioned. IDs generated by CouchDB or other clients don't sort by
+        time, so points with such IDs would be missed by that shortcut.
+        """
+        now = time.time() if now is None else now
+        cutoffs = {
+            variable: now - days * 86400 for variable, days in policies.items()
+        }
+        default_cutoff = None if default is None else now - default * 86400
+        all_cutoffs = [
+            c for c in list(cutoffs.values()) + [default_cutoff]
+            if c is not None
+        ]
+        if not all_cutoffs:
+            return 0
+        db = self.resource(db_name)
+        endkey = None
+        if time_ordered_ids and not self.is_partitioned(db_name):
+            endkey = "{:017.6f}".format(max(all_cutoffs))
+        startkey = None
+        count = 0
+        out = gzip.GzipFile(fileobj=fileobj, mode="wb")
+        try:
+            while True:
+                params = {
+                    "include_docs": True, "conflicts": True,
+                    "limit": batch_size
+                }
+                if endkey is not None:
+                    params["endkey"] = json_codec.dumps(endkey)
+                if startkey is not None:
+                    params["startkey"] = json_codec.dumps(startkey)
+                    params["limit"] += 1
+                status, _, body = db.get_json("_all_docs", **params)
+                if status != 200:
+                    raise RuntimeError(
+                        'Failed to read documents from "{}"'.format(db_name)
+                    )
+                # The previous page ended with `startkey`, which is only still
+                # there if it wasn't purged
+                rows = [
+                    row for row in body["rows"] if row["id"] != startkey
+                ]
+                expired = {}
+                for row in rows:
+                    doc = row["doc"]
+                    cutoff = cutoffs.get(doc.get("variable"), default_cutoff)
+                    if cutoff is None or doc.get("timestamp") is None or \
+                            doc["timestamp"] >= cutoff:
+                        continue
+                    conflicts = doc.pop("_conflicts", [])
+                    out.write(json_codec.dumps(doc) + "\n")
+                    expired[doc["_id"]] = [doc["_rev"]] + conflicts
+                if expired:
+                    status, _, res = db.post_json("_purge", body=expired)
+                    if status not in (200, 201):
+                        raise RuntimeError(
+                            'Failed to purge documents from "{}"'.format(
+                                db_name
+                            )
+                        )
+                    count += len(expired)
+                if len(body["rows"]) < params["limit"]:
+                    break
+                startkey = rows[-1]["id"]
+        finally:
+            out.close()
+        return count
+
+    def get_disk_size(self, db_name):
+        """
+        Returns the number of bytes that the database `db_name` and the view
+        indexes of its design documents take up on disk
+        """
+        db = self.resource(db_name)
+        size = _file_size(self._get_info(db, [], db_name))
+        for ddoc in self._design_doc_names(db):
+            size += _file_size(self._get_view_index_info(db, ddoc, db_name))
+        return size
+
+    def compact(self, db_name, wait=True, poll_interval=1):
+        """
+        Compacts the database `db_name` and the views of its design documents
+        and removes index files of views that no longer exist. If `wait` is
+        true, waits for the compaction of the database and of all of the views
+        to finish (checking every `poll_interval` seconds) and returns the
+        number of bytes that were reclaimed.
+        """
+        db = self.resource(db_name)
+        old_size = self.get_disk_size(db_name)
+        headers = {"Content-Type": "application/json"}
+        ddocs = self._design_doc_names(db)
+        targets = [["_compact"]]
+        targets.extend(["_compact", ddoc] for ddoc in ddocs)
+        targets.append(["_view_cleanup"])
+        for path in targets:
+            status, _, _ = db.post_json(path, headers=headers)
+            if status not in (200, 202):
+                raise RuntimeError(
+                    'Failed to compact "{}"'.format(db_name)
+                )
+        if not wait:
+            return None
+        while self._get_info(db, [], db_name).get("compact_running") or any(
+            self._get_view_index_info(db, ddoc, db_name).get("compact_running")
+            for ddoc in ddocs
+        ):
+            time.sleep(poll_interval)
+        return old_size - self.get_disk_size(db_name)
+
+    def _design_doc_names(self, db):
+        """
+        Returns the names (without the "_design/" prefix) of the design
+        documents in the database represented by the resource `db`
+        """
+        status, _, body = db.get_json(
+            "_all_docs", startkey=json_codec.dumps("_design/"),
+            endkey=json_codec.dumps("_design0")
+        )
+        return [
+            row["id"][len("_design/"):] for row in body.get("rows", [])
+        ]
+
+    def _get_view_index_info(self, db, ddoc, db_name):
+        """
+        Returns the information about the view index of the design document
+        `ddoc` in the database represented by the resource `db`
+        """
+        return self._get_info(db, ["_design", ddoc, "_info"], db_name)[
+            "view_index"
+        ]
+
+    def _get_info(self, db, path, db_name):
+        status, _, body = db.get_json(path)
+        if status != 200:
+            raise RuntimeError(
+                'Failed to read information about "{}"'.format(db_name)
+            )
+        return body
+
+    def _check_bulk_results(self, results):
+        """
+        Raises an error if any of the per-document `results` of a bulk request
+        is an error
+        """
+        for result in results:
+            if "error" in result:
+                raise RuntimeError(
+                    'Failed to write document "{}": {}'.format(
+                        result["id"], result.get("reason", result["error"])
+                    )
+                )
+
+    def _bulk_docs(self, resource, docs, new_edits=True):
+        """
+        Writes the documents `docs` to the database represented by `resource`
+        in a single request and returns the list of per-document results
+        """
+        data = {"docs": docs}
+        if not new_edits:
+            data["new_edits"] = False
+        status, _, body = resource.post_json("_bulk_docs", body=data)
+        if status not in (200, 201):
+            raise RuntimeError("Bulk update failed ({})".format(status))
+        return body
 
     def create_user(self, username, password):
         """
@@ -58,7 +1037,7 @@ class Server(_Server):
         """
         user_id = "org.couchdb.user:" + username
         res = self["_users"].resource.put(
-            user_id, body=json.dumps({
+            user_id, body=json_codec.dumps({
                 "_id": user_id,
                 "name": username,
                 "roles": [],
@@ -81,22 +1060,85 @@ class Server(_Server):
     def log_in(self, username, password):
         """
         Logs in to the CouchDB instance with the credentials `username` and
-        `password`
+        `password`. This creates a cookie-based session, so the server only has
+        to check the password once. The session cookie is available as
+        `session_cookie` and expires at `session_expires`, as set by the
+        server. If the server rejects the cookie later on (e.g. because it was
+        restarted), a new session is created with the same credentials.
         """
-        self.resource.credentials = (username, password)
-        return self.resource.get_json("_session")[2]
+        cookie, expires, body = self._create_session(username, password)
+        self.use_session(username, cookie, expires, password)
+        return body
+
+    def _create_session(self, username, password):
+        # Don't send the cookie of the current session, if any
+        resource = self.resource()
+        resource.headers.pop("Cookie", None)
+        status, headers, body = resource.post_json(
+            "_session", body={"name": username, "password": password}
+        )
+        session = session_cookie(headers)
+        if status != 200 or session is None:
+            raise RuntimeError("Failed to log in")
+        cookie, expires = session
+        return cookie, expires, body
+
+    def use_session(self, username, cookie, expires, password=None):
+        """
+        Uses the existing session cookie `cookie` (e.g. from an earlier call
+        to :meth:`log_in`), which expires at the timestamp `expires`, to
+        authenticate as the user `username`. If `password` is given and the
+        server rejects the cookie, a new session is created with it.
+        """
+        self.username = username
+        self._session_cookie = cookie
+        self._session_expires = expires
+        # Replace the headers rather than changing them, because other threads
+        # may be copying them
+        headers = dict(self.resource.headers)
+        headers["Cookie"] = "AuthSession=" + cookie
+        self.resource.headers = headers
+        session = self.resource.session
+        if password is not None and isinstance(session, Session):
+            def renew():
+                return self._create_session(username, password)[:2]
+            session.add_session_renewal(cookie, renew)
+
+    @property
+    def session_cookie(self):
+        """
+        The cookie of the current session, which is replaced when the server
+        refreshes the session or the session is renewed
+        """
+        return self._latest_session()[0]
+
+    @property
+    def session_expires(self):
+        """ The timestamp at which :attr:`session_cookie` expires """
+        return self._latest_session()[1]
+
+    def _latest_session(self):
+        cookie = getattr(self, "_session_cookie", None)
+        session = self.resource.session
+        if cookie is not None and isinstance(session, Session):
+            latest = session.latest_session(cookie)
+            if latest is not None:
+                return latest
+        return cookie, getattr(self, "_session_expires", None)
 
     def get_user_info(self):
         """
         Returns the document representing the currently logged in user on the
         server
         """
-        try:
-            user_id = "org.couchdb.user:"+self.resource.credentials[0]
-        except TypeError:
+        username = getattr(self, "username", None)
+        if not username and self.resource.credentials:
+            username = self.resource.credentials[0]
+        if not username:
             raise RuntimeError(
                 "Please log in before trying to access your user's info"
             )
+        user_id = "org.couchdb.user:" + username
         status, _, body = self["_users"].resource.get_json(user_id)
         if status != 200:
             raise RuntimeError(
@@ -106,26 +1148,153 @@ class Server(_Server):
 
     def log_out(self):
         """ Logs out of the CouchDB instance """
-        self.resource.credentials = None
+        self.username = None
+        self._session_cookie = None
+        self._session_expires = None
+        headers = dict(self.resource.headers)
+        headers.pop("Cookie", None)
+        self.resource.headers = headers
 
-    def push_design_documents(self, design_path):
+    def push_design_documents(self, design_path, partitioned_design_path=None):
         """
-        Push the design documents stored in `design_path` to the server
+        Push the design documents stored in `design_path` to the server.
+        Partitioned databases also get the partition-scoped design documents
+        stored in `partitioned_design_path` (by default the ones that come with
+        this package).
         """
+        if partitioned_design_path is None:
+            partitioned_design_path = os.path.dirname(
+                _partitioned_design.__file__
+            )
+        db_names = list(self)
         for db_name in os.listdir(design_path):
             if db_name.startswith("__") or db_name.startswith("."):
                 continue
-            db_path = os.path.join(design_path, db_name)
-            doc = self._folder_to_dict(db_path)
-            doc_id = "_design/openag"
-            doc["_id"] = doc_id
-            db = self[db_name]
-            if doc_id in db:
-                old_doc = db[doc_id]
-                doc["_rev"] = old_doc["_rev"]
-                if doc == old_doc:
-                    continue
-            db[doc_id] = doc
+            # Optional databases may not have been created
+            if db_name in optional_per_farm_dbs and not db_name in db_names:
+                continue
+            self._push_db_design_documents(
+                db_name, design_path, partitioned_design_path
+            )
+            # Shards use the same design documents as the database itself
+            for shard_name in db_names:
+                if is_shard(shard_name, db_name):
+                    self._push_db_design_documents(
+                        shard_name, design_path, partitioned_design_path,
+                        db_name
+                    )
+
+    def _push_db_design_documents(
+        self, db_name, design_path, partitioned_design_path, base_db_name=None,
+        partitioned=None
+    ):
+        """
+        Push the design documents for the database `base_db_name` (by default
+        `db_name`) to the database `db_name`. `partitioned` says whether
+        `db_name` is partitioned (if None, the server is asked if there is a
+        partition-scoped design document for it).
+        """
+        base_db_name = base_db_name or db_name
+        db_path = os.path.join(design_path, base_db_name)
+        partitioned_path = os.path.join(partitioned_design_path, base_db_name)
+        if not os.path.isdir(partitioned_path):
+            partitioned = False
+        elif partitioned is None:
+            partitioned = self.is_partitioned(db_name)
+        if base_db_name in VARIABLE_DICTIONARY_DBS:
+            self.push_variable_dictionary(db_name)
+        if not partitioned:
+            self.push_design_document(db_name, db_path)
+            return
+        # Custom reduce and list functions only work in global design
+        # documents
+        self.push_design_document(db_name, db_path, partitioned=False)
+        self.push_design_document(
+            db_name, partitioned_path, PARTITIONED_DESIGN_DOC, partitioned=True
+        )
+
+    def push_design_document(
+        self, db_name, db_path, doc_id="_design/openag", partitioned=None
+    ):
+        """
+        Push the design document stored in the folder `db_path` to the database
+        `db_name` under the ID `doc_id`. If `partitioned` is not None, the
+        design document is marked as partitioned or not (which only makes sense
+        in partitioned databases). Each JSON file in the "indexes" subfolder of
+        `db_path` defines a Mango index (as in the "index" field of a request
+        to `_index`), which is created under the name of the file.
+        """
+        doc = self._folder_to_dict(db_path)
+        for name, index in sorted(doc.pop("indexes", {}).items()):
+            self.create_index(db_name, name, json_codec.loads(index))
+        doc["_id"] = doc_id
+        if partitioned is not None:
+            doc["options"] = {"partitioned": partitioned}
+        db = self[db_name]
+        if doc_id in db:
+            old_doc = db[doc_id]
+            doc["_rev"] = old_doc["_rev"]
+            if doc == old_doc:
+                return
+        db[doc_id] = doc
+
+    def push_variable_dictionary(self, db_name, dictionary=None):
+        """
+        Stores the variable dictionary `dictionary` (by default the one
+        generated from :class:`~openag.var_types.EnvVar`) in the database
+        `db_name`. A stored dictionary is kept if it has the same version or
+        has codes that `dictionary` doesn't extend (i.e. it is newer). It is
+        stored as a design document so that it is replicated along with the
+        data but not subject to the validation function of the database.
+        """
+        dictionary = dictionary or VARIABLE_DICTIONARY
+        db = self[db_name]
+        doc = dictionary.to_doc()
+        if VARIABLE_DICTIONARY_DOC in db:
+            old_doc = db[VARIABLE_DICTIONARY_DOC]
+            old_dictionary = VariableDictionary.from_doc(old_doc)
+            if old_doc.get("version") == dictionary.version or \
+                    not dictionary.extends(old_dictionary):
+                return
+            doc["_rev"] = old_doc["_rev"]
+        db[VARIABLE_DICTIONARY_DOC] = doc
+
+    def get_variable_dictionary(self, db_name):
+        """
+        Returns the :class:`~openag.var_types.VariableDictionary` stored in the
+        database `db_name`, or None if there is none
+        """
+        db = self[db_name]
+        if not VARIABLE_DICTIONARY_DOC in db:
+            return None
+        return VariableDictionary.from_doc(db[VARIABLE_DICTIONARY_DOC])
+
+    def create_index(self, db_name, name, index):
+        """
+        Creates the Mango index `index` named `name` in the database `db_name`
+        if it doesn't already exist. Servers that don't support Mango queries
+        (i.e. CouchDB 1.x) are skipped.
+        """
+        if self.version_info()[0] < 2:
+            return
+        status, _, body = self.resource(db_name).post_json("_index", body={
+            "index": index, "name": name, "type": "json",
+            "ddoc": INDEX_DESIGN_DOC[len("_design/"):]
+        })
+        if status not in (200, 201):
+            raise RuntimeError(
+                'Failed to create index "{}" in "{}": {}'.format(
+                    name, db_name, body.get("reason", body.get("error"))
+                )
+            )
+
+    def find(self, db_name, selector=None, partition=None):
+        """
+        Returns a :class:`FindQuery` for the documents in the database
+        `db_name` (or its partition `partition`) that match the Mango selector
+        `selector`
+        """
+        return FindQuery(self, db_name, selector, partition)
 
     def _folder_to_dict(self, path):
         """
@@ -145,3 +1314,100 @@ class Server(_Server):
                 res[key] = self._folder_to_dict(key_path)
         return res
 
+class FindQuery(object):
+    """
+    Builds and runs a Mango query against the `_find` endpoint of a database.
+    The methods that modify the query return the query itself, so they can be
+    chained::
+
+        query = server.find(ENVIRONMENTAL_DATA_POINT).where(
+            is_manual=True, variable="air_temperature"
+        ).fields("timestamp", "value").sort("-timestamp").limit(10)
+        for doc in query:
+            ...
+
+    Iterating over a query fetches all of the matching documents, one page of
+    `limit` documents at a time, using bookmarks. If execution statistics are
+    requested, the statistics of the most recent request are stored in
+    :attr:`execution_stats`.
+    """
+    def __init__(self, server, db_name, selector=None, partition=None):
+        self.server = server
+        self.db_name = db_name
+        self.partition = partition
+        self.body = {"selector": dict(selector or {})}
+        self.execution_stats = None
+        self.warning = None
+
+    def where(self, **conditions):
+        """
+        Adds conditions to the selector. Each keyword argument maps a field to
+        a value it has to be equal to, or to a dictionary of Mango operators
+        (e.g. `timestamp={"$gt": 1476900000}`).
+        """
+        self.body["selector"].update(conditions)
+        return self
+
+    def fields(self, *fields):
+        """ Only returns the fields `fields` of each document """
+        self.body["fields"] = list(fields)
+        return self
+
+    def sort(self, *fields):
+        """
+        Sorts the results by `fields`. Fields starting with "-" are sorted in
+        descending order.
+        """
+        self.body["sort"] = [
+            {f[1:]: "desc"} if f.startswith("-") else {f: "asc"}
+            for f in fields
+        ]
+        return self
+
+    def limit(self, limit):
+        """ Returns at most `limit` documents per request """
+        self.body["limit"] = limit
+        return self
+
+    def use_index(self, name):
+        """ Runs the query on the index `name` """
+        self.body["use_index"] = [INDEX_DESIGN_DOC, name]
+        return self
+
+    def with_execution_stats(self, enabled=True):
+        """ Requests execution statistics along with the results """
+        self.body["execution_stats"] = enabled
+        return self
+
+    def execute(self, bookmark=None):
+        """
+        Runs the query, starting after the bookmark `bookmark` if it is given,
+        and returns a tuple of the list of matching documents and the bookmark
+        of the next page
+        """
+        body = dict(self.body)
+        if bookmark:
+            body["bookmark"] = bookmark
+        path = ["_find"]
+        if self.partition:
+            path = ["_partition", self.partition] + path
+        status, _, res = self.server.resource(self.db_name).post_json(
+            path, body=body
+        )
+        if status != 200:
+            raise RuntimeError('Failed to query "{}": {}'.format(
+                self.db_name, res.get("reason", res.get("error"))
+            ))
+        self.execution_stats = res.get("execution_stats")
+        self.warning = res.get("warning")
+        return res["docs"], res.get("bookmark")
+
+    def __iter__(self):
+        limit = self.body.get("limit", 25)
+        bookmark = None
+        while True:
+            docs, bookmark = self.execute(bookmark)
+            for doc in docs:
+                yield doc
+            if len(docs) < limit or not bookmark:
+                break
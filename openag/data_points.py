@@ -0,0 +1,260 @@
+"""
+This module consists of compact in-memory representations of
+:class:`~openag.models.EnvironmentalDataPoint` objects for services that hold
+many of them at once. A :class:`DataPoint` stores the fields of a single point
+in slots instead of a dictionary, and a :class:`DataPointBatch` stores the
+timestamps and numeric values of many points in typed arrays and their
+environments and variables as indices into tables of interned strings.
+"""
+import math
+from array import array
+
+from .models import EnvironmentalDataPoint
+from .validators import get_validator
+
+__all__ = ["DataPoint", "DataPointBatch"]
+
+_interned = {}
+
+def _intern(s):
+    """
+    Returns a canonical instance of the string `s`, so that points with the
+    same environment or variable share one string object
+    """
+    return _interned.setdefault(s, s)
+
+class DataPoint(object):
+    """
+    A single environmental data point. The attributes are the fields of
+    :class:`~openag.models.EnvironmentalDataPoint`.
+    """
+    __slots__ = (
+        "environment", "variable", "is_manual", "is_desired", "value",
+        "timestamp"
+    )
+
+    def __init__(
+        self, environment, variable, value, timestamp, is_desired=False,
+        is_manual=False
+    ):
+        self.environment = _intern(environment)
+        self.variable = _intern(variable)
+        self.value = value
+        self.timestamp = timestamp
+        self.is_desired = is_desired
+        self.is_manual = is_manual
+
+    @classmethod
+    def from_dict(cls, doc):
+        """
+        Creates a point from a dictionary (or CouchDB document) that is valid
+        according to :class:`~openag.models.EnvironmentalDataPoint`
+        """
+        doc = get_validator(EnvironmentalDataPoint)(doc)
+        return cls(
+            doc["environment"], doc["variable"], doc.get("value"),
+            doc["timestamp"], doc["is_desired"], doc["is_manual"]
+        )
+
+    def to_dict(self):
+        """
+        Returns the point as a dictionary in the format of
+        :class:`~openag.models.EnvironmentalDataPoint`
+        """
+        return {
+            "environment": self.environment,
+            "variable": self.variable,
+            "is_manual": self.is_manual,
+            "is_desired": self.is_desired,
+            "value": self.value,
+            "timestamp": self.timestamp
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, DataPoint) and all(
+            getattr(self, attr) == getattr(other, attr)
+            for attr in self.__slots__
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "DataPoint({!r}, {!r}, {!r}, {!r})".format(
+            self.environment, self.variable, self.value, self.timestamp
+        )
+
+class DataPointBatch(object):
+    """
+    A sequence of environmental data points stored column by column.
+    Timestamps and numeric values are stored in arrays of doubles (so integer
+    values come back as floats), environments and variables as indices into
+    the tables :attr:`environments` and :attr:`variables`, and the flags as
+    arrays of bytes. Values that aren't numbers (such as booleans, strings and
+    dictionaries) are kept in a dictionary mapping the indices of their points
+    to them.
+
+    If a `variable_dictionary` (such as
+    :data:`~openag.var_types.VARIABLE_DICTIONARY`) is given, variables are
+    stored as their codes in that dictionary, so the codes are the same in
+    every batch. Variables that aren't in the dictionary get codes after the
+    ones in the dictionary.
+    """
+    def __init__(self, points=(), variable_dictionary=None):
+        self.timestamps = array("d")
+        self.values = array("d")
+        self.environment_codes = array("I")
+        self.variable_codes = array("I")
+        self.is_desired = array("b")
+        self.is_manual = array("b")
+        self.other_values = {}
+        self.environments = []
+        self.variables = []
+        self._environment_index = {}
+        self._variable_index = {}
+        if variable_dictionary is not None:
+            self.variables.extend(variable_dictionary.names)
+            self._variable_index.update(variable_dictionary.codes)
+        self.extend(points)
+
+    @classmethod
+    def from_dicts(cls, docs, variable_dictionary=None):
+        """
+        Creates a batch from an iterable of dictionaries (or CouchDB documents)
+        that are valid according to
+        :class:`~openag.models.EnvironmentalDataPoint`
+        """
+        validate = get_validator(EnvironmentalDataPoint)
+        batch = cls(variable_dictionary=variable_dictionary)
+        for doc in docs:
+            batch._append_dict(validate(doc))
+        return batch
+
+    def to_dicts(self):
+        """
+        Returns a list of the points in the batch as dictionaries in the format
+        of :class:`~openag.models.EnvironmentalDataPoint`
+        """
+        return [point.to_dict() for point in self]
+
+    def to_docs(self, partitioned=False):
+        """
+        Returns a list of the points in the batch as CouchDB documents, with
+        IDs from :func:`~openag.couch.data_point_id`
+        """
+        from .couch import data_point_id
+        docs = self.to_dicts()
+        for doc in docs:
+            doc["_id"] = data_point_id(doc, partitioned)
+        return docs
+
+    def append(self, point):
+        """
+        Adds a point, which can be a :class:`DataPoint` or a dictionary in the
+        format of :class:`~openag.models.EnvironmentalDataPoint`, to the batch
+        """
+        if isinstance(point, DataPoint):
+            self._append(
+                point.environment, point.variable, point.value,
+                point.timestamp, point.is_desired, point.is_manual
+            )
+        else:
+            self._append_dict(get_validator(EnvironmentalDataPoint)(point))
+
+    def extend(self, points):
+        """ Adds every point in the iterable `points` to the batch """
+        for point in points:
+            self.append(point)
+
+    def _append_dict(self, doc):
+        self._append(
+            doc["environment"], doc["variable"], doc.get("value"),
+            doc["timestamp"], doc["is_desired"], doc["is_manual"]
+        )
+
+    def _append(
+        self, environment, variable, value, timestamp, is_desired, is_manual
+    ):
+        index = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        self.environment_codes.append(self._code(
+            environment, self.environments, self._environment_index
+        ))
+        self.variable_codes.append(self._code(
+            variable, self.variables, self._variable_index
+        ))
+        self.is_desired.append(bool(is_desired))
+        self.is_manual.append(bool(is_manual))
+        if isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            self.values.append(value)
+        else:
+            self.values.append(0)
+            self.other_values[index] = value
+
+    def _code(self, name, table, index):
+        code = index.get(name)
+        if code is None:
+            code = index[name] = len(table)
+            table.append(_intern(name))
+        return code
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("DataPointBatch index out of range")
+        return DataPoint(
+            self.environments[self.environment_codes[i]],
+            self.variables[self.variable_codes[i]],
+            self.other_values[i] if i in self.other_values
+            else self.values[i],
+            self.timestamps[i], bool(self.is_desired[i]),
+            bool(self.is_manual[i])
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def invalid_indices(self, min_timestamp=0, max_timestamp=None):
+        """
+        Returns the sorted indices of the points whose timestamps aren't
+        finite or aren't between `min_timestamp` and `max_timestamp`, or whose
+        numeric values aren't finite. The common case of a valid batch is
+        checked with a few passes of built-in functions over the arrays rather
+        than by looking at each point in Python.
+        """
+        res = set()
+        timestamps = self.timestamps
+        if timestamps and not (
+            _is_finite(sum(timestamps)) and
+            min(timestamps) >= min_timestamp and
+            (max_timestamp is None or max(timestamps) <= max_timestamp)
+        ):
+            for i, t in enumerate(timestamps):
+                if not _is_finite(t) or t < min_timestamp or \
+                        (max_timestamp is not None and t > max_timestamp):
+                    res.add(i)
+        values = self.values
+        if values and not _is_finite(sum(values)):
+            res.update(i for i, v in enumerate(values) if not _is_finite(v))
+        return sorted(res)
+
+    def validate(self, min_timestamp=0, max_timestamp=None):
+        """
+        Raises a ValueError if any point in the batch is invalid according to
+        :meth:`invalid_indices`
+        """
+        invalid = self.invalid_indices(min_timestamp, max_timestamp)
+        if invalid:
+            raise ValueError(
+                "Invalid timestamps or values in {} data points (first at "
+                "index {})".format(len(invalid), invalid[0])
+            )
+
+def _is_finite(x):
+    return not (math.isinf(x) or math.isnan(x))
@@ -1,8 +1,17 @@
-__all__ = ["all_dbs", "global_dbs", "per_farm_dbs"]
+__all__ = [
+    "all_dbs", "global_dbs", "per_farm_dbs", "optional_per_farm_dbs",
+    "shard_db_name", "shard_db_names", "is_shard"
+]
+
+import re
+from datetime import datetime
 
 all_dbs = set()
 global_dbs = set()
 per_farm_dbs = set()
+# Per-farm databases that are only created and replicated when the feature
+# that uses them is turned on, so they aren't in `all_dbs` or `per_farm_dbs`
+optional_per_farm_dbs = set()
 
 def global_db(db):
     all_dbs.add(db)
@@ -14,6 +23,10 @@ def per_farm_db(db):
     per_farm_dbs.add(db)
     return db
 
+def optional_per_farm_db(db):
+    optional_per_farm_dbs.add(db)
+    return db
+
 RECIPE = global_db("recipes")
 SOFTWARE_MODULE_TYPE = global_db("software_module_type")
 SOFTWARE_MODULE = per_farm_db("software_module")
@@ -21,3 +34,35 @@ FIRMWARE_MODULE_TYPE = global_db("firmware_module_type")
 FIRMWARE_MODULE = per_farm_db("firmware_module")
 ENVIRONMENT = per_farm_db("environment")
 ENVIRONMENTAL_DATA_POINT = per_farm_db("environmental_data_point")
+ENVIRONMENTAL_DATA_BUCKET = optional_per_farm_db("environmental_data_bucket")
+
+def shard_db_name(db_name, timestamp):
+    """
+    Returns the name of the monthly shard of the database `db_name` that holds
+    documents with the UNIX timestamp `timestamp` (e.g.
+    "environmental_data_point_2016_10")
+    """
+    return "{}_{}".format(
+        db_name, datetime.utcfromtimestamp(timestamp).strftime("%Y_%m")
+    )
+
+def shard_db_names(db_name, start, end):
+    """
+    Returns the names of the monthly shards of the database `db_name` that
+    cover the time between the UNIX timestamps `start` and `end`
+    """
+    start = datetime.utcfromtimestamp(start)
+    end = datetime.utcfromtimestamp(end)
+    year, month = start.year, start.month
+    res = []
+    while (year, month) <= (end.year, end.month):
+        res.append("{}_{:04d}_{:02d}".format(db_name, year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return res
+
+def is_shard(name, db_name):
+    """
+    Returns whether the database named `name` is a monthly shard of the
+    database `db_name`
+    """
+    return bool(re.match(re.escape(db_name) + r"_\d{4}_\d{2}$", name))
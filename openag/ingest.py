@@ -0,0 +1,130 @@
+"""
+This module consists of code for reducing the volume of environmental data
+points before they are written to the database, based on the accuracy and
+repeatability declared by the firmware modules that produce them.
+"""
+from .utils import synthesize_firmware_module_info, index_by_id
+from .db_names import FIRMWARE_MODULE, FIRMWARE_MODULE_TYPE
+
+__all__ = ["IngestFilter"]
+
+class IngestFilter(object):
+    """
+    Filters a stream of :class:`~openag.models.EnvironmentalDataPoint`
+    instances. Measured values of variables with a declared `accuracy` are
+    rounded to that accuracy, and readings that differ from the last reading
+    that was kept by no more than the declared `repeatability` are dropped.
+    Such a reading is kept anyway if no reading of the variable was kept for
+    `max_interval` seconds, so that consumers can tell a steady value from a
+    dead sensor. Desired and manual points are never changed.
+
+    :param dict outputs: A dictionary mapping variable names, or tuples of
+    environment IDs and variable names, to dictionaries that can contain the
+    fields "accuracy" and "repeatability" (as in
+    :class:`~openag.models.FirmwareOutput`)
+    :param float max_interval: The maximum number of seconds between kept
+    readings of a variable
+    """
+    def __init__(self, outputs, max_interval=600):
+        self.outputs = outputs
+        self.max_interval = max_interval
+        self._last_kept = {}
+
+    @classmethod
+    def from_modules(cls, modules, module_types, **kwargs):
+        """
+        Creates a filter from the outputs of the firmware modules `modules`
+        (a dictionary mapping module IDs to
+        :class:`~openag.models.FirmwareModule` objects) and their types
+        `module_types` (a dictionary mapping module type IDs to
+        :class:`~openag.models.FirmwareModuleType` objects). If several
+        outputs have the same variable, the smallest accuracy and
+        repeatability are used.
+        """
+        outputs = {}
+        modules = synthesize_firmware_module_info(modules, module_types)
+        for mod_info in modules.values():
+            for output_info in mod_info["outputs"].values():
+                key = output_info["variable"]
+                if "environment" in mod_info:
+                    key = (mod_info["environment"], key)
+                info = outputs.setdefault(key, {})
+                for field in ("accuracy", "repeatability"):
+                    if field in output_info:
+                        info[field] = min(
+                            info.get(field, output_info[field]),
+                            output_info[field]
+                        )
+        return cls(outputs, **kwargs)
+
+    @classmethod
+    def from_server(cls, server, **kwargs):
+        """
+        Creates a filter from the firmware modules stored on the
+        :class:`~openag.couch.Server` `server`
+        """
+        def read_docs(db_name):
+            return index_by_id(
+                row.doc for row in
+                server[db_name].view("_all_docs", include_docs=True)
+                if not row.id.startswith("_")
+            )
+        return cls.from_modules(
+            read_docs(FIRMWARE_MODULE), read_docs(FIRMWARE_MODULE_TYPE),
+            **kwargs
+        )
+
+    def __call__(self, points):
+        """
+        Yields the points in the iterable `points` that should be kept, with
+        their values rounded
+        """
+        for point in points:
+            point = self.process(point)
+            if point is not None:
+                yield point
+
+    def process(self, point):
+        """
+        Returns the point `point` with its value rounded, or None if it should
+        be dropped
+        """
+        value = point.get("value")
+        if point.get("is_desired") or point.get("is_manual") or \
+                isinstance(value, bool) or \
+                not isinstance(value, (int, long, float)):
+            return point
+        info = self.outputs.get(
+            (point["environment"], point["variable"]),
+            self.outputs.get(point["variable"])
+        )
+        if not info:
+            return point
+        accuracy = info.get("accuracy")
+        if accuracy:
+            point = dict(point)
+            point["value"] = round(
+                round(value / float(accuracy)) * accuracy,
+                _decimal_places(accuracy)
+            )
+        key = (point["environment"], point["variable"])
+        last = self._last_kept.get(key)
+        repeatability = info.get("repeatability")
+        if last is not None and repeatability is not None:
+            last_timestamp, last_value = last
+            if abs(point["value"] - last_value) <= repeatability and \
+                    point["timestamp"] - last_timestamp < self.max_interval:
+                return None
+        self._last_kept[key] = (point["timestamp"], point["value"])
+        return point
+
+def _decimal_places(number):
+    """
+    Returns the number of decimal places needed to represent multiples of
+    `number`
+    """
+    digits = repr(float(number))
+    if "e" in digits:
+        mantissa, exponent = digits.split("e")
+        return max(0, _decimal_places(float(mantissa)) - int(exponent))
+    return len(digits.split(".")[1].rstrip("0"))
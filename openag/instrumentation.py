@@ -0,0 +1,201 @@
+"""
+This module consists of code for measuring the requests that
+:class:`~openag.couch.Server` makes to CouchDB. Every request is described by
+a :class:`RequestRecord`, which is passed to the hooks registered with
+:meth:`~openag.couch.Server.add_request_hook`. :class:`RequestStats` is such a
+hook that aggregates the records by method and path template, keeps latency
+histograms and logs slow requests.
+"""
+import bisect
+import threading
+from collections import namedtuple, deque
+from urllib import unquote
+from urlparse import urlsplit
+
+__all__ = [
+    "RequestRecord", "RequestStats", "path_template", "LATENCY_BUCKETS"
+]
+
+# Information about a single request. `path` is the path template from
+# `path_template`, `status` is None if no response was received, `latency` is
+# the number of seconds until the response body was read, `bytes_out` and
+# `bytes_in` are the sizes of the request and response bodies as sent and
+# returned, and `retries` is the number of times the request was retried after
+# a connection error
+RequestRecord = namedtuple("RequestRecord", [
+    "method", "url", "path", "status", "latency", "bytes_out", "bytes_in",
+    "retries"
+])
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")
+)
+
+# Path segments after which the next segment is a name rather than an ID
+_NAMED_SEGMENTS = {
+    "_design": "{ddoc}",
+    "_partition": "{partition}",
+    "_local": "{docid}",
+    "_view": "{view}",
+    "_list": "{list}",
+    "_show": "{show}",
+    "_update": "{update}",
+    "_rewrite": "{path}",
+    "_compact": "{ddoc}",
+    "_index": "{ddoc}"
+}
+
+def path_template(url):
+    """
+    Returns the path of `url` with the names of databases, documents, design
+    documents and views replaced by placeholders, so that requests to the same
+    endpoint can be grouped. For example, the path of a view query becomes
+    "/{db}/_design/{ddoc}/_view/{view}".
+    """
+    segments = [
+        unquote(s) for s in urlsplit(url).path.split("/") if s
+    ]
+    res = []
+    placeholder = None
+    for i, segment in enumerate(segments):
+        if placeholder is not None:
+            res.append(placeholder)
+            # Lists take a view name after their own name
+            placeholder = "{view}" if placeholder == "{list}" else None
+        elif segment.startswith("_"):
+            res.append(segment)
+            placeholder = _NAMED_SEGMENTS.get(segment)
+        elif i == 0:
+            res.append("{db}")
+        else:
+            res.append("{docid}")
+    return "/" + "/".join(res)
+
+class _EndpointStats(object):
+    __slots__ = (
+        "count", "errors", "total_latency", "max_latency", "bytes_out",
+        "bytes_in", "retries", "histogram"
+    )
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retries = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, record):
+        self.count += 1
+        if record.status is None or record.status >= 400:
+            self.errors += 1
+        self.total_latency += record.latency
+        self.max_latency = max(self.max_latency, record.latency)
+        self.bytes_out += record.bytes_out or 0
+        self.bytes_in += record.bytes_in or 0
+        self.retries += record.retries
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, record.latency)] \
+            += 1
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the histogram bucket holding the `p`th
+        percentile of the latencies
+        """
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+class RequestStats(object):
+    """
+    A request hook that aggregates requests by method and path template.
+    Requests that take at least `slow_threshold` seconds (if it is given) are
+    kept in :attr:`slow_requests` (up to `max_slow_requests` of them) and, if
+    `slow_log` is given, written to that file-like object as they happen. It
+    can be shared by threads.
+    """
+    def __init__(
+        self, slow_threshold=None, slow_log=None, max_slow_requests=100
+    ):
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+        self.slow_requests = deque(maxlen=max_slow_requests)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        key = (record.method, record.path)
+        slow = self.slow_threshold is not None and \
+            record.latency >= self.slow_threshold
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = _EndpointStats()
+            stats.add(record)
+            if slow:
+                self.slow_requests.append(record)
+                if self.slow_log is not None:
+                    self.slow_log.write(
+                        "Slow request: {} {} -> {} in {:.3f}s\n".format(
+                            record.method, record.url, record.status,
+                            record.latency
+                        )
+                    )
+
+    def summary(self):
+        """
+        Returns a list with a dictionary of statistics for each method and path
+        template, sorted by the total time spent on them
+        """
+        with self._lock:
+            items = list(self._endpoints.items())
+        res = []
+        for (method, path), stats in items:
+            res.append({
+                "method": method,
+                "path": path,
+                "count": stats.count,
+                "errors": stats.errors,
+                "total_latency": stats.total_latency,
+                "mean_latency": stats.total_latency / stats.count,
+                "max_latency": stats.max_latency,
+                "p50_latency": stats.percentile(50),
+                "p95_latency": stats.percentile(95),
+                "bytes_out": stats.bytes_out,
+                "bytes_in": stats.bytes_in,
+                "retries": stats.retries,
+                "histogram": list(stats.histogram)
+            })
+        res.sort(key=lambda item: item["total_latency"], reverse=True)
+        return res
+
+    def format_summary(self):
+        """ Returns :meth:`summary` as a human-readable table """
+        lines = [
+            "{:<7} {:<40} {:>6} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+                "method", "path", "count", "errors", "total(s)", "mean(s)",
+                "p95(s)", "bytes out", "bytes in"
+            )
+        ]
+        for item in self.summary():
+            lines.append(
+                "{method:<7} {path:<40} {count:>6} {errors:>6} "
+                "{total_latency:>9.3f} {mean_latency:>9.3f} "
+                "{p95_latency:>9.3f} {bytes_out:>10} {bytes_in:>10}".format(
+                    **item
+                )
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        """ Forgets all of the recorded requests """
+        with self._lock:
+            self._endpoints.clear()
+            self.slow_requests.clear()
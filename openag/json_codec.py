@@ -0,0 +1,219 @@
+"""
+This module consists of code for encoding and decoding JSON with the fastest
+library that is installed. Encoding and decoding documents is one of the main
+costs of talking to CouchDB, so everything in :mod:`openag.couch` and the CLI
+that reads or writes JSON goes through the functions in this module rather
+than through :mod:`json` directly. This includes the request bodies and
+responses of :class:`openag.couch.Server`. Other couchdb-python clients in the
+same process keep their own JSON library unless :func:`install` is called.
+
+The libraries in :data:`BACKENDS` are tried in order. ujson is only picked
+automatically from version 2, because earlier versions round floats when
+encoding and decoding them; it can still be selected explicitly with
+:func:`use`. The backend can also be chosen with the environment variable
+``OPENAG_JSON``.
+"""
+import os
+import re
+
+__all__ = [
+    "BACKENDS", "backend", "use", "install", "loads", "dumps", "couch_dumps",
+    "load", "dump", "iter_array"
+]
+
+# Names of the supported JSON libraries, fastest first
+BACKENDS = ("ujson", "simplejson", "json")
+
+_loads = None
+_dumps = None
+_couch_dumps = None
+_backend = None
+
+def _init_ujson(explicit):
+    import ujson
+    if not explicit and \
+            int(getattr(ujson, "__version__", "1").split(".")[0]) < 2:
+        raise ImportError("ujson versions before 2 round floats")
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    def couch_dumps(obj):
+        return ujson.dumps(
+            obj, ensure_ascii=False, escape_forward_slashes=False
+        )
+    return ujson.loads, dumps, couch_dumps
+
+def _init_simplejson(explicit):
+    import simplejson
+    def couch_dumps(obj):
+        return simplejson.dumps(obj, allow_nan=False, ensure_ascii=False)
+    return simplejson.loads, simplejson.dumps, couch_dumps
+
+def _init_json(explicit):
+    import json
+    def couch_dumps(obj):
+        return json.dumps(obj, allow_nan=False, ensure_ascii=False)
+    return json.loads, json.dumps, couch_dumps
+
+_initializers = {
+    "ujson": _init_ujson,
+    "simplejson": _init_simplejson,
+    "json": _init_json
+}
+
+def use(name=None):
+    """
+    Selects the JSON library named `name` (one of :data:`BACKENDS`), or the
+    first one in :data:`BACKENDS` that is installed if `name` is None, and
+    returns its name. Raises an ImportError if the library isn't installed.
+    """
+    global _loads, _dumps, _couch_dumps, _backend
+    if name is not None:
+        if not name in _initializers:
+            raise ValueError('Unsupported JSON library "{}"'.format(name))
+        _loads, _dumps, _couch_dumps = _initializers[name](True)
+        _backend = name
+        return name
+    for name in BACKENDS:
+        try:
+            _loads, _dumps, _couch_dumps = _initializers[name](False)
+        except ImportError:
+            continue
+        _backend = name
+        return name
+
+def backend():
+    """ Returns the name of the JSON library in use """
+    if _backend is None:
+        use(os.environ.get("OPENAG_JSON") or None)
+    return _backend
+
+def loads(s):
+    """ Decodes the JSON string `s` """
+    if _backend is None:
+        backend()
+    return _loads(s)
+
+def dumps(obj):
+    """ Encodes `obj` as a JSON string """
+    if _backend is None:
+        backend()
+    return _dumps(obj)
+
+def load(fp):
+    """ Decodes the JSON document in the file object `fp` """
+    return loads(fp.read())
+
+def dump(obj, fp):
+    """ Encodes `obj` as JSON and writes it to the file object `fp` """
+    fp.write(dumps(obj))
+
+def couch_dumps(obj):
+    """
+    Encodes `obj` as the body of a request to CouchDB, which (like
+    couchdb-python) keeps non-ASCII characters and rejects NaN and infinity
+    """
+    if _backend is None:
+        backend()
+    return _couch_dumps(obj)
+
+def _couch_decode(s):
+    return loads(s)
+
+def install():
+    """
+    Makes couchdb-python encode request bodies and decode responses with the
+    selected library (including libraries selected later with :func:`use`)
+    for every client in the process, not just :class:`openag.couch.Server`.
+    This is never done implicitly.
+    """
+    from couchdb import json as couchdb_json
+    couchdb_json.use(decode=_couch_decode, encode=couch_dumps)
+
+# Characters that change the nesting depth or end an item in an array
+_TOKEN = re.compile(r'[{}\[\]",]')
+# The rest of a string whose opening quote has been read
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+# Separators between the items of an array
+_SEPARATOR = re.compile(r'[\s,]*')
+
+def iter_array(chunks, key):
+    """
+    Yields the decoded items of the array stored under the key `key` in a JSON
+    object that arrives as the iterable of strings `chunks` (such as the
+    "rows" of a CouchDB view response). Each item is decoded as soon as all of
+    it has arrived, so only one item has to be held in memory at a time. The
+    fields of the object after the array are ignored. Raises a ValueError if
+    the chunks end before the array does.
+    """
+    chunks = iter(chunks)
+    start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        match = start.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+    else:
+        return
+    pos = 0
+    item_start = None
+    depth = 0
+    in_string = False
+    while True:
+        while pos < len(buf):
+            if in_string:
+                match = _STRING_END.match(buf, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                in_string = False
+                continue
+            if item_start is None:
+                pos = _SEPARATOR.match(buf, pos).end()
+                if pos == len(buf):
+                    break
+                if buf[pos] == "]":
+                    return
+                item_start = pos
+            match = _TOKEN.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            token = match.group()
+            pos = match.end()
+            if token == '"':
+                in_string = True
+                continue
+            if token in "{[":
+                depth += 1
+                continue
+            if token in "}]":
+                depth -= 1
+                if depth > 0:
+                    continue
+                if depth == 0:
+                    yield loads(buf[item_start:pos])
+                    item_start = None
+                    continue
+            elif depth > 0:
+                continue
+            # A comma or closing bracket ends an item that isn't an object or
+            # array
+            item = buf[item_start:match.start()].strip()
+            if item:
+                yield loads(item)
+            if token == "]":
+                return
+            item_start = None
+            depth = 0
+        # Only keep the part of the buffer that is still needed
+        keep = pos if item_start is None else item_start
+        buf = buf[keep:]
+        pos -= keep
+        if item_start is not None:
+            item_start = 0
+        try:
+            buf += next(chunks)
+        except StopIteration:
+            raise ValueError("Unexpected end of JSON array")
@@ -1,6 +1,7 @@
 __all__ = [
-    "Environment", "EnvironmentalDataPoint", "FirmwareModule",
-    "FirmwareModuleType", "Recipe", "SoftwareModule", "SoftwareModuleType"
+    "Environment", "EnvironmentalDataPoint", "EnvironmentalDataBucket",
+    "FirmwareModule", "FirmwareModuleType", "Recipe", "SoftwareModule",
+    "SoftwareModuleType"
 ]
 
 from .categories import SENSORS, ACTUATORS, CALIBRATION, all_categories
@@ -67,6 +68,78 @@ recipe.
     generated.
 """
 
+EnvironmentalDataBucket = Schema({
+    Required("environment"): Any(str, unicode),
+    Required("variable"): Any(str, unicode),
+    Required("is_desired"): bool,
+    Required("start"): Any(float, int),
+    Required("size"): Any(float, int),
+    Required("timestamps"): Any([Any(float, int)], str, unicode),
+    Required("values"): Any([object], str, unicode),
+    Optional("encoding"): "dod-xor",
+    Optional("version"): int,
+    Optional("latest"): {
+        Required("timestamp"): Any(float, int),
+        Required("value"): object
+    },
+}, extra=REMOVE_EXTRA)
+EnvironmentalDataBucket.__doc__ = """
+An `EnvironmentalDataBucket` stores all of the automatic
+:class:`~openag.models.EnvironmentalDataPoint` instances for a single variable
+in a single `Environment` over a window of time. Storing high-rate series this
+way takes far fewer documents (and far less disk space) than storing each point
+on its own.
+
+.. py:attribute:: environment
+
+    (str, required) The ID of the environment for which these points were
+    measured
+
+.. py:attribute:: variable
+
+    (str, required) The type of measurement or event these points represent
+    (e.g. "air_temperature")
+
+.. py:attribute:: is_desired
+
+    (bool, required) Whether these points represent the desired state of the
+    environment or the measured state of the environment
+
+.. py:attribute:: start
+
+    (float, required) A UNIX timestamp reflecting the start of the window of
+    time covered by this bucket
+
+.. py:attribute:: size
+
+    (float, required) The length of the window of time covered by this bucket
+    (in seconds)
+
+.. py:attribute:: timestamps
+
+    (list, required) The sorted timestamps of the points in this bucket
+
+.. py:attribute:: values
+
+    (list, required) The values of the points in this bucket, in the same
+    order as `timestamps`
+
+.. py:attribute:: encoding
+
+    (str) If set to "dod-xor", `timestamps` and `values` are strings encoded
+    with :func:`openag.codec.encode_series` instead of lists
+
+.. py:attribute:: version
+
+    (int) For encoded buckets, the version of the layout of the encoded
+    strings (see :data:`openag.codec.VERSION`)
+
+.. py:attribute:: latest
+
+    (dict) For encoded buckets, the "timestamp" and "value" of the latest
+    point in the bucket
+"""
+
 Recipe = Schema({
     "name": Any(str, unicode),
     "description": Any(str, unicode),
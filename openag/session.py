@@ -0,0 +1,592 @@
+"""
+This module consists of an HTTP session for :class:`~openag.couch.Server` that
+keeps a bounded client-side cache of responses. CouchDB returns an ETag with
+every document and view response, so a cached response can be revalidated
+with an `If-None-Match` header and served from the cache when the server
+replies "304 Not Modified", instead of being downloaded again.
+
+couchdb-python only caches responses shorter than 8 KiB and keeps at most a
+few dozen of them. :class:`Session` also caches larger (streamed) responses,
+such as view queries, as they are read, and takes the cache to use as an
+argument: a :class:`MemoryCache` or a :class:`DiskCache`, which both evict the
+least recently used responses when they grow past their limits. Responses are
+cached by URL only, so a cache shouldn't be shared by sessions that
+authenticate as different users.
+
+:class:`Session` can also compress traffic with gzip, which shrinks JSON
+documents several times over on slow links such as cellular uplinks to the
+cloud server.
+"""
+import os
+import json
+import zlib
+import errno
+import time
+import hashlib
+import calendar
+import threading
+from Cookie import SimpleCookie, CookieError
+from email.utils import parsedate
+from httplib import HTTPMessage, HTTPResponse
+from StringIO import StringIO
+from collections import OrderedDict
+from couchdb import http
+
+from . import json_codec
+from .instrumentation import RequestRecord, path_template
+
+__all__ = ["Session", "MemoryCache", "DiskCache", "session_cookie"]
+
+# Number of seconds for which CouchDB session cookies last by default, which
+# is assumed for cookies that don't say when they expire
+SESSION_TIMEOUT = 600
+
+def session_cookie(headers, default_lifetime=SESSION_TIMEOUT):
+    """
+    Returns a tuple of the CouchDB session cookie set by the response headers
+    `headers` and the timestamp at which it expires, or None if they don't set
+    one. The expiry is taken from the cookie's "Max-Age" or "Expires"
+    attribute, and is `default_lifetime` seconds from now if it has neither.
+    """
+    try:
+        cookie = SimpleCookie(headers.get("set-cookie") or "")
+    except CookieError:
+        return None
+    morsel = cookie.get("AuthSession")
+    if morsel is None or not morsel.value:
+        return None
+    expires = None
+    try:
+        if morsel["max-age"]:
+            expires = time.time() + int(morsel["max-age"])
+        elif morsel["expires"]:
+            expires = calendar.timegm(parsedate(morsel["expires"]))
+    except (TypeError, ValueError):
+        pass
+    if expires is None:
+        expires = time.time() + default_lifetime
+    return morsel.value, expires
+
+def _request_cookie(headers):
+    """
+    Returns the CouchDB session cookie sent with the request headers
+    `headers`, or None
+    """
+    header = (headers or {}).get("Cookie", "")
+    if header.startswith("AuthSession="):
+        return header[len("AuthSession="):]
+    return None
+
+class MemoryCache(object):
+    """
+    A cache of responses held in memory. When it holds more than
+    `max_entries` responses or more than `max_bytes` bytes of response bodies,
+    the least recently used responses are evicted. It can be shared by
+    threads.
+    """
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, url):
+        return url in self._entries
+
+    def get(self, url):
+        """ Returns the response cached for `url`, or None """
+        with self._lock:
+            response = self._entries.pop(url, None)
+            if response is not None:
+                self._entries[url] = response
+            return response
+
+    def put(self, url, response):
+        """
+        Caches the tuple `response` of the status, headers and body of a
+        response for `url`. Responses larger than the cache itself are ignored.
+        """
+        with self._lock:
+            self.remove(url)
+            size = _body_size(response)
+            if size > self.max_bytes:
+                return
+            self._entries[url] = response
+            self.size += size
+            self._evict()
+
+    def remove(self, url):
+        """ Removes the response cached for `url`, if any """
+        with self._lock:
+            response = self._entries.pop(url, None)
+            if response is not None:
+                self.size -= _body_size(response)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            url, response = self._entries.popitem(last=False)
+            self.size -= _body_size(response)
+
+class DiskCache(object):
+    """
+    A cache of responses stored as files in the folder `path`, so that it
+    survives restarts and can be shared by processes. It has the same limits
+    as :class:`MemoryCache`. Files written by other processes are only picked
+    up when the cache is created.
+    """
+    def __init__(self, path, max_entries=10000, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+        # Rebuild the index from the files, least recently used first
+        files = []
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, url):
+        return _key(url) in self._entries
+
+    def get(self, url):
+        """ Returns the response cached for `url`, or None """
+        key = _key(url)
+        with self._lock:
+            if not key in self._entries:
+                return None
+            filename = os.path.join(self.path, key)
+            try:
+                with open(filename, "rb") as f:
+                    meta = json.loads(f.readline())
+                    body = f.read()
+            except (IOError, ValueError):
+                self.remove(url)
+                return None
+            if meta["url"] != url:
+                return None
+            os.utime(filename, None)
+            self._entries[key] = self._entries.pop(key)
+        headers = HTTPMessage(StringIO("".join(meta["headers"])))
+        return meta["status"], headers, body
+
+    def put(self, url, response):
+        """
+        Caches the tuple `response` of the status, headers and body of a
+        response for `url`. Responses larger than the cache itself are ignored.
+        """
+        status, headers, body = response
+        meta = json.dumps({
+            "url": url, "status": status, "headers": headers.headers
+        })
+        size = len(meta) + 1 + _body_size(response)
+        key = _key(url)
+        filename = os.path.join(self.path, key)
+        with self._lock:
+            self.remove(url)
+            if size > self.max_bytes:
+                return
+            # Write to a temporary file first so readers never see partial
+            # files
+            tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmp_filename, "wb") as f:
+                f.write(meta + "\n")
+                f.write(body or "")
+            os.rename(tmp_filename, filename)
+            self._entries[key] = size
+            self.size += size
+            self._evict()
+
+    def remove(self, url):
+        """ Removes the response cached for `url`, if any """
+        with self._lock:
+            self._remove_key(_key(url))
+
+    def _remove_key(self, key):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            self._remove_key(next(iter(self._entries)))
+
+def _key(url):
+    return hashlib.sha1(url).hexdigest()
+
+def _body_size(response):
+    return len(response[2] or "")
+
+class _CachingBody(object):
+    """
+    Wraps the body of a streamed response and caches the response once all of
+    it has been read, unless it turns out to be larger than `max_bytes`
+    """
+    def __init__(self, body, cache, url, status, headers, max_bytes):
+        self._body = body
+        self._cache = cache
+        self._url = url
+        self._status = status
+        self._headers = headers
+        self._max_bytes = max_bytes
+        self._parts = []
+        self._size = 0
+
+    def read(self, size=None):
+        data = self._body.read(size)
+        if self._parts is not None:
+            self._size += len(data)
+            if self._max_bytes is not None and self._size > self._max_bytes:
+                self._parts = None
+            else:
+                self._parts.append(data)
+                if size is None or len(data) < size:
+                    self._cache.put(
+                        self._url,
+                        (self._status, self._headers, "".join(self._parts))
+                    )
+                    self._parts = None
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
+
+class _GzipResponse(HTTPResponse):
+    """
+    An HTTP response whose body is transparently decompressed if it was sent
+    with "Content-Encoding: gzip"
+    """
+    def begin(self):
+        HTTPResponse.begin(self)
+        self._decompressor = None
+        self._buffer = ""
+        if (self.getheader("content-encoding") or "").lower() == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, amt=None):
+        if self._decompressor is None:
+            return HTTPResponse.read(self, amt)
+        while amt is None or len(self._buffer) < amt:
+            data = HTTPResponse.read(self, amt and http.CHUNK_SIZE)
+            if not data:
+                self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(data)
+        if amt is None:
+            res, self._buffer = self._buffer, ""
+        else:
+            res, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return res
+
+class _GzipConnectionPool(http.ConnectionPool):
+    """ A connection pool whose connections decompress gzipped responses """
+    def get(self, url):
+        conn = super(_GzipConnectionPool, self).get(url)
+        conn.response_class = _GzipResponse
+        return conn
+
+def _gzip(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class _MeasuredBody(object):
+    """
+    Wraps the body of a streamed response and calls `callback` with the
+    number of bytes read once all of it has been read or it is closed
+    """
+    def __init__(self, body, callback):
+        self._body = body
+        self._callback = callback
+        self._size = 0
+
+    def read(self, size=None):
+        data = self._body.read(size)
+        self._size += len(data)
+        if size is None or len(data) < size:
+            self._finish()
+        return data
+
+    def close(self):
+        self._body.close()
+        self._finish()
+
+    def _finish(self):
+        if self._callback is not None:
+            callback, self._callback = self._callback, None
+            callback(self._size)
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
+
+class _RetryDelays(list):
+    """
+    The delays before retrying failed requests, which counts the retries made
+    by the current thread in `counter`. couchdb-python iterates over the
+    delays once per request and takes one delay for each retry.
+    """
+    def __init__(self, delays, counter):
+        super(_RetryDelays, self).__init__(delays)
+        self._counter = counter
+
+    def __iter__(self):
+        for delay in super(_RetryDelays, self).__iter__():
+            self._counter.count = getattr(self._counter, "count", 0) + 1
+            yield delay
+
+# HTTP statuses of the errors couchdb-python raises for error responses
+_ERROR_STATUSES = (
+    (http.Unauthorized, 401),
+    (http.Forbidden, 403),
+    (http.ResourceNotFound, 404),
+    (http.ResourceConflict, 409),
+    (http.PreconditionFailed, 412)
+)
+
+def _error_status(e):
+    """
+    Returns the HTTP status of the response for which the exception `e` was
+    raised, or None if it wasn't raised for a response
+    """
+    for cls, status in _ERROR_STATUSES:
+        if isinstance(e, cls):
+            return status
+    if isinstance(e, http.ServerError):
+        try:
+            return int(e.args[0][0])
+        except (IndexError, TypeError, ValueError):
+            return 500
+    return None
+
+class Session(http.Session):
+    """
+    An HTTP session that caches responses in `cache` (such as a
+    :class:`MemoryCache` or a :class:`DiskCache`, or None for the default
+    cache of couchdb-python). Streamed responses are only cached if the cache
+    has a `max_bytes` limit, so that they aren't held in memory otherwise. If
+    `compress` is true, gzipped responses are requested with an
+    "Accept-Encoding" header, and request bodies of at least
+    `compress_min_size` bytes (such as bulk uploads) are sent gzipped. Hooks
+    added with :meth:`add_request_hook` are called with a
+    :class:`~openag.instrumentation.RequestRecord` for every request.
+
+    The session also keeps track of CouchDB session cookies. When the server
+    refreshes a session cookie, or a session is renewed because the server
+    rejected its cookie (see :meth:`add_session_renewal`), later requests
+    that send the old cookie send the new one instead. Other keyword
+    arguments are passed to :class:`couchdb.http.Session`.
+    """
+    def __init__(
+        self, cache=None, compress=False, compress_min_size=1024, **kwargs
+    ):
+        super(Session, self).__init__(**kwargs)
+        if cache is not None:
+            self.cache = cache
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.request_hooks = []
+        # Maps session cookies to tuples of the cookies that replaced them and
+        # their expiries, and to the callables that renew them
+        self._cookies = {}
+        self._renewals = {}
+        self._cookie_lock = threading.RLock()
+        self._retries = threading.local()
+        self.retry_delays = _RetryDelays(self.retry_delays, self._retries)
+        self.connection_pool = _GzipConnectionPool(
+            self._timeout,
+            disable_ssl_verification=self._disable_ssl_verification
+        )
+
+    def disable_ssl_verification(self):
+        super(Session, self).disable_ssl_verification()
+        self.connection_pool = _GzipConnectionPool(
+            self._timeout,
+            disable_ssl_verification=self._disable_ssl_verification
+        )
+
+    def add_request_hook(self, hook):
+        """
+        Registers the callable `hook` to be called with a
+        :class:`~openag.instrumentation.RequestRecord` after every request
+        """
+        self.request_hooks.append(hook)
+
+    def remove_request_hook(self, hook):
+        """ Unregisters a hook registered with :meth:`add_request_hook` """
+        self.request_hooks.remove(hook)
+
+    def add_session_renewal(self, cookie, renew):
+        """
+        Registers the callable `renew` to be called when the server rejects a
+        request authenticated with the session cookie `cookie` (or a cookie
+        that replaced it). It should log in again and return a tuple of the new
+        session cookie and its expiry, after which the request is retried
+        with the new cookie.
+        """
+        with self._cookie_lock:
+            self._renewals[cookie] = renew
+
+    def latest_session(self, cookie):
+        """
+        Returns a tuple of the session cookie that has replaced the session
+        cookie `cookie` and its expiry, or None if it hasn't been replaced
+        """
+        with self._cookie_lock:
+            return self._latest_session(cookie)
+
+    def _latest_session(self, cookie):
+        res = None
+        while cookie in self._cookies:
+            res = self._cookies[cookie]
+            cookie = res[0]
+        return res
+
+    def _replace_cookie(self, old, new, expires):
+        # Must be called with the lock held
+        if new == old:
+            return
+        self._cookies[old] = (new, expires)
+        if old in self._renewals:
+            self._renewals.setdefault(new, self._renewals[old])
+
+    def _renew_session(self, cookie):
+        """
+        Renews the session of the rejected cookie `cookie` and returns the new
+        cookie, or returns None if it can't be renewed
+        """
+        with self._cookie_lock:
+            latest = self._latest_session(cookie)
+            if latest is not None:
+                # Another thread has already replaced the cookie
+                return latest[0]
+            renew = self._renewals.get(cookie)
+            if renew is None:
+                return None
+            new_cookie, expires = renew()
+            self._replace_cookie(cookie, new_cookie, expires)
+            return new_cookie
+
+    def request(
+        self, method, url, body=None, headers=None, *args, **kwargs
+    ):
+        if body is not None and not isinstance(body, basestring) and \
+                not hasattr(body, "read"):
+            # Encode the body here (instead of leaving it to couchdb-python)
+            # so that it is encoded with the library selected in
+            # openag.json_codec, and can be measured and compressed
+            headers = dict(headers or {})
+            headers.setdefault("Content-Type", "application/json")
+            body = json_codec.couch_dumps(body)
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        if self.compress:
+            headers, body = self._compress(method, url, body, headers)
+        if not self.request_hooks:
+            return self._request(method, url, body, headers, *args, **kwargs)
+        bytes_out = len(body) if isinstance(body, basestring) else None
+        self._retries.count = 0
+        start = time.time()
+        def emit(status, bytes_in, retries):
+            record = RequestRecord(
+                method.upper(), url, path_template(url), status,
+                time.time() - start, bytes_out, bytes_in, retries
+            )
+            for hook in list(self.request_hooks):
+                hook(record)
+        try:
+            status, res_headers, res_body = self._request(
+                method, url, body, headers, *args, **kwargs
+            )
+        except Exception as e:
+            emit(_error_status(e), None, self._retries.count)
+            raise
+        # Other requests may be made before a streamed body has been read
+        retries = self._retries.count
+        if isinstance(res_body, (http.ResponseBody, _CachingBody)):
+            res_body = _MeasuredBody(
+                res_body, lambda n: emit(status, n, retries)
+            )
+        else:
+            emit(status, len(res_body.getvalue()) if res_body else 0, retries)
+        return status, res_headers, res_body
+
+    def _request(self, method, url, body=None, headers=None, *args, **kwargs):
+        cookie = _request_cookie(headers)
+        if cookie is not None:
+            latest = self.latest_session(cookie)
+            if latest is not None:
+                cookie = latest[0]
+                headers = dict(headers, Cookie="AuthSession=" + cookie)
+        try:
+            status, res_headers, res_body = super(Session, self).request(
+                method, url, body, headers, *args, **kwargs
+            )
+        except http.Unauthorized:
+            # Bodies that are read from files can't be sent again
+            if cookie is None or hasattr(body, "read"):
+                raise
+            new_cookie = self._renew_session(cookie)
+            if new_cookie is None or new_cookie == cookie:
+                raise
+            cookie = new_cookie
+            headers = dict(headers, Cookie="AuthSession=" + cookie)
+            status, res_headers, res_body = super(Session, self).request(
+                method, url, body, headers, *args, **kwargs
+            )
+        if cookie is not None and "set-cookie" in res_headers:
+            refreshed = session_cookie(res_headers)
+            if refreshed is not None:
+                with self._cookie_lock:
+                    self._replace_cookie(cookie, *refreshed)
+        # couchdb-python only caches responses that it buffers itself.
+        # Streamed responses are only buffered for caches that bound their
+        # size, since they can be arbitrarily large
+        max_bytes = getattr(self.cache, "max_bytes", None)
+        if max_bytes and method.upper() == "GET" and status == 200 and \
+                isinstance(res_body, http.ResponseBody) and \
+                "etag" in res_headers:
+            res_body = _CachingBody(
+                res_body, self.cache, url, status, res_headers, max_bytes
+            )
+        return status, res_headers, res_body
+
+    def _compress(self, method, url, body, headers):
+        """
+        Returns the headers and body with which to send a request with
+        compression
+        """
+        headers = dict(headers or {})
+        # Continuous feeds are read line by line from the raw socket, so they
+        # can't be decompressed
+        if not "feed=continuous" in url:
+            headers["Accept-Encoding"] = "gzip"
+        if method.upper() in ("POST", "PUT") and body is not None and \
+                not hasattr(body, "read"):
+            if len(body) >= self.compress_min_size:
+                body = _gzip(body)
+                headers["Content-Encoding"] = "gzip"
+        return headers, body
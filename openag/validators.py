@@ -0,0 +1,224 @@
+"""
+This module consists of code for validating documents against the voluptuous
+schemas in :mod:`openag.models` quickly. Voluptuous interprets a schema every
+time it is called, which dominates the cost of bulk operations such as
+ingesting data points. :func:`compile_schema` turns a schema into a plain
+Python function that does the same checks and returns the same result
+(including defaults and the removal of extra keys) with much less overhead.
+
+Compiled validators only decide whether a document is valid. When a document
+is invalid, it is passed to the original schema, so the errors raised are
+exactly the ones voluptuous would raise.
+"""
+import inspect
+from voluptuous import (
+    Schema, Any, Extra, Marker, Required, MultipleInvalid, Invalid,
+    PREVENT_EXTRA, ALLOW_EXTRA
+)
+try:
+    from voluptuous.schema_builder import UNDEFINED
+except ImportError:
+    from voluptuous import UNDEFINED
+
+__all__ = ["compile_schema", "get_validator", "validate_batch"]
+
+# Before voluptuous 0.10, `Any` was a function rather than a class
+_ANY_TYPE = Any if inspect.isclass(Any) else None
+
+class _Invalid(Exception):
+    """ Raised by compiled validators for data that doesn't match """
+
+class _Unsupported(Exception):
+    """ Raised for parts of a schema that can't be compiled """
+
+def compile_schema(schema):
+    """
+    Returns a function that validates data against the voluptuous schema
+    `schema` (a :class:`voluptuous.Schema` or anything that can be passed to
+    one) and returns the validated data, like calling the schema would
+    """
+    if not isinstance(schema, Schema):
+        schema = Schema(schema)
+    fast = _compile(schema.schema, schema.extra)
+    def validate(data):
+        try:
+            return fast(data)
+        except _Invalid:
+            # Let voluptuous produce the error
+            return schema(data)
+    validate.schema = schema
+    return validate
+
+_validators = {}
+
+def get_validator(schema):
+    """
+    Returns a compiled validator for the schema `schema`, compiling it on the
+    first call for each schema
+    """
+    key = id(schema)
+    if not key in _validators:
+        _validators[key] = (schema, compile_schema(schema))
+    return _validators[key][1]
+
+def validate_batch(schema, items, errors=None):
+    """
+    Validates every document in the iterable `items` against the schema
+    `schema` and returns a list of the validated documents. If `errors` is
+    None, the first invalid document raises a
+    :class:`voluptuous.MultipleInvalid` whose path starts with the index of the
+    document. Otherwise, invalid documents are skipped and a tuple of the index
+    of each one and its error is appended to the list `errors`.
+    """
+    validate = get_validator(schema)
+    res = []
+    for i, item in enumerate(items):
+        try:
+            res.append(validate(item))
+        except MultipleInvalid as e:
+            e.prepend([i])
+            if errors is None:
+                raise
+            errors.append((i, e))
+    return res
+
+def _compile(node, extra):
+    """
+    Returns a function that validates data against the schema node `node`
+    (with the extra key behavior `extra` for dictionaries) and raises
+    `_Invalid` if it doesn't match
+    """
+    try:
+        if isinstance(node, Schema):
+            return _compile(node.schema, node.extra)
+        if _ANY_TYPE is not None and isinstance(node, _ANY_TYPE):
+            return _compile_any(node)
+        if isinstance(node, dict):
+            return _compile_dict(node, extra)
+        if isinstance(node, list):
+            return _compile_list(node, extra)
+    except _Unsupported:
+        return _compile_fallback(node, extra)
+    if node is object:
+        return lambda data: data
+    if inspect.isclass(node):
+        def validate_type(data):
+            if not isinstance(data, node):
+                raise _Invalid()
+            return data
+        return validate_type
+    if callable(node):
+        return _compile_fallback(node, extra)
+    def validate_literal(data):
+        if data != node:
+            raise _Invalid()
+        return data
+    return validate_literal
+
+def _compile_fallback(node, extra):
+    """ Validates data against `node` with voluptuous itself """
+    schema = Schema(node, extra=extra)
+    def validate(data):
+        try:
+            return schema(data)
+        except Invalid:
+            raise _Invalid()
+    return validate
+
+def _compile_any(node):
+    validators = node.validators
+    if validators and all(inspect.isclass(v) for v in validators):
+        types = tuple(validators)
+        def validate_types(data):
+            if not isinstance(data, types):
+                raise _Invalid()
+            return data
+        return validate_types
+    # `Any` validates against each alternative as a separate schema
+    compiled = [_compile(v, PREVENT_EXTRA) for v in validators]
+    def validate_any(data):
+        for validate in compiled:
+            try:
+                return validate(data)
+            except _Invalid:
+                pass
+        raise _Invalid()
+    return validate_any
+
+def _compile_dict(node, extra):
+    fields = {}
+    defaults = []
+    required = []
+    extra_validator = None
+    for key, value in node.items():
+        if key is Extra:
+            extra_validator = _compile(value, extra)
+            continue
+        name = key.schema if isinstance(key, Marker) else key
+        if not isinstance(name, basestring):
+            raise _Unsupported()
+        fields[name] = _compile(value, extra)
+        default = getattr(key, "default", UNDEFINED)
+        if default is not UNDEFINED:
+            defaults.append((name, default))
+        elif isinstance(key, Required):
+            required.append(name)
+    def validate_dict(data):
+        if not isinstance(data, dict):
+            raise _Invalid()
+        out = {}
+        for key, value in data.iteritems():
+            validate = fields.get(key)
+            if validate is not None:
+                out[key] = validate(value)
+            elif extra_validator is not None:
+                out[key] = extra_validator(value)
+            elif extra == ALLOW_EXTRA:
+                out[key] = value
+            elif extra == PREVENT_EXTRA:
+                raise _Invalid()
+        for name, default in defaults:
+            if not name in out:
+                out[name] = default() if callable(default) else default
+        for name in required:
+            if not name in out:
+                raise _Invalid()
+        return out
+    return validate_dict
+
+def _compile_list(node, extra):
+    if not node:
+        raise _Unsupported()
+    if all(isinstance(v, basestring) for v in node):
+        choices = frozenset(node)
+        def validate_choices(data):
+            if not isinstance(data, list):
+                raise _Invalid()
+            for value in data:
+                if not isinstance(value, basestring) or not value in choices:
+                    raise _Invalid()
+            return list(data)
+        return validate_choices
+    compiled = [_compile(v, extra) for v in node]
+    if len(compiled) == 1:
+        validate_item = compiled[0]
+        def validate_list(data):
+            if not isinstance(data, list):
+                raise _Invalid()
+            return [validate_item(value) for value in data]
+        return validate_list
+    def validate_alternatives(data):
+        if not isinstance(data, list):
+            raise _Invalid()
+        out = []
+        for value in data:
+            for validate in compiled:
+                try:
+                    out.append(validate(value))
+                    break
+                except _Invalid:
+                    pass
+            else:
+                raise _Invalid()
+        return out
+    return validate_alternatives
@@ -1,5 +1,15 @@
+import json
+import hashlib
+from array import array
+
 class EnvVar:
     items = {}
+    # All variables in the order in which they were defined. The position of
+    # a variable in this list is its code in the variable dictionary, so new
+    # variables must only ever be added at the end of this file.
+    ordered = []
+    # Maps group names to the lists of variables in those groups
+    by_group = {}
 
     def __init__(self, name, description, units=None, groups=None):
         self.name = name
@@ -9,10 +19,116 @@ class EnvVar:
         # Assign one or more groups to this environmental variable.
         # Can be used to create collections of related variables.
         self.groups = groups or []
+        self.code = len(self.ordered)
+        self.ordered.append(self)
+        for group in self.groups:
+            self.by_group.setdefault(group, []).append(self)
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def in_group(cls, group):
+        """ Returns the list of variables in the group `group` """
+        return list(cls.by_group.get(group, []))
+
+class VariableDictionary(object):
+    """
+    Maps variable names to small integer codes, so that series of data points
+    can store a code instead of repeating the name of their variable. Codes
+    are only ever added, never changed, so a dictionary can decode anything
+    encoded with a dictionary whose codes are a prefix of its own (see
+    :meth:`extends`).
+
+    The codes are used by in-memory batches of data points
+    (:class:`~openag.data_points.DataPointBatch`). Bucket documents and CSV
+    exports keep variable names: a bucket holds a single variable, so a code
+    would only save a few bytes per bucket, and the views of the bucket
+    database and readers of the exports use the names.
+
+    :param list names: The variable names in the order of their codes
+    :param dict groups: A dictionary mapping group names to lists of the
+    names of the variables in each group
+    """
+    def __init__(self, names, groups=None):
+        self.names = list(names)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+        self.groups = {
+            group: frozenset(names) for group, names in (groups or {}).items()
+        }
+        self._group_codes = {
+            group: frozenset(self.codes[name] for name in names)
+            for group, names in self.groups.items()
+        }
+        # A digest of the codes and groups, so any change to either of them
+        # (and only a change) gives the dictionary a new version
+        content = json.dumps([self.names, sorted(
+            (group, sorted(names)) for group, names in self.groups.items()
+        )])
+        self.version = hashlib.sha1(content).hexdigest()[:16]
+
+    @classmethod
+    def from_env_vars(cls):
+        """
+        Creates the dictionary of the variables defined by :class:`EnvVar`
+        """
+        return cls(
+            [var.name for var in EnvVar.ordered],
+            {
+                group: [var.name for var in variables]
+                for group, variables in EnvVar.by_group.items()
+            }
+        )
+
+    @classmethod
+    def from_doc(cls, doc):
+        """ Creates a dictionary from a document returned by :meth:`to_doc` """
+        return cls(doc["variables"], doc.get("groups"))
+
+    def to_doc(self):
+        """ Returns the dictionary as a JSON-serializable document """
+        return {
+            "version": self.version,
+            "variables": self.names,
+            "groups": {
+                group: sorted(names, key=self.codes.get)
+                for group, names in self.groups.items()
+            }
+        }
+
+    def extends(self, other):
+        """
+        Returns True if this dictionary gives every variable in the dictionary
+        `other` the same code as `other` does
+        """
+        return self.names[:len(other.names)] == other.names
+
+    def code(self, name):
+        """ Returns the code of the variable `name` """
+        return self.codes[name]
+
+    def name(self, code):
+        """ Returns the name of the variable with the code `code` """
+        return self.names[code]
+
+    def encode(self, names):
+        """ Returns an array of the codes of the variables `names` """
+        codes = self.codes
+        return array("H", [codes[name] for name in names])
+
+    def decode(self, codes):
+        """ Returns a list of the names of the variables with codes `codes` """
+        names = self.names
+        return [names[code] for code in codes]
+
+    def group(self, group):
+        """ Returns the set of names of the variables in the group `group` """
+        return self.groups.get(group, frozenset())
+
+    def group_codes(self, group):
+        """ Returns the set of codes of the variables in the group `group` """
+        return self._group_codes.get(group, frozenset())
+
 GROUP_ENVIRONMENT = "environment"
 GROUP_USER = "user"
 GROUP_RECIPE = "recipe"
@@ -118,3 +234,7 @@ FRONTAL_IMAGE = EnvVar(
     units="png",
     groups=[GROUP_CAMERA]
 )
+
+# The dictionary of all of the variables above. Keep this at the end of the
+# file.
+VARIABLE_DICTIONARY = VariableDictionary.from_env_vars()
@@ -1,4 +1,5 @@
 from functools import wraps
+from contextlib import contextmanager
 
 from openag.cli.config import Config
 
@@ -14,19 +15,25 @@ def mock_config(new_config):
         return new_config[key]
     def new__setitem__(self, key, val):
         new_config[key] = val
+    @contextmanager
+    def new_transaction(self):
+        yield self
 
     def wrapper(f):
         @wraps(f)
         def inner(*args):
             old__getitem__ = Config.__getitem__
             old__setitem__ = Config.__setitem__
+            old_transaction = Config.transaction
             Config.__getitem__ = new__getitem__
             Config.__setitem__ = new__setitem__
+            Config.transaction = new_transaction
 
             res = f(new_config, *args)
 
             Config.__getitem__ = old__getitem__
             Config.__setitem__ = old__setitem__
+            Config.transaction = old_transaction
 
             return res
         return inner
@@ -1,7 +1,12 @@
 """
 Tests the dictionary abstraction of the persistent global configuration
 """
+import os
+import json
+import mock
+import shutil
 import tempfile
+import threading
 
 from openag.cli.config import Config
 
@@ -10,6 +15,9 @@ def test_config():
         config = Config(f.name)
         config["test"]["test"] = "test"
         assert config._data == {"test": {"test": "test"}}
+        # Nested objects compare equal to the data they wrap
+        assert config["test"] == {"test": "test"}
+        assert not config["test"] != {"test": "test"}
         del config["test"]["test"]
         assert config._data == {}
         assert not config["test2"]
@@ -17,3 +25,78 @@ def test_config():
         config["test"] = "test"
         assert list(config) == ["test"]
         assert list(config.items()) == [("test", "test")]
+
+def test_transaction():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "config.json")
+        config = Config(filename)
+        with mock.patch.object(config, "_write", wraps=config._write) as write:
+            with config.transaction():
+                config["a"]["b"] = 1
+                config["a"]["c"] = 2
+                with config.transaction():
+                    config["d"] = 3
+                assert not os.path.exists(filename)
+            assert write.call_count == 1
+        with open(filename) as f:
+            assert json.load(f) == {"a": {"b": 1, "c": 2}, "d": 3}
+
+        # Changes are discarded if the transaction fails
+        try:
+            with config.transaction():
+                config["d"] = 4
+                raise ValueError()
+        except ValueError:
+            pass
+        assert config["d"] == 3
+
+        # Changes made by other processes are picked up
+        other = Config(filename)
+        other["d"] = 5
+        assert config["d"] == 5
+        with mock.patch.object(config, "_load") as load:
+            assert config["d"] == 5
+            assert not load.called
+        # The write is atomic, so no temporary files are left behind
+        assert sorted(os.listdir(tmp_dir)) == \
+            ["config.json", "config.json.lock"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_concurrent_transactions():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "config.json")
+        def increment():
+            config = Config(filename)
+            for _ in range(20):
+                with config.transaction():
+                    config["count"] = config.get("count", 0) + 1
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert Config(filename)["count"] == 80
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_concurrent_writes():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "config.json")
+        config = Config(filename)
+        other = Config(filename)
+        config["a"]["b"] = 1
+        cloud_server = other["cloud_server"]
+        config["a"]["c"] = 2
+        # Writes outside of a transaction reload the file first, so they don't
+        # drop the changes made by others in the meantime
+        cloud_server["url"] = "http://test.test:5984"
+        del config["a"]["b"]
+        assert Config(filename)._data == {
+            "a": {"c": 2}, "cloud_server": {"url": "http://test.test:5984"}
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
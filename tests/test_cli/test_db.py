@@ -1,6 +1,7 @@
 """
 Tests interactions with the local database
 """
+import os
 import json
 import mock
 import httpretty
@@ -10,8 +11,8 @@ from click.testing import CliRunner
 from tests import mock_config
 
 from openag.couch import Server
-from openag.db_names import all_dbs
-from openag.cli.db import init, load_fixture, show
+from openag.db_names import all_dbs, ENVIRONMENTAL_DATA_BUCKET
+from openag.cli.db import init, load_fixture, show, retention
 
 @mock_config({
     "local_server": {
@@ -71,14 +72,13 @@ def test_init_without_cloud_server(
         "farm_name": "test"
     }
 })
-@mock.patch("openag.cli.utils.replicate_per_farm_dbs")
-@mock.patch("openag.cli.utils.replicate_global_dbs")
+@mock.patch("openag.cli.utils.replicate_all_dbs")
 @mock.patch("openag.cli.db.generate_config")
 @mock.patch.object(Server, "get_or_create")
 @mock.patch.object(Server, "push_design_documents")
 def test_init_with_cloud_server(
     config, push_design_documents, get_or_create, generate_config,
-    replicate_global_dbs, replicate_per_farm_dbs
+    replicate_all_dbs
 ):
     runner = CliRunner()
 
@@ -88,8 +88,38 @@ def test_init_with_cloud_server(
     res = runner.invoke(init)
     assert res.exit_code == 0, res.exception or res.output
     assert push_design_documents.call_count == 1
-    assert replicate_global_dbs.call_count == 1
-    assert replicate_per_farm_dbs.call_count == 1
+    assert replicate_all_dbs.call_count == 1
+
+@mock_config({
+    "local_server": {
+        "url": None
+    },
+    "cloud_server": {
+        "url": None
+    }
+})
+@mock.patch("openag.cli.db.generate_config")
+@mock.patch.object(Server, "get_or_create")
+@mock.patch.object(Server, "push_design_documents")
+def test_init_with_bucket_storage(
+    config, push_design_documents, get_or_create, generate_config
+):
+    runner = CliRunner()
+    generate_config.return_value = {}
+
+    # The bucket database is only created when bucket storage is turned on
+    res = runner.invoke(init)
+    assert res.exit_code == 0, res.exception or res.output
+    created = [args[0][0] for args in get_or_create.call_args_list]
+    assert not ENVIRONMENTAL_DATA_BUCKET in created
+    assert not config["local_server"].get("bucket_storage")
+
+    get_or_create.reset_mock()
+    res = runner.invoke(init, ["--bucket_storage"])
+    assert res.exit_code == 0, res.exception or res.output
+    created = [args[0][0] for args in get_or_create.call_args_list]
+    assert set(created) == all_dbs | {ENVIRONMENTAL_DATA_BUCKET}
+    assert config["local_server"]["bucket_storage"]
 
 @mock_config({
     "local_server": {
@@ -109,6 +139,9 @@ def test_load_fixture_without_local_server(config):
 @mock_config({
     "local_server": {
         "url": "http://localhost:5984"
+    },
+    "cloud_server": {
+        "url": None
     }
 })
 @httpretty.activate
@@ -176,3 +209,45 @@ def test_load_fixture_with_local_server(config):
 
         res = runner.invoke(load_fixture, ["fixture.json"])
         assert res.exit_code == 0, res.exception or res.output
+
+@mock_config({
+    "local_server": {
+        "url": "http://localhost:5984",
+        "retention": {"policies": {"air_temperature": 30}}
+    }
+})
+@mock.patch.object(Server, "compact")
+@mock.patch.object(Server, "archive_expired_data_points")
+@mock.patch.object(Server, "list_shards")
+def test_retention(config, list_shards, archive_expired_data_points, compact):
+    runner = CliRunner()
+    list_shards.return_value = ["environmental_data_point_2016_10"]
+    archive_expired_data_points.side_effect = [5, 0]
+    compact.return_value = 2000000
+
+    with runner.isolated_filesystem():
+        # Should use the stored policies and only compact databases from which
+        # points were purged
+        res = runner.invoke(retention, ["--archive_dir", "archive"])
+        assert res.exit_code == 0, res.exception or res.output
+        assert archive_expired_data_points.call_args_list[0][0][0] == {
+            "air_temperature": 30
+        }
+        compact.assert_called_once_with("environmental_data_point")
+        assert "2.0 MB" in res.output
+        assert len(os.listdir("archive")) == 1
+
+        # Policies given on the command line should override the stored ones
+        archive_expired_data_points.reset_mock()
+        archive_expired_data_points.side_effect = [0, 0]
+        res = runner.invoke(retention, [
+            "--archive_dir", "archive", "-p", "water_temperature=7",
+            "--default_days", "365"
+        ])
+        assert res.exit_code == 0, res.exception or res.output
+        args, kwargs = archive_expired_data_points.call_args
+        assert args[0] == {"water_temperature": 7}
+        assert kwargs["default"] == 365
+
+        res = runner.invoke(retention, ["-p", "air_temperature"])
+        assert res.exit_code, res.output
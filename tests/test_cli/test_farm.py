@@ -11,7 +11,9 @@ from tests import mock_config
 
 from openag.couch import Server
 from openag.db_names import per_farm_dbs
-from openag.cli.cloud import create_farm, list_farms, init_farm, deinit_farm
+from openag.cli.cloud import (
+    create_farm, list_farms, init_farm, deinit_farm, push_farm
+)
 
 @mock_config({
     "cloud_server": {
@@ -85,7 +87,9 @@ def test_farm_with_only_cloud_server(config):
     global current_farms
     current_farms = []
     httpretty.register_uri(
-        httpretty.GET, "http://test.test:5984/_session"
+        httpretty.POST, "http://test.test:5984/_session",
+        content_type="application/json", body='{"ok": true}',
+        set_cookie="AuthSession=test; Version=1; Path=/"
     )
     httpretty.register_uri(
         httpretty.HEAD, "http://test.test:5984/_users"
@@ -165,3 +169,30 @@ def test_farm_with_cloud_and_local_server(
     res = runner.invoke(deinit_farm)
     assert res.exit_code == 0, res.exception or res.output
     assert cancel_per_farm_db_replication.call_count == 1
+
+@mock_config({
+    "cloud_server": {
+        "url": "http://test.test:5984",
+        "username": "test",
+        "password": "test",
+        "farm_name": u"f\xe9rme",
+        "push_interval": 15
+    },
+    "local_server": {
+        "url": "http://localhost:5984"
+    }
+})
+@mock.patch("time.sleep")
+@mock.patch("openag.cli.utils.push_per_farm_dbs")
+def test_push_farm_loop(config, push_per_farm_dbs, sleep):
+    stats = {"docs_written": 1, "duration": 1, "docs_per_second": 1}
+    # A failed push shouldn't stop the loop
+    push_per_farm_dbs.side_effect = [
+        RuntimeError("Network is unreachable"), stats, KeyboardInterrupt()
+    ]
+    runner = CliRunner()
+    res = runner.invoke(push_farm, ["--loop"])
+    assert push_per_farm_dbs.call_count == 3
+    assert sleep.call_count == 3
+    assert "Push failed: Network is unreachable" in res.output
+    assert "Pushed 1 documents" in res.output
@@ -0,0 +1,77 @@
+"""
+Tests the options of the top-level `openag` command
+"""
+import os
+import sys
+import pstats
+import shutil
+import tempfile
+import subprocess
+
+from click.testing import CliRunner
+
+from tests import mock_config
+
+from openag.cli import main, timings
+
+def test_phases():
+    timings.reset()
+    with timings.phase("outer"):
+        with timings.phase("inner"):
+            pass
+    phases = timings.get_phases()
+    assert [(depth, name) for depth, name, _ in phases] == \
+        [(0, "outer"), (1, "inner")]
+    assert phases[0][2] >= phases[1][2] >= 0
+    table = timings.format_phases(1)
+    assert "outer" in table and "  inner" in table and "total" in table
+
+@mock_config({
+    "local_server": {
+        "url": "http://localhost:5984"
+    }
+})
+def test_profile_and_timings(config):
+    runner = CliRunner()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        profile_file = os.path.join(tmp_dir, "openag.prof")
+        res = runner.invoke(main, [
+            "--profile", "--profile_file", profile_file, "--timings", "db",
+            "show"
+        ])
+        assert res.exit_code == 0, res.exception or res.output
+        assert 'Using local server at "http://localhost:5984"' in res.output
+        # The sorted statistics and the timings are printed
+        assert "function calls" in res.output
+        assert "total" in res.output
+        assert pstats.Stats(profile_file).total_calls > 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+# Modules that `openag db show` should not have to import
+HEAVY_MODULES = ("couchdb", "requests", "voluptuous", "yaml", "openag.models")
+
+def test_lazy_subcommands():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ, HOME=tmp_dir, XDG_CONFIG_HOME=tmp_dir)
+        script = (
+            "import sys\n"
+            "from openag.cli import main\n"
+            "try:\n"
+            "    main(['db', 'show'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "loaded = [m for m in {!r} if m in sys.modules]\n"
+            "print('loaded: ' + ' '.join(loaded))\n"
+        ).format(HEAVY_MODULES)
+        output = subprocess.check_output(
+            [sys.executable, "-c", script], env=env, stderr=subprocess.STDOUT
+        )
+        assert output.splitlines()[-1].strip() == "loaded:", output
+    finally:
+        shutil.rmtree(tmp_dir)
+    # The subcommands are still listed and loaded on demand
+    assert main.list_commands(None) == ["cloud", "db", "firmware"]
+    assert main.get_command(None, "db").name == "db"
@@ -61,7 +61,9 @@ def test_user_with_cloud_server(config):
 
     # Login -- Should work
     httpretty.register_uri(
-        httpretty.GET, "http://test.test:5984/_session"
+        httpretty.POST, "http://test.test:5984/_session",
+        content_type="application/json", body='{"ok": true}',
+        set_cookie="AuthSession=test; Version=1; Path=/"
     )
     res = runner.invoke(login, input="test\ntest\n")
     assert res.exit_code == 0, res.exception or res.output
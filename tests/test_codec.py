@@ -0,0 +1,54 @@
+import json
+
+from openag.codec import (
+    DOD_XOR, encode_series, decode_series, encode_timestamps,
+    decode_timestamps, encode_values, decode_values, round_timestamp
+)
+
+def test_timestamps():
+    timestamps = [1476900000, 1476900001, 1476900002.5, 1476899000.125]
+    assert decode_timestamps(encode_timestamps(timestamps)) == timestamps
+    assert decode_timestamps(encode_timestamps([])) == []
+    # Timestamps are rounded to the millisecond
+    timestamp = 1476900000.1234567
+    assert decode_timestamps(encode_timestamps([timestamp])) == \
+        [round_timestamp(timestamp)] == [1476900000.123]
+
+def test_values():
+    values = [20.5, 20.5, 20.6, -3.0, 0.0, 1e300, float("inf"), 42.0]
+    assert decode_values(encode_values(values)) == values
+    assert decode_values(encode_values([])) == []
+
+def test_value_types():
+    # Integers are decoded as integers, in series of integers and in series
+    # that mix integers and floats
+    for values in [[1, 2, -3, 2**62], [20, 20.5, 21, -3, 1e300]]:
+        res = decode_values(encode_values(values))
+        assert res == values
+        assert map(type, res) == map(type, values)
+
+def test_series():
+    timestamps = [1476900000 + i for i in range(1000)]
+    values = [20 + (i // 100) / 10.0 for i in range(1000)]
+    series = encode_series(timestamps, values)
+    assert series["encoding"] == DOD_XOR
+    assert decode_series(series) == (timestamps, values)
+    # Regular timestamps and slowly changing values should compress well
+    plain = json.dumps({"timestamps": timestamps, "values": values})
+    assert len(json.dumps(series)) * 5 < len(plain)
+
+def test_version_1():
+    # Series written before the encoded numbers were compressed
+    series = {
+        "encoding": DOD_XOR, "timestamps": "gMTM4ftVr7TM4ftV6Ac=",
+        "values": "NUA0gAA1gDyA"
+    }
+    assert decode_series(series) == \
+        ([1476900000, 1476900001, 1476900002.5], [20.5, 20.5, -3])
+
+def test_unknown_encoding():
+    try:
+        decode_series({"encoding": "test", "timestamps": "", "values": ""})
+        assert False, "decode_series should reject unknown encodings"
+    except ValueError:
+        pass
@@ -1,11 +1,44 @@
 import os
+import re
+import gzip
 import json
+import time
+import uuid
 import shutil
+import threading
 import tempfile
+import mock
 import httpretty
-from base64 import b64decode
+from StringIO import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
-from openag.couch import Server
+from couchdb import json as couchdb_json
+from openag import json_codec
+from openag.couch import Server, FindQuery, data_point_id, shard_target
+from openag.codec import decode_series
+from openag.var_types import VariableDictionary, VARIABLE_DICTIONARY
+
+@httpretty.activate
+def test_json_codec():
+    server = Server("http://test.test:5984")
+    httpretty.register_uri(
+        httpretty.PUT, "http://test.test:5984/test/a",
+        content_type="application/json",
+        body=json.dumps({"ok": True, "id": "a", "rev": "1-a"})
+    )
+    # The server uses openag.json_codec without changing the library used by
+    # other couchdb-python clients
+    with mock.patch.object(
+        json_codec, "couch_dumps", wraps=json_codec.couch_dumps
+    ) as dumps, mock.patch.object(
+        json_codec, "loads", wraps=json_codec.loads
+    ) as loads, mock.patch.object(couchdb_json, "decode") as decode:
+        _, _, body = server.resource("test").put_json("a", body={"a": 1})
+        assert body["rev"] == "1-a"
+        assert dumps.call_count == loads.call_count == 1
+        assert not decode.called
+    assert json.loads(httpretty.last_request().body) == {"a": 1}
 
 @httpretty.activate
 def test_get_or_create_db():
@@ -29,91 +62,131 @@ def test_get_or_create_db():
     test_db = server.get_or_create("test")
     assert "test" in server
 
-@httpretty.activate
-def test_replicate():
-    # Start a replication
-    server = Server("http://test.test:5984")
+class BulkRequests(list):
+    def __init__(self):
+        super(BulkRequests, self).__init__()
+        self.read_keys = []
+
+def mock_replicator(docs):
+    """
+    Registers handlers that emulate the "_replicator" database of the server at
+    http://test.test:5984 with the contents `docs` (a dictionary mapping IDs to
+    documents). Returns a list to which the body of every bulk request is
+    appended. The keys requested from "_all_docs" are appended to the
+    attribute `read_keys` of the list.
+    """
+    bulk_requests = BulkRequests()
+    def get_all_docs(request, uri, headers):
+        keys = json.loads(request.body)["keys"]
+        bulk_requests.read_keys.append(keys)
+        rows = []
+        for _id in keys:
+            if _id in docs:
+                rows.append({
+                    "id": _id, "key": _id,
+                    "value": {"rev": docs[_id]["_rev"]}, "doc": docs[_id]
+                })
+            else:
+                rows.append({"key": _id, "error": "not_found"})
+        return 200, headers, json.dumps({
+            "total_rows": len(docs), "offset": 0, "rows": rows
+        })
     httpretty.register_uri(
-        httpretty.HEAD, "http://test.test:5984/_replicator"
+        httpretty.POST, "http://test.test:5984/_replicator/_all_docs",
+        content_type="application/json", body=get_all_docs
     )
+    def bulk_docs(request, uri, headers):
+        body = json.loads(request.body)
+        bulk_requests.append(body)
+        res = []
+        for doc in body["docs"]:
+            old_doc = docs.get(doc["_id"])
+            if old_doc and old_doc["_rev"] != doc.get("_rev"):
+                res.append({"id": doc["_id"], "error": "conflict"})
+                continue
+            if doc.get("_deleted"):
+                del docs[doc["_id"]]
+            else:
+                doc["_rev"] = str(int(doc.get("_rev", "0")) + 1)
+                docs[doc["_id"]] = doc
+            res.append({"id": doc["_id"], "rev": doc.get("_rev")})
+        return 201, headers, json.dumps(res)
     httpretty.register_uri(
-        httpretty.HEAD, "http://test.test:5984/_replicator/test",
-        status=404
-    )
-    def replicate_test_src(request, uri, headers):
-        httpretty.reset()
-        httpretty.register_uri(
-            httpretty.HEAD, "http://test.test:5984/_replicator"
-        )
-        httpretty.register_uri(
-            httpretty.HEAD, "http://test.test:5984/_replicator/test",
-            status=200, etag="a"
-        )
-        return 201, headers, json.dumps({
-            "id": "test_src", "rev": "a", "ok": True
-        })
-    httpretty.register_uri(
-        httpretty.PUT, "http://test.test:5984/_replicator/test",
-        status=201, content_type="application/json", body=replicate_test_src
+        httpretty.POST, "http://test.test:5984/_replicator/_bulk_docs",
+        content_type="application/json", body=bulk_docs
     )
+    return bulk_requests
+
+@httpretty.activate
+def test_replicate():
+    server = Server("http://test.test:5984")
+    docs = {}
+    bulk_requests = mock_replicator(docs)
+
+    # Start a replication
     server.replicate("test", "test_src", "test_dest", continuous=True)
-    assert "test" in server["_replicator"]
+    assert docs["test"]["source"] == "test_src"
+    assert len(bulk_requests) == 1
 
     # Make sure replicate is idempotent
-    httpretty.register_uri(
-        httpretty.PUT, "http://test.test:5984/_replicator/test_src",
-        status=500
-    )
     server.replicate("test", "test_src", "test_dest", continuous=True)
-    assert "test" in server["_replicator"]
+    assert len(bulk_requests) == 1
 
-    # Cancel the replication
-    def cancel_test_replication(request, uri, headers):
-        httpretty.reset()
-        httpretty.register_uri(
-            httpretty.HEAD, "http://test.test:5984/_replicator"
-        )
-        httpretty.register_uri(
-            httpretty.HEAD, "http://test.test:5984/_replicator/test",
-            status=404
-        )
-        return 200, headers, ""
-    httpretty.register_uri(
-        httpretty.DELETE, "http://test.test:5984/_replicator/test",
-        status=200, body=cancel_test_replication
+    # Changing the settings should update the replication
+    server.replicate(
+        "test", "test_src", "test_dest", continuous=True, doc_ids=["b", "a"]
     )
+    assert len(bulk_requests) == 2
+    assert docs["test"]["doc_ids"] == ["a", "b"]
+
+    # Cancel the replication
     server.cancel_replication("test")
-    assert "test" not in server["_replicator"]
+    assert "test" not in docs
 
 @httpretty.activate
 def test_cancel_replication():
     server = Server("http://test.test:5984")
-    httpretty.register_uri(
-        httpretty.HEAD, "http://test.test:5984/_replicator",
-        status=200
-    )
-    global doc_exists
-    doc_exists = True
-    def head_test_src(request, uri, headers):
-        if doc_exists:
-            return 200, headers, ""
-        else:
-            return 404, headers, ""
-    httpretty.register_uri(
-        httpretty.HEAD, "http://test.test:5984/_replicator/test_src",
-        etag="a", body=head_test_src
-    )
-    def delete_test_src(request, uri, headers):
-        global doc_exists
-        doc_exists = False
-        return 200, headers, ""
-    httpretty.register_uri(
-        httpretty.DELETE, "http://test.test:5984/_replicator/test_src",
-        etag="a", body=delete_test_src
-    )
-    assert "test_src" in server["_replicator"]
+    docs = {"test_src": {"_id": "test_src", "_rev": "1"}}
+    bulk_requests = mock_replicator(docs)
+    server.cancel_replication("test_src")
+    assert "test_src" not in docs
+
+    # Cancelling a replication that doesn't exist should do nothing
     server.cancel_replication("test_src")
-    assert "test_src" not in server["_replicator"]
+    assert len(bulk_requests) == 1
+
+@httpretty.activate
+def test_reconcile_replications():
+    server = Server("http://test.test:5984")
+    docs = {
+        "a": {
+            "_id": "a", "_rev": "1", "source": "a", "target": "b",
+            "continuous": True, "_replication_state": "triggered"
+        },
+        "b": {
+            "_id": "b", "_rev": "1", "source": "b", "target": "c",
+            "continuous": True
+        },
+        "c": {
+            "_id": "c", "_rev": "1", "source": "c", "target": "d",
+            "continuous": True
+        },
+        "unmanaged": {
+            "_id": "unmanaged", "_rev": "1", "source": "e", "target": "f"
+        }
+    }
+    bulk_requests = mock_replicator(docs)
+    res = server.reconcile_replications({
+        "a": {"source": "a", "target": "b", "continuous": True},
+        "b": {"source": "b", "target": "x", "continuous": True},
+        "d": {"source": "d", "target": "e", "continuous": False}
+    }, managed_ids=["a", "b", "c", "d"])
+    assert res == {"added": ["d"], "updated": ["b"], "removed": ["c"]}, res
+    assert len(bulk_requests) == 1
+    # Only the replications that are managed are read
+    assert bulk_requests.read_keys == [["a", "b", "c", "d"]]
+    assert sorted(docs) == ["a", "b", "d", "unmanaged"]
+    assert docs["b"]["target"] == "x"
 
 @httpretty.activate
 def test_create_user():
@@ -138,24 +211,31 @@ def test_get_user_info():
     except RuntimeError as e:
         pass
 
-    def on_get_session(request, uri, headers):
-        credentials = request.headers.getheader("Authorization")
-        if credentials.startswith("Basic "):
-            username, password = b64decode(credentials[6:]).split(":")
-            if username == "test" and password == "test":
-                return 200, headers, '{"test": "test"}'
-        return 401, headers, '{"test": "test"}'
+    def on_post_session(request, uri, headers):
+        credentials = json.loads(request.body)
+        if credentials == {"name": "test", "password": "test"}:
+            headers["set-cookie"] = "AuthSession=abc; Version=1; Path=/"
+            return 200, headers, '{"ok": true, "name": "test"}'
+        return 401, headers, '{"error": "unauthorized"}'
     httpretty.register_uri(
-        httpretty.GET, "http://test.test:5984/_session", body=on_get_session,
-        content_type="application/json"
+        httpretty.POST, "http://test.test:5984/_session",
+        body=on_post_session, content_type="application/json"
     )
     server.log_in("test", "test")
+    assert server.session_cookie == "abc"
+    assert server.session_expires > time.time()
     httpretty.register_uri(
         httpretty.HEAD, "http://test.test:5984/_users"
     )
+    def on_get_user(request, uri, headers):
+        # The password should only be checked when logging in
+        assert request.headers.getheader("Authorization") is None
+        if request.headers.getheader("Cookie") != "AuthSession=abc":
+            return 401, headers, '{"error": "unauthorized"}'
+        return 200, headers, '{"test": "test"}'
     httpretty.register_uri(
         httpretty.GET, "http://test.test:5984/_users/org.couchdb.user%3Atest",
-        body='{"test": "test"}', content_type="application/json"
+        body=on_get_user, content_type="application/json"
     )
     res = server.get_user_info()
     assert server.get_user_info() == {"test": "test"}
@@ -214,6 +294,801 @@ def test_push_design_documents():
             httpretty.PUT, "http://test.test:5984/test/_design/openag",
             body=create_design_doc, content_type="application/json"
         )
+        httpretty.register_uri(
+            httpretty.GET, "http://test.test:5984/_all_dbs",
+            body=json.dumps(["test", "test2"]),
+            content_type="application/json"
+        )
         server.push_design_documents(tempdir)
     finally:
         shutil.rmtree(tempdir)
+
+@httpretty.activate
+def test_snapshot():
+    server = Server("http://test.test:5984")
+    docs = [
+        {"_id": "a", "_rev": "1-a", "value": 1},
+        {"_id": "b", "_rev": "2-b", "value": 2}
+    ]
+    def get_changes(request, uri, headers):
+        since = int(request.querystring["since"][0])
+        results = [
+            {"seq": 1, "id": "a", "changes": [], "doc": docs[0]},
+            {"seq": 2, "id": "_design/openag", "changes": [], "doc": {}},
+            {"seq": 3, "id": "c", "changes": [], "doc": {}, "deleted": True},
+            {"seq": 4, "id": "b", "changes": [], "doc": docs[1]}
+        ][since:since+2]
+        return 200, headers, json.dumps({
+            "results": results, "last_seq": since + len(results)
+        })
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test/_changes",
+        content_type="application/json", body=get_changes
+    )
+    snapshot = StringIO()
+    assert server.dump_snapshot("test", snapshot, batch_size=2) == 4
+    snapshot.seek(0)
+
+    global uploaded
+    uploaded = []
+    def bulk_docs(request, uri, headers):
+        body = json.loads(request.body)
+        assert body["new_edits"] is False
+        uploaded.extend(body["docs"])
+        return 201, headers, "[]"
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test2/_bulk_docs",
+        content_type="application/json", body=bulk_docs
+    )
+    assert server.load_snapshot("test2", snapshot) == 4
+    assert uploaded == docs
+
+def test_data_point_id():
+    point = {
+        "environment": "env", "variable": "air_temperature",
+        "is_desired": False, "timestamp": 1476900000.5
+    }
+    assert data_point_id(point) == \
+        "1476900000.500000-env-measured-air_temperature"
+    later_point = dict(point, timestamp=1476900010)
+    assert data_point_id(point) < data_point_id(later_point)
+
+@httpretty.activate
+def test_write_data_points():
+    server = Server("http://test.test:5984")
+    global written
+    written = {"0000000001.000000-env-measured-air_temperature": {}}
+    def bulk_docs(request, uri, headers):
+        res = []
+        for doc in json.loads(request.body)["docs"]:
+            if doc["_id"] in written:
+                res.append({"id": doc["_id"], "error": "conflict"})
+            else:
+                written[doc["_id"]] = doc
+                res.append({"id": doc["_id"], "rev": "1-a"})
+        return 201, headers, json.dumps(res)
+    httpretty.register_uri(
+        httpretty.POST,
+        "http://test.test:5984/environmental_data_point/_bulk_docs",
+        content_type="application/json", body=bulk_docs
+    )
+    points = [
+        {
+            "environment": "env", "variable": "air_temperature",
+            "is_desired": False, "value": 20, "timestamp": i
+        } for i in range(1, 4)
+    ]
+    assert server.write_data_points(points, batch_size=2) == 2
+    assert len(written) == 3
+    # Retrying the write shouldn't create duplicates
+    assert server.write_data_points(points) == 0
+
+@httpretty.activate
+def test_bucketed_data_points():
+    server = Server("http://test.test:5984")
+    buckets = {}
+    def all_docs(request, uri, headers):
+        rows = []
+        for key in json.loads(request.body)["keys"]:
+            if key in buckets:
+                rows.append({"id": key, "key": key, "doc": buckets[key]})
+            else:
+                rows.append({"key": key, "error": "not_found"})
+        return 200, headers, json.dumps({"rows": rows})
+    httpretty.register_uri(
+        httpretty.POST,
+        "http://test.test:5984/environmental_data_bucket/_all_docs",
+        content_type="application/json", body=all_docs
+    )
+    def bulk_docs(request, uri, headers):
+        res = []
+        for doc in json.loads(request.body)["docs"]:
+            doc["_rev"] = "1-a"
+            buckets[doc["_id"]] = doc
+            res.append({"id": doc["_id"], "rev": doc["_rev"]})
+        return 201, headers, json.dumps(res)
+    httpretty.register_uri(
+        httpretty.POST,
+        "http://test.test:5984/environmental_data_bucket/_bulk_docs",
+        content_type="application/json", body=bulk_docs
+    )
+    points = [
+        {
+            "environment": "env", "variable": "air_temperature",
+            "is_desired": False, "value": 20 + i, "timestamp": 3590 + i * 5
+        } for i in range(4)
+    ]
+    assert server.write_bucketed_data_points(points, bucket_size=3600) == 4
+    assert sorted(buckets) == [
+        "0000000000.000000-env-measured-air_temperature",
+        "0000003600.000000-env-measured-air_temperature"
+    ]
+    first_bucket = buckets["0000000000.000000-env-measured-air_temperature"]
+    assert first_bucket["timestamps"] == [3590, 3595]
+    assert first_bucket["values"] == [20, 21]
+
+    # Writing the same points again shouldn't change anything
+    assert server.write_bucketed_data_points(points, bucket_size=3600) == 0
+
+    def get_view(request, uri, headers):
+        assert json.loads(request.querystring["startkey"][0]) == \
+            ["env", "measured", "air_temperature", 3600]
+        rows = [{"doc": buckets[_id]} for _id in sorted(buckets)[1:]]
+        return 200, headers, json.dumps({"rows": rows})
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/environmental_data_bucket/"
+        "_design/openag/_view/by_variable", content_type="application/json",
+        body=get_view
+    )
+    res = list(server.read_bucketed_data_points(
+        "env", "air_temperature", 3600, 3605
+    ))
+    assert [p["value"] for p in res] == [22, 23]
+
+    # Points with sub-millisecond timestamps are only added to compressed
+    # buckets once
+    point = dict(points[0], timestamp=7200.1234567)
+    assert server.write_bucketed_data_points(
+        [point], bucket_size=3600, encoding="dod-xor"
+    ) == 1
+    assert server.write_bucketed_data_points(
+        [point], bucket_size=3600, encoding="dod-xor"
+    ) == 0
+    bucket = buckets["0000007200.000000-env-measured-air_temperature"]
+    assert decode_series(bucket)[0] == [7200.123]
+
+@httpretty.activate
+def test_sharded_data_points():
+    server = Server("http://test.test:5984")
+    dbs = {"environmental_data_point": {}}
+    db_url = r"http://test.test:5984/environmental\w*"
+    def all_dbs(request, uri, headers):
+        return 200, headers, json.dumps(sorted(dbs))
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/_all_dbs",
+        content_type="application/json", body=all_dbs
+    )
+    def head_db(request, uri, headers):
+        db_name = uri.split("/")[3]
+        return (200 if db_name in dbs else 404), headers, ""
+    httpretty.register_uri(
+        httpretty.HEAD, re.compile(db_url + "$"), body=head_db
+    )
+    def put_db(request, uri, headers):
+        dbs[uri.split("/")[3]] = {}
+        return 201, headers, json.dumps({"ok": True})
+    httpretty.register_uri(
+        httpretty.PUT, re.compile(db_url + "$"),
+        content_type="application/json", body=put_db
+    )
+    httpretty.register_uri(
+        httpretty.HEAD,
+        re.compile(db_url + r"/_design/\w+$"),
+        status=404
+    )
+    def put_design_doc(request, uri, headers):
+        doc_id = "/".join(uri.split("/")[4:])
+        dbs[uri.split("/")[3]][doc_id] = json.loads(request.body)
+        return 201, headers, json.dumps({"id": doc_id, "rev": "1"})
+    httpretty.register_uri(
+        httpretty.PUT,
+        re.compile(db_url + r"/_design/\w+$"),
+        content_type="application/json", body=put_design_doc
+    )
+    def bulk_docs(request, uri, headers):
+        db = dbs[uri.split("/")[3]]
+        res = []
+        for doc in json.loads(request.body)["docs"]:
+            db[doc["_id"]] = doc
+            res.append({"id": doc["_id"], "rev": "1-a"})
+        return 201, headers, json.dumps(res)
+    httpretty.register_uri(
+        httpretty.POST, re.compile(db_url + r"/_bulk_docs$"),
+        content_type="application/json", body=bulk_docs
+    )
+    replicator = {
+        "environmental_data_point": {
+            "_id": "environmental_data_point", "_rev": "1",
+            "source": "environmental_data_point",
+            "target": "http://cloud/u%2Ff%2Fenvironmental_data_point",
+            "continuous": True
+        }
+    }
+    mock_replicator(replicator)
+    # The shards should get the Mango indexes as well
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/",
+        content_type="application/json", body=json.dumps({"version": "1.6.1"})
+    )
+
+    # Points should be written to the shard for their month
+    points = [
+        {
+            "environment": "env", "variable": "air_temperature",
+            "is_desired": False, "value": 20, "timestamp": timestamp
+        } for timestamp in (1475000000, 1476000000, 1478000000)
+    ]
+    assert server.write_data_points(points, sharded=True) == 3
+    assert len(dbs["environmental_data_point_2016_09"]) == 3
+    assert len(dbs["environmental_data_point_2016_10"]) == 3
+    assert len(dbs["environmental_data_point_2016_11"]) == 3
+    assert dbs["environmental_data_point"] == {}
+    # New shards should get the design document and be replicated
+    shard = dbs["environmental_data_point_2016_10"]
+    assert "views" in shard["_design/openag"]
+    assert shard["_design/variable_dictionary"]["variables"][0] == \
+        "air_temperature"
+    shard_replication = replicator["environmental_data_point_2016_10"]
+    assert shard_replication["target"] == \
+        "http://cloud/u%2Ff%2Fenvironmental_data_point_2016_10"
+    assert shard_replication["source"] == "environmental_data_point_2016_10"
+    assert shard_replication["continuous"] is True
+    # The remote shard doesn't exist yet
+    assert shard_replication["create_target"] is True
+    assert server.list_shards("environmental_data_point") == [
+        "environmental_data_point_2016_09", "environmental_data_point_2016_10",
+        "environmental_data_point_2016_11"
+    ]
+
+    # Reads should only query the shards covering the time range
+    def get_view(request, uri, headers):
+        db = dbs[uri.split("/")[3]]
+        start = json.loads(request.querystring["startkey"][0])[-1]
+        end = json.loads(request.querystring["endkey"][0])[-1]
+        rows = [
+            {"id": _id, "key": None, "value": doc}
+            for _id, doc in sorted(db.items())
+            if not _id.startswith("_") and start <= doc["timestamp"] <= end
+        ]
+        return 200, headers, json.dumps({"rows": rows})
+    httpretty.register_uri(
+        httpretty.GET,
+        re.compile(db_url + r"/_design/openag/_view/.*"),
+        content_type="application/json", body=get_view
+    )
+    res = list(server.read_data_points(
+        "env", 1475000000, 1477000000, "air_temperature", sharded=True
+    ))
+    assert [p["timestamp"] for p in res] == [1475000000, 1476000000]
+    assert not "environmental_data_point_2016_11" in \
+        httpretty.last_request().path
+
+    def get_csv(request, uri, headers):
+        db = dbs[uri.split("/")[3]]
+        lines = ["timestamp,value\n"] + [
+            "{},{}\n".format(doc["timestamp"], doc["value"])
+            for _id, doc in sorted(db.items()) if not _id.startswith("_")
+        ]
+        return 200, headers, "".join(lines)
+    httpretty.register_uri(
+        httpretty.GET,
+        re.compile(db_url + r"/_design/openag/_list/.*"),
+        content_type="text/csv", body=get_csv
+    )
+    out = StringIO()
+    server.export_csv(
+        out, "env", 1475000000, 1479000000, cols=["timestamp", "value"],
+        sharded=True
+    )
+    assert out.getvalue() == (
+        "timestamp,value\n1475000000,20\n1476000000,20\n1478000000,20\n"
+    )
+
+def test_shard_target():
+    assert shard_target(
+        "http://cloud/u%2Ff%2Fdata", "data", "data_2016_10"
+    ) == "http://cloud/u%2Ff%2Fdata_2016_10"
+
+def register_data_point_db(docs, queries):
+    """
+    Serves the documents in the dictionary `docs` from `_all_docs` and
+    `_purge` of the environmental_data_point database, recording the query
+    strings of the `_all_docs` requests in `queries`
+    """
+    def all_docs(request, uri, headers):
+        query = request.querystring
+        queries.append(query)
+        startkey = json.loads(query.get("startkey", ['""'])[0])
+        endkey = json.loads(query.get("endkey", ['"\\ufff0"'])[0])
+        rows = [
+            {"id": _id, "key": _id, "doc": dict(doc)}
+            for _id, doc in sorted(docs.items())
+            if startkey <= _id <= endkey
+        ][:int(query["limit"][0])]
+        return 200, headers, json.dumps({"rows": rows})
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/environmental_data_point/_all_docs",
+        content_type="application/json", body=all_docs
+    )
+    def purge(request, uri, headers):
+        body = json.loads(request.body)
+        for _id, revs in body.items():
+            assert revs == [docs[_id]["_rev"]]
+            del docs[_id]
+        return 200, headers, json.dumps({"purged": body})
+    httpretty.register_uri(
+        httpretty.POST,
+        "http://test.test:5984/environmental_data_point/_purge",
+        content_type="application/json", body=purge
+    )
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/environmental_data_point",
+        content_type="application/json", body=json.dumps({"props": {}})
+    )
+
+@httpretty.activate
+def test_archive_expired_data_points():
+    server = Server("http://test.test:5984")
+    day = 86400
+    docs = {}
+    for variable in ("air_temperature", "water_temperature"):
+        for timestamp in (1 * day, 5 * day, 9 * day):
+            doc = {
+                "environment": "env", "variable": variable,
+                "is_desired": False, "value": 20, "timestamp": timestamp,
+                "_rev": "1-a"
+            }
+            doc["_id"] = data_point_id(doc)
+            docs[doc["_id"]] = doc
+    queries = []
+    register_data_point_db(docs, queries)
+    archive = StringIO()
+    assert server.archive_expired_data_points(
+        {"air_temperature": 2}, archive, default=6, now=10 * day,
+        batch_size=1, time_ordered_ids=True
+    ) == 3
+    # Only the time-ordered start of the database is scanned
+    assert all("endkey" in query for query in queries)
+    # Only points older than the policy for their variable should be removed
+    assert sorted(
+        (doc["variable"], doc["timestamp"] / day) for doc in docs.values()
+    ) == [
+        ("air_temperature", 9), ("water_temperature", 5),
+        ("water_temperature", 9)
+    ]
+    archive.seek(0)
+    archived = [
+        json.loads(line) for line in gzip.GzipFile(fileobj=archive)
+    ]
+    assert len(archived) == 3
+    assert all(not doc["_id"] in docs for doc in archived)
+
+@httpretty.activate
+def test_archive_expired_data_points_with_random_ids():
+    server = Server("http://test.test:5984")
+    day = 86400
+    docs = {}
+    for timestamp in (1 * day, 5 * day, 9 * day):
+        doc = {
+            "_id": uuid.uuid4().hex, "_rev": "1-a", "environment": "env",
+            "variable": "air_temperature", "is_desired": False, "value": 20,
+            "timestamp": timestamp
+        }
+        docs[doc["_id"]] = doc
+    register_data_point_db(docs, [])
+    archive = StringIO()
+    assert server.archive_expired_data_points(
+        {}, archive, default=4, now=10 * day, batch_size=1
+    ) == 2
+    assert [doc["timestamp"] for doc in docs.values()] == [9 * day]
+
+@httpretty.activate
+def test_compact():
+    server = Server("http://test.test:5984")
+    sizes = [3000, 1000]
+    def get_db(request, uri, headers):
+        return 200, headers, json.dumps({
+            "disk_size": sizes[0], "compact_running": False
+        })
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test",
+        content_type="application/json", body=get_db
+    )
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test/_all_docs",
+        content_type="application/json",
+        body=json.dumps({"rows": [{"id": "_design/openag"}]})
+    )
+    # The view index is still being compacted when the database is done
+    view_sizes = [500, 500, 100]
+    def get_view_info(request, uri, headers):
+        size = view_sizes.pop(0) if len(view_sizes) > 1 else view_sizes[0]
+        return 200, headers, json.dumps({
+            "name": "openag", "view_index": {
+                "sizes": {"file": size}, "compact_running": size != 100
+            }
+        })
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test/_design/openag/_info",
+        content_type="application/json", body=get_view_info
+    )
+    compacted = []
+    def post(request, uri, headers):
+        assert request.headers["Content-Type"] == "application/json"
+        compacted.append(request.path)
+        del sizes[:-1]
+        return 202, headers, json.dumps({"ok": True})
+    for path in ("_compact", "_compact/openag", "_view_cleanup"):
+        httpretty.register_uri(
+            httpretty.POST, "http://test.test:5984/test/" + path,
+            content_type="application/json", body=post
+        )
+    assert server.compact("test", poll_interval=0) == 2400
+    assert compacted == [
+        "/test/_compact", "/test/_compact/openag", "/test/_view_cleanup"
+    ]
+    assert view_sizes == [100]
+
+@httpretty.activate
+def test_partitioned_data_points():
+    server = Server("http://test.test:5984")
+    created = {}
+    def head_db(request, uri, headers):
+        return (200 if created else 404), headers, ""
+    httpretty.register_uri(
+        httpretty.HEAD, "http://test.test:5984/test", body=head_db
+    )
+    def put_db(request, uri, headers):
+        created.update(request.querystring)
+        return 201, headers, json.dumps({"ok": True})
+    httpretty.register_uri(
+        httpretty.PUT, "http://test.test:5984/test",
+        content_type="application/json", body=put_db
+    )
+    server.get_or_create("test", partitioned=True)
+    assert created == {"partitioned": ["true"]}
+
+    point = {
+        "environment": "env", "variable": "air_temperature",
+        "is_desired": False, "value": 20, "timestamp": 1476900000.5
+    }
+    assert data_point_id(point, partitioned=True) == \
+        "env:1476900000.500000-env-measured-air_temperature"
+
+    written = []
+    def bulk_docs(request, uri, headers):
+        docs = json.loads(request.body)["docs"]
+        written.extend(docs)
+        return 201, headers, json.dumps([
+            {"id": doc["_id"], "rev": "1-a"} for doc in docs
+        ])
+    httpretty.register_uri(
+        httpretty.POST,
+        "http://test.test:5984/environmental_data_point/_bulk_docs",
+        content_type="application/json", body=bulk_docs
+    )
+    assert server.write_data_points([point], partitioned=True) == 1
+    assert written[0]["_id"].startswith("env:")
+
+    # Queries should only touch the partition of the environment
+    def get_view(request, uri, headers):
+        if request.querystring.get("descending") == ["true"]:
+            assert json.loads(request.querystring["startkey"][0]) == \
+                ["measured", "air_temperature", {}]
+        return 200, headers, json.dumps({
+            "rows": [{"id": doc["_id"], "value": doc} for doc in written]
+        })
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/environmental_data_point/_partition/env/"
+        "_design/partitioned/_view/by_variable",
+        content_type="application/json", body=get_view
+    )
+    res = list(server.read_data_points(
+        "env", 0, 1476900001, "air_temperature", partitioned=True
+    ))
+    assert res == written
+    assert json.loads(httpretty.last_request().querystring["startkey"][0]) \
+        == ["measured", "air_temperature", 0]
+    assert server.read_latest_data_point(
+        "env", "air_temperature", partitioned=True
+    ) == written[0]
+
+@httpretty.activate
+def test_push_partitioned_design_documents():
+    server = Server("http://test.test:5984")
+    tempdir = tempfile.mkdtemp()
+    try:
+        for name in ("global", "partitioned"):
+            view_path = os.path.join(tempdir, name, "test", "views", "test")
+            os.makedirs(view_path)
+            with open(os.path.join(view_path, "map.js"), "w+") as f:
+                f.write(name)
+        httpretty.register_uri(
+            httpretty.GET, "http://test.test:5984/_all_dbs",
+            content_type="application/json", body=json.dumps(["test"])
+        )
+        httpretty.register_uri(
+            httpretty.HEAD, "http://test.test:5984/test"
+        )
+        httpretty.register_uri(
+            httpretty.GET, "http://test.test:5984/test",
+            content_type="application/json",
+            body=json.dumps({"props": {"partitioned": True}})
+        )
+        pushed = {}
+        for doc_id in ("openag", "partitioned"):
+            httpretty.register_uri(
+                httpretty.HEAD,
+                "http://test.test:5984/test/_design/" + doc_id, status=404
+            )
+            def put_design_doc(request, uri, headers):
+                doc = json.loads(request.body)
+                pushed[doc["_id"]] = doc
+                return 201, headers, json.dumps({"id": doc["_id"], "rev": "1"})
+            httpretty.register_uri(
+                httpretty.PUT,
+                "http://test.test:5984/test/_design/" + doc_id,
+                content_type="application/json", body=put_design_doc
+            )
+        server.push_design_documents(
+            os.path.join(tempdir, "global"),
+            os.path.join(tempdir, "partitioned")
+        )
+        assert pushed["_design/openag"]["options"] == {"partitioned": False}
+        assert pushed["_design/partitioned"]["options"] == \
+            {"partitioned": True}
+        assert pushed["_design/partitioned"]["views"]["test"]["map"] == \
+            "partitioned"
+    finally:
+        shutil.rmtree(tempdir)
+
+@httpretty.activate
+def test_create_index():
+    server = Server("http://test.test:5984")
+    versions = ["2.1.0"]
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/",
+        content_type="application/json",
+        body=lambda request, uri, headers: (
+            200, headers, json.dumps({"version": versions[0]})
+        )
+    )
+    indexes = []
+    def create_index(request, uri, headers):
+        indexes.append(json.loads(request.body))
+        return 200, headers, json.dumps({"result": "created"})
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test/_index",
+        content_type="application/json", body=create_index
+    )
+    server.create_index("test", "by_test", {"fields": ["test"]})
+    assert indexes == [{
+        "index": {"fields": ["test"]}, "name": "by_test", "type": "json",
+        "ddoc": "indexes"
+    }]
+
+    # CouchDB 1.x doesn't support Mango indexes
+    server = Server("http://test.test:5984")
+    versions[0] = "1.6.1"
+    server.create_index("test", "by_test", {"fields": ["test"]})
+    assert len(indexes) == 1
+
+@httpretty.activate
+def test_find():
+    server = Server("http://test.test:5984")
+    docs = [{"_id": str(i), "value": i} for i in range(5)]
+    requests = []
+    def find(request, uri, headers):
+        body = json.loads(request.body)
+        requests.append(body)
+        start = int(body.get("bookmark", 0))
+        page = docs[start:start + body["limit"]]
+        return 200, headers, json.dumps({
+            "docs": page, "bookmark": str(start + len(page)),
+            "execution_stats": {"total_docs_examined": len(page)}
+        })
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test/_find",
+        content_type="application/json", body=find
+    )
+    query = server.find("test", {"is_manual": True}).where(
+        variable="air_temperature", timestamp={"$gt": 0}
+    ).fields("value").sort("variable", "-timestamp").limit(2) \
+        .use_index("by_test").with_execution_stats()
+    assert [doc["value"] for doc in query] == list(range(5))
+    assert requests[0] == {
+        "selector": {
+            "is_manual": True, "variable": "air_temperature",
+            "timestamp": {"$gt": 0}
+        },
+        "fields": ["value"],
+        "sort": [{"variable": "asc"}, {"timestamp": "desc"}],
+        "limit": 2,
+        "use_index": ["_design/indexes", "by_test"],
+        "execution_stats": True
+    }
+    assert [r.get("bookmark") for r in requests] == [None, "2", "4"]
+    assert query.execution_stats == {"total_docs_examined": 1}
+
+    # Partition queries should go to the partition's `_find` endpoint
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test/_partition/env/_find",
+        content_type="application/json",
+        body=json.dumps({"docs": docs[:1]})
+    )
+    assert FindQuery(server, "test", partition="env").execute() == \
+        (docs[:1], None)
+
+@httpretty.activate
+def test_variable_dictionary():
+    server = Server("http://test.test:5984")
+    stored = {}
+    httpretty.register_uri(
+        httpretty.HEAD, "http://test.test:5984/test"
+    )
+    url = "http://test.test:5984/test/_design/variable_dictionary"
+    httpretty.register_uri(
+        httpretty.HEAD, url,
+        body=lambda request, uri, headers: (
+            200 if stored else 404, headers, ""
+        )
+    )
+    httpretty.register_uri(
+        httpretty.GET, url, content_type="application/json",
+        body=lambda request, uri, headers: (200, headers, json.dumps(stored))
+    )
+    def put_doc(request, uri, headers):
+        stored.clear()
+        stored.update(json.loads(request.body))
+        stored["_rev"] = str(int(stored.get("_rev", "0")) + 1)
+        return 201, headers, json.dumps({
+            "id": "_design/variable_dictionary", "rev": stored["_rev"]
+        })
+    httpretty.register_uri(
+        httpretty.PUT, url, content_type="application/json", body=put_doc
+    )
+    assert server.get_variable_dictionary("test") is None
+    newer = VariableDictionary(VARIABLE_DICTIONARY.names + ["new_variable"])
+    server.push_variable_dictionary("test", newer)
+    assert stored["version"] == newer.version
+    # An older dictionary shouldn't replace a newer one
+    server.push_variable_dictionary("test")
+    assert stored["_rev"] == "1"
+    assert server.get_variable_dictionary("test").names == newer.names
+    # A change to the groups is stored even though the codes are the same
+    regrouped = VariableDictionary(newer.names, {"custom": ["new_variable"]})
+    server.push_variable_dictionary("test", regrouped)
+    assert stored["_rev"] == "2"
+    assert stored["version"] == regrouped.version
+
+@httpretty.activate
+def test_iter_view():
+    server = Server("http://test.test:5984")
+    # Large enough that the response is streamed rather than buffered
+    rows = [
+        {"id": str(i), "key": ["env", i], "value": {"value": i * 0.5}}
+        for i in range(1000)
+    ]
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/test/_design/openag/_view/by_timestamp",
+        content_type="application/json",
+        body=json.dumps({"total_rows": 1000, "offset": 0, "rows": rows})
+    )
+    res = server.iter_view(
+        "test", "openag/by_timestamp", startkey=json.dumps(["env"])
+    )
+    assert next(res) == rows[0]
+    assert list(res) == rows[1:]
+    assert httpretty.last_request().querystring["startkey"] == ['["env"]']
+
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test/_partition/env/_all_docs",
+        content_type="application/json",
+        body=json.dumps({"total_rows": 1, "offset": 0, "rows": rows[:1]})
+    )
+    assert list(server.iter_view("test", "_all_docs", partition="env")) == \
+        rows[:1]
+
+class FakeCouchHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests made by :func:`test_shared_server`. Unlike httpretty,
+    this works with concurrent requests.
+    """
+    protocol_version = "HTTP/1.1"
+    rows = [{"id": str(i), "key": ["env", i], "value": i} for i in range(100)]
+
+    def do_GET(self):
+        self.respond(200, {"total_rows": 100, "offset": 0, "rows": self.rows})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        docs = json.loads(body)["docs"]
+        with self.server.lock:
+            self.server.cookies.append(self.headers.get("Cookie"))
+            self.server.written.update((doc["_id"], doc) for doc in docs)
+        self.respond(201, [{"id": doc["_id"], "rev": "1-a"} for doc in docs])
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeCouchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def test_shared_server():
+    httpd = FakeCouchServer(("127.0.0.1", 0), FakeCouchHandler)
+    httpd.lock = threading.Lock()
+    httpd.written = {}
+    httpd.cookies = []
+    httpd_thread = threading.Thread(target=httpd.serve_forever)
+    httpd_thread.daemon = True
+    httpd_thread.start()
+    try:
+        host = "127.0.0.1:{}".format(httpd.server_address[1])
+        server = Server("http://" + host)
+        errors = []
+        def worker(i):
+            # Each thread writes as its own user through the shared
+            # connections
+            user_server = server.with_session("user{}".format(i), str(i), 0)
+            try:
+                for j in range(10):
+                    point = {
+                        "environment": "env", "variable": "air_temperature",
+                        "is_desired": False, "value": i,
+                        "timestamp": i * 100 + j
+                    }
+                    assert user_server.write_data_points([point]) == 1
+                    assert list(server.read_data_points("env", 0, 100)) == \
+                        range(100)
+            except Exception as e:
+                errors.append(e)
+        threads = [
+            threading.Thread(target=worker, args=(i,)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(httpd.written) == 80
+        assert sorted(set(httpd.cookies)) == [
+            "AuthSession={}".format(i) for i in range(8)
+        ]
+        for doc in httpd.written.values():
+            assert doc["timestamp"] // 100 == doc["value"]
+        # The shared server itself isn't logged in
+        assert not "Cookie" in server.resource.headers
+        # Connections are returned to the pool to be reused by other threads
+        pool = server.resource.session.connection_pool
+        assert 0 < len(pool.conns[("http", host)]) <= 8
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_with_credentials():
+    server = Server("http://test.test:5984")
+    user_server = server.with_credentials("user", "password")
+    assert user_server.resource.session is server.resource.session
+    assert user_server.resource("test").credentials == ("user", "password")
+    assert server.resource("test").credentials is None
@@ -0,0 +1,75 @@
+from openag.data_points import DataPoint, DataPointBatch
+from openag.var_types import VARIABLE_DICTIONARY
+
+def make_points(count):
+    return [
+        {
+            "environment": "env", "variable": "air_temperature",
+            "is_desired": False, "value": 20.5, "timestamp": 1476900000 + i,
+            "_id": "test"
+        } for i in range(count)
+    ]
+
+def test_data_point():
+    doc = make_points(1)[0]
+    point = DataPoint.from_dict(doc)
+    assert point.variable == "air_temperature"
+    assert point.is_manual is False
+    assert not hasattr(point, "__dict__")
+    expected = dict(doc, is_manual=False)
+    del expected["_id"]
+    assert point.to_dict() == expected
+    assert DataPoint.from_dict(point.to_dict()) == point
+    # Environments and variables should be interned
+    other = DataPoint.from_dict(dict(doc, variable=u"air_" + "temperature"))
+    assert other.variable is point.variable
+
+def test_batch():
+    docs = make_points(3)
+    docs[1]["variable"] = "water_temperature"
+    docs[1]["is_desired"] = True
+    docs[2]["value"] = {"recipe_id": "test"}
+    batch = DataPointBatch.from_dicts(docs)
+    assert len(batch) == 3
+    assert batch.variables == ["air_temperature", "water_temperature"]
+    assert list(batch.variable_codes) == [0, 1, 0]
+    assert batch[-1].value == {"recipe_id": "test"}
+    for doc, res in zip(docs, batch.to_dicts()):
+        del doc["_id"]
+        doc["is_manual"] = False
+        assert res == doc
+    docs = batch.to_docs()
+    assert docs[0]["_id"] == \
+        "1476900000.000000-env-measured-air_temperature"
+    # Batches should round trip through points
+    assert DataPointBatch(list(batch)).to_dicts() == batch.to_dicts()
+    # Numeric values should be stored in the arrays
+    batch = DataPointBatch.from_dicts(make_points(1000))
+    assert batch.other_values == {}
+    assert batch.values.buffer_info()[1] == 1000
+
+def test_batch_validation():
+    batch = DataPointBatch.from_dicts(make_points(5))
+    assert batch.invalid_indices() == []
+    batch.validate(max_timestamp=1476900004)
+    assert batch.invalid_indices(max_timestamp=1476900002) == [3, 4]
+    batch.values[1] = float("nan")
+    batch.timestamps[2] = float("inf")
+    assert batch.invalid_indices() == [1, 2]
+    try:
+        batch.validate()
+    except ValueError:
+        pass
+    else:
+        assert False, "The batch should be invalid"
+
+def test_batch_variable_dictionary():
+    docs = make_points(2)
+    docs[1]["variable"] = "custom"
+    batch = DataPointBatch.from_dicts(
+        docs, variable_dictionary=VARIABLE_DICTIONARY
+    )
+    assert batch.variable_codes[0] == \
+        VARIABLE_DICTIONARY.code("air_temperature")
+    assert batch.variable_codes[1] == len(VARIABLE_DICTIONARY.names)
+    assert [p.variable for p in batch] == ["air_temperature", "custom"]
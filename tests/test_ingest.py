@@ -0,0 +1,75 @@
+from openag.ingest import IngestFilter
+
+MODULE_TYPES = {
+    "am2315": {
+        "_id": "am2315",
+        "header_file": "openag_am2315.h",
+        "class_name": "Am2315",
+        "outputs": {
+            "air_temperature": {
+                "type": "std_msgs/Float32",
+                "accuracy": 0.1,
+                "repeatability": 0.2
+            },
+            "air_humidity": {
+                "type": "std_msgs/Float32",
+                "accuracy": 2
+            }
+        }
+    }
+}
+
+MODULES = {
+    "am2315_1": {
+        "_id": "am2315_1",
+        "type": "am2315",
+        "outputs": {
+            "air_humidity": {
+                "accuracy": 0.5
+            }
+        }
+    }
+}
+
+def make_point(variable, value, timestamp, **kwargs):
+    point = {
+        "environment": "env", "variable": variable, "is_desired": False,
+        "is_manual": False, "value": value, "timestamp": timestamp
+    }
+    point.update(kwargs)
+    return point
+
+def test_from_modules():
+    f = IngestFilter.from_modules(MODULES, MODULE_TYPES)
+    assert f.outputs == {
+        "air_temperature": {"accuracy": 0.1, "repeatability": 0.2},
+        "air_humidity": {"accuracy": 0.5}
+    }
+
+def test_rounding():
+    f = IngestFilter.from_modules(MODULES, MODULE_TYPES)
+    point = f.process(make_point("air_humidity", 41.3, 0))
+    assert point["value"] == 41.5
+    point = f.process(make_point("air_temperature", 20.1234, 0))
+    assert point["value"] == 20.1
+    # Unknown variables, desired points and manual points aren't changed
+    assert f.process(make_point("water_temperature", 1.23, 0))["value"] == 1.23
+    assert f.process(
+        make_point("air_humidity", 41.3, 0, is_desired=True)
+    )["value"] == 41.3
+    assert f.process(
+        make_point("air_humidity", 41.3, 0, is_manual=True)
+    )["value"] == 41.3
+
+def test_repeatability():
+    f = IngestFilter.from_modules(MODULES, MODULE_TYPES, max_interval=60)
+    points = [
+        make_point("air_temperature", 20.0, 0),
+        make_point("air_temperature", 20.1, 10),
+        make_point("air_temperature", 19.9, 20),
+        make_point("air_temperature", 20.5, 30),
+        make_point("air_temperature", 20.5, 40),
+        make_point("air_temperature", 20.5, 90)
+    ]
+    kept = list(f(points))
+    assert [p["timestamp"] for p in kept] == [0, 30, 90]
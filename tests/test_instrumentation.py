@@ -0,0 +1,112 @@
+import json
+import httpretty
+from StringIO import StringIO
+from couchdb.http import ResourceNotFound
+
+from openag.couch import Server
+from openag.instrumentation import (
+    RequestRecord, RequestStats, path_template, LATENCY_BUCKETS
+)
+
+def test_path_template():
+    base = "http://test.test:5984"
+    for path, template in (
+        ("/", "/"),
+        ("/_session", "/_session"),
+        ("/test", "/{db}"),
+        ("/test/_bulk_docs", "/{db}/_bulk_docs"),
+        ("/test/doc%2F1?rev=1-a", "/{db}/{docid}"),
+        ("/test/_design/openag", "/{db}/_design/{ddoc}"),
+        (
+            "/test/_design/openag/_view/by_variable?startkey=%5B%5D",
+            "/{db}/_design/{ddoc}/_view/{view}"
+        ),
+        (
+            "/test/_design/openag/_list/csv/by_timestamp",
+            "/{db}/_design/{ddoc}/_list/{list}/{view}"
+        ),
+        (
+            "/test/_partition/env/_design/partitioned/_view/by_timestamp",
+            "/{db}/_partition/{partition}/_design/{ddoc}/_view/{view}"
+        ),
+        ("/user%2Ffarm%2Fdb/_all_docs", "/{db}/_all_docs"),
+        ("/test/_compact/openag", "/{db}/_compact/{ddoc}")
+    ):
+        assert path_template(base + path) == template, path
+
+def record(latency, status=200, path="/{db}/_all_docs", retries=0):
+    return RequestRecord(
+        "GET", "http://test.test:5984/test/_all_docs", path, status, latency,
+        None, 100, retries
+    )
+
+def test_request_stats():
+    slow_log = StringIO()
+    stats = RequestStats(slow_threshold=1, slow_log=slow_log)
+    for latency in (0.001, 0.002, 0.02, 0.3):
+        stats(record(latency))
+    stats(record(3, status=500, retries=2))
+    stats(record(0.01, path="/{db}"))
+    summary = stats.summary()
+    assert [item["path"] for item in summary] == ["/{db}/_all_docs", "/{db}"]
+    item = summary[0]
+    assert item["count"] == 5
+    assert item["errors"] == 1
+    assert item["retries"] == 2
+    assert item["bytes_in"] == 500
+    assert item["max_latency"] == 3
+    assert sum(item["histogram"]) == 5
+    assert item["histogram"][0] == 2
+    assert item["p50_latency"] == 0.025
+    assert item["p95_latency"] == 5
+    assert len(item["histogram"]) == len(LATENCY_BUCKETS)
+    assert [r.latency for r in stats.slow_requests] == [3]
+    assert slow_log.getvalue() == "Slow request: GET " \
+        "http://test.test:5984/test/_all_docs -> 500 in 3.000s\n"
+    assert "/{db}/_all_docs" in stats.format_summary()
+    stats.reset()
+    assert stats.summary() == []
+
+@httpretty.activate
+def test_server_request_hook():
+    server = Server("http://test.test:5984")
+    records = []
+    server.add_request_hook(records.append)
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test/_bulk_docs",
+        content_type="application/json", status=201, body="[]"
+    )
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/missing",
+        content_type="application/json", status=404,
+        body='{"error": "not_found", "reason": "missing"}'
+    )
+    rows = [{"id": str(i), "key": i, "value": i} for i in range(1000)]
+    body = json.dumps({"rows": rows})
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/test/_design/openag/_view/by_timestamp",
+        content_type="application/json", body=body
+    )
+    server.resource("test").post_json("_bulk_docs", body={"docs": []})
+    try:
+        server.resource("missing").get_json()
+    except ResourceNotFound:
+        pass
+    else:
+        assert False, "Expected a ResourceNotFound"
+    # Users acting through copies of the server are measured as well
+    user_server = server.with_credentials("user", "password")
+    assert list(user_server.iter_view("test", "openag/by_timestamp")) == rows
+    assert [(r.method, r.path, r.status) for r in records] == [
+        ("POST", "/{db}/_bulk_docs", 201),
+        ("GET", "/{db}", 404),
+        ("GET", "/{db}/_design/{ddoc}/_view/{view}", 200)
+    ]
+    assert records[0].bytes_out == len('{"docs": []}')
+    assert records[2].bytes_in == len(body)
+    assert all(r.retries == 0 and r.latency >= 0 for r in records)
+
+    server.remove_request_hook(records.append)
+    server.resource("test").post_json("_bulk_docs", body={"docs": []})
+    assert len(records) == 3
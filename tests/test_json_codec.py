@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import json
+from StringIO import StringIO
+from nose.tools import raises
+
+from couchdb import json as couchdb_json
+from openag import json_codec
+
+def teardown():
+    json_codec.use()
+    # Don't leave the codec installed for other couchdb-python clients
+    couchdb_json.use("json")
+
+def test_round_trip():
+    for name in json_codec.BACKENDS:
+        try:
+            json_codec.use(name)
+        except ImportError:
+            continue
+        doc = {
+            "_id": "1476900000.123456-env-air_temperature-measured",
+            "value": 0.1 + 0.2, "timestamp": 1476900000.123456,
+            "url": "http://example.com/test", "name": u"température",
+            "list": [1, None, True, "a"]
+        }
+        assert json_codec.loads(json_codec.dumps(doc)) == doc, name
+        f = StringIO()
+        json_codec.dump(doc, f)
+        f.seek(0)
+        assert json_codec.load(f) == doc, name
+        assert "\\/" not in json_codec.dumps(doc["url"]), name
+
+def test_fallback():
+    # The standard library is always available
+    assert json_codec.use() in json_codec.BACKENDS
+    assert json_codec.use("json") == "json"
+    assert json_codec.backend() == "json"
+
+@raises(ValueError)
+def test_unknown_backend():
+    json_codec.use("xml")
+
+def test_install():
+    json_codec.install()
+    json_codec.use("json")
+    doc = {"name": u"température"}
+    body = couchdb_json.encode(doc)
+    assert isinstance(body, unicode)
+    assert couchdb_json.decode(body.encode("utf-8")) == doc
+
+@raises(ValueError)
+def test_install_rejects_nan():
+    json_codec.install()
+    json_codec.use("json")
+    couchdb_json.encode({"value": float("nan")})
+
+def test_iter_array():
+    doc = {
+        "total_rows": 5, "offset": 0,
+        "rows": [
+            {"id": 'a,]}"b', "key": [1, {}], "value": {"v": 'c\\"'}},
+            1, "d,]", None, [[2], []]
+        ],
+        "update_seq": "1-a"
+    }
+    data = json.dumps(doc)
+    for size in (1, 2, 3, 7, len(data)):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert list(json_codec.iter_array(chunks, "rows")) == doc["rows"]
+    assert list(json_codec.iter_array(['{"rows": [ ]}'], "rows")) == []
+    assert list(json_codec.iter_array(['{"total_rows": 0}'], "rows")) == []
+
+@raises(ValueError)
+def test_iter_array_truncated():
+    list(json_codec.iter_array(['{"rows": [{"id": "a"}, {"id"'], "rows"))
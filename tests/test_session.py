@@ -0,0 +1,150 @@
+import json
+import zlib
+import shutil
+import tempfile
+import httpretty
+from httplib import HTTPMessage
+from StringIO import StringIO
+
+from openag.couch import Server
+from openag.session import MemoryCache, DiskCache
+
+def check_cache(cache):
+    server = Server("http://test.test:5984", cache=cache)
+    # Large enough that the response is streamed rather than buffered
+    rows = [{"id": str(i), "key": i, "value": i} for i in range(1000)]
+    view = {
+        "body": json.dumps({"total_rows": 1000, "offset": 0, "rows": rows}),
+        "etag": '"1-a"'
+    }
+    requests = []
+    def get_view(request, uri, headers):
+        requests.append(request.headers.get("If-None-Match"))
+        headers["etag"] = view["etag"]
+        if request.headers.get("If-None-Match") == view["etag"]:
+            return 304, headers, ""
+        return 200, headers, view["body"]
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/test/_design/openag/_view/by_variable",
+        content_type="application/json", body=get_view
+    )
+    assert list(server.iter_view("test", "openag/by_variable")) == rows
+    assert len(cache) == 1
+    assert list(server.iter_view("test", "openag/by_variable")) == rows
+    assert requests == [None, '"1-a"']
+
+    # A changed view is downloaded again
+    view["body"] = json.dumps({"rows": rows[:1]})
+    view["etag"] = '"2-b"'
+    assert list(server.iter_view("test", "openag/by_variable")) == rows[:1]
+    assert list(server.iter_view("test", "openag/by_variable")) == rows[:1]
+    assert requests[2:] == ['"1-a"', '"2-b"']
+
+@httpretty.activate
+def test_memory_cache():
+    check_cache(MemoryCache())
+
+@httpretty.activate
+def test_disk_cache():
+    path = tempfile.mkdtemp()
+    try:
+        check_cache(DiskCache(path))
+        # The cache survives restarts
+        cache = DiskCache(path)
+        url = "http://test.test:5984/test/_design/openag/_view/by_variable"
+        status, headers, body = cache.get(url)
+        assert status == 200
+        assert headers.get("etag") == '"2-b"'
+        assert json.loads(body)["rows"][0]["id"] == "0"
+    finally:
+        shutil.rmtree(path)
+
+@httpretty.activate
+def test_default_cache():
+    # Without a bounded cache, streamed responses aren't kept in memory
+    server = Server("http://test.test:5984")
+    rows = [{"id": str(i), "key": i, "value": i} for i in range(20000)]
+    httpretty.register_uri(
+        httpretty.GET, "http://test.test:5984/test/_all_docs",
+        content_type="application/json", adding_headers={"etag": '"1-a"'},
+        body=json.dumps({"total_rows": 20000, "offset": 0, "rows": rows})
+    )
+    assert list(server.iter_view("test", "_all_docs")) == rows
+    cache = server.resource.session.cache
+    assert cache.get("http://test.test:5984/test/_all_docs") is None
+    assert len(cache.by_url) == 0
+
+def response(body):
+    return 200, HTTPMessage(StringIO('ETag: "1-a"\r\n')), body
+
+def check_eviction(cache):
+    for i in range(4):
+        cache.put("http://test/{}".format(i), response("x" * 10))
+    assert not "http://test/0" in cache
+    # Reading an entry makes it the most recently used one
+    assert cache.get("http://test/1")[2] == "x" * 10
+    cache.put("http://test/4", response("x" * 10))
+    assert "http://test/1" in cache
+    assert not "http://test/2" in cache
+    # Entries larger than the cache aren't stored
+    cache.put("http://test/5", response("x" * 1000))
+    assert not "http://test/5" in cache
+
+def test_memory_cache_eviction():
+    check_eviction(MemoryCache(max_entries=3, max_bytes=100))
+    cache = MemoryCache(max_bytes=25)
+    cache.put("http://test/0", response("x" * 10))
+    cache.put("http://test/1", response("x" * 10))
+    cache.put("http://test/2", response("x" * 10))
+    assert len(cache) == 2 and cache.size == 20
+
+def test_disk_cache_eviction():
+    path = tempfile.mkdtemp()
+    try:
+        check_eviction(DiskCache(path, max_entries=3, max_bytes=1000))
+        assert len(DiskCache(path)) == 3
+    finally:
+        shutil.rmtree(path)
+
+@httpretty.activate
+def test_compression():
+    server = Server("http://test.test:5984", compress=True)
+    rows = [{"id": str(i), "key": i, "value": i} for i in range(1000)]
+    body = json.dumps({"total_rows": 1000, "offset": 0, "rows": rows})
+    accept_encodings = []
+    def get_view(request, uri, headers):
+        accept_encodings.append(request.headers.get("Accept-Encoding"))
+        headers["content-encoding"] = "gzip"
+        return 200, headers, _gzip(body)
+    httpretty.register_uri(
+        httpretty.GET,
+        "http://test.test:5984/test/_design/openag/_view/by_variable",
+        content_type="application/json", body=get_view
+    )
+    assert list(server.iter_view("test", "openag/by_variable")) == rows
+    assert accept_encodings == ["gzip"]
+
+    # Large request bodies are gzipped and small ones aren't
+    written = []
+    def bulk_docs(request, uri, headers):
+        data = request.body
+        if request.headers.get("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        docs = json.loads(data)["docs"]
+        written.append((request.headers.get("Content-Encoding"), len(docs)))
+        return 201, headers, json.dumps([
+            {"id": doc["_id"], "rev": "1-a"} for doc in docs
+        ])
+    httpretty.register_uri(
+        httpretty.POST, "http://test.test:5984/test/_bulk_docs",
+        content_type="application/json", body=bulk_docs
+    )
+    docs = [{"_id": str(i), "value": i} for i in range(100)]
+    server.resource("test").post_json("_bulk_docs", body={"docs": docs})
+    server.resource("test").post_json("_bulk_docs", body={"docs": docs[:1]})
+    assert written == [("gzip", 100), (None, 1)]
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,105 @@
+from voluptuous import MultipleInvalid
+
+from openag.models import (
+    EnvironmentalDataPoint, FirmwareModule, FirmwareModuleType, SoftwareModule
+)
+from openag.validators import compile_schema, get_validator, validate_batch
+
+def assert_same(schema, data):
+    """
+    Asserts that the compiled version of `schema` returns or raises the same
+    thing as `schema` itself for `data`
+    """
+    validate = compile_schema(schema)
+    try:
+        expected = schema(data)
+    except MultipleInvalid as e:
+        try:
+            validate(data)
+        except MultipleInvalid as e2:
+            assert str(e2) == str(e)
+        else:
+            assert False, "{!r} should be invalid".format(data)
+    else:
+        assert validate(data) == expected
+
+def test_data_point():
+    point = {
+        "environment": "env", "variable": u"air_temperature",
+        "is_desired": False, "value": 20, "timestamp": 1476900000.5,
+        "_id": "test"
+    }
+    assert_same(EnvironmentalDataPoint, point)
+    # Defaults should be filled in and extra keys removed
+    res = compile_schema(EnvironmentalDataPoint)(point)
+    assert res["is_manual"] is False
+    assert not "_id" in res
+    for key in ("environment", "is_desired", "timestamp"):
+        invalid = dict(point)
+        del invalid[key]
+        assert_same(EnvironmentalDataPoint, invalid)
+    assert_same(EnvironmentalDataPoint, dict(point, timestamp="now"))
+    assert_same(EnvironmentalDataPoint, dict(point, is_desired=1))
+    assert_same(EnvironmentalDataPoint, None)
+
+def test_firmware_modules():
+    module_type = {
+        "repository": {"type": "git", "url": "http://test"},
+        "header_file": "test.h",
+        "class_name": "Test",
+        "categories": ["sensors", u"calibration"],
+        "arguments": [{"name": "pin", "type": "int", "default": 2}],
+        "outputs": {"temp": {"type": "std_msgs/Float32", "accuracy": 0.5}},
+        "inputs": {},
+        "dependencies": [{"type": "pio", "id": 1}],
+        "status_codes": {"1": "Failed"},
+        "_id": "test"
+    }
+    assert_same(FirmwareModuleType, module_type)
+    res = compile_schema(FirmwareModuleType)(module_type)
+    assert res["repository"] == {"type": "git", "url": "http://test"}
+    assert_same(FirmwareModuleType, dict(
+        module_type, arguments=[{"name": "pin", "type": "long"}]
+    ))
+    assert_same(FirmwareModuleType, dict(
+        module_type, repository={"type": "svn", "url": "http://test"}
+    ))
+    assert_same(FirmwareModuleType, dict(
+        module_type, repository={"type": "git", "url": "http://test", "a": 1}
+    ))
+    assert_same(FirmwareModuleType, dict(module_type, categories=["test"]))
+    assert_same(FirmwareModuleType, dict(
+        module_type, outputs={"temp": {"accuracy": "high"}}
+    ))
+    assert_same(FirmwareModuleType, dict(
+        module_type, outputs={"temp": {"unknown": 1}}
+    ))
+    module = {
+        "type": "test", "environment": "env", "arguments": [1, "a"],
+        "categories": ["actuators"], "outputs": {}
+    }
+    assert_same(FirmwareModule, module)
+    assert_same(FirmwareModule, dict(module, arguments="a"))
+    assert_same(SoftwareModule, {"type": "test", "categories": ["control"]})
+    assert_same(SoftwareModule, {"categories": ["control"]})
+
+def test_validate_batch():
+    points = [
+        {
+            "environment": "env", "variable": "air_temperature",
+            "is_desired": False, "value": i, "timestamp": i
+        } for i in range(3)
+    ]
+    points[1]["timestamp"] = "now"
+    assert get_validator(EnvironmentalDataPoint) is \
+        get_validator(EnvironmentalDataPoint)
+    errors = []
+    res = validate_batch(EnvironmentalDataPoint, points, errors)
+    assert [p["value"] for p in res] == [0, 2]
+    assert [i for i, e in errors] == [1]
+    try:
+        validate_batch(EnvironmentalDataPoint, points)
+    except MultipleInvalid as e:
+        assert e.path == [1, "timestamp"]
+    else:
+        assert False, "The batch should be invalid"
@@ -0,0 +1,46 @@
+from openag.var_types import (
+    EnvVar, VariableDictionary, VARIABLE_DICTIONARY, AIR_TEMPERATURE,
+    AERIAL_IMAGE, FRONTAL_IMAGE, GROUP_CAMERA, GROUP_ENVIRONMENT
+)
+
+def test_variable_codes():
+    # Codes follow the order in which the variables are defined
+    assert AIR_TEMPERATURE.code == 0
+    assert [var.code for var in EnvVar.ordered] == \
+        list(range(len(EnvVar.items)))
+    assert VARIABLE_DICTIONARY.names == [var.name for var in EnvVar.ordered]
+    assert VARIABLE_DICTIONARY.code("air_temperature") == 0
+    assert VARIABLE_DICTIONARY.name(FRONTAL_IMAGE.code) == "frontal_image"
+    names = ["air_temperature", "frontal_image", "air_temperature"]
+    codes = VARIABLE_DICTIONARY.encode(names)
+    assert codes.itemsize == 2
+    assert VARIABLE_DICTIONARY.decode(codes) == names
+
+def test_variable_groups():
+    assert EnvVar.in_group(GROUP_CAMERA) == [AERIAL_IMAGE, FRONTAL_IMAGE]
+    assert VARIABLE_DICTIONARY.group(GROUP_CAMERA) == \
+        {"aerial_image", "frontal_image"}
+    assert VARIABLE_DICTIONARY.group_codes(GROUP_CAMERA) == \
+        {AERIAL_IMAGE.code, FRONTAL_IMAGE.code}
+    assert "air_temperature" in VARIABLE_DICTIONARY.group(GROUP_ENVIRONMENT)
+    assert VARIABLE_DICTIONARY.group("unknown") == frozenset()
+
+def test_variable_dictionary_doc():
+    doc = VARIABLE_DICTIONARY.to_doc()
+    assert doc["version"] == VARIABLE_DICTIONARY.version
+    res = VariableDictionary.from_doc(doc)
+    assert res.names == VARIABLE_DICTIONARY.names
+    assert res.groups == VARIABLE_DICTIONARY.groups
+
+def test_variable_dictionary_version():
+    names = VARIABLE_DICTIONARY.names
+    groups = {GROUP_CAMERA: ["aerial_image"]}
+    same = VariableDictionary(names, groups)
+    assert same.version == VariableDictionary(names, groups).version
+    # Changing a group changes the version even though no code changes
+    regrouped = VariableDictionary(names, {GROUP_CAMERA: ["frontal_image"]})
+    assert regrouped.version != same.version
+    assert regrouped.extends(same) and same.extends(regrouped)
+    newer = VariableDictionary(names + ["new_variable"], groups)
+    assert newer.version != same.version
+    assert newer.extends(same) and not same.extends(newer)